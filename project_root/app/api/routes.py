@@ -13,6 +13,7 @@ from flask_jwt_extended import (
 )
 from flask_cors import CORS
 from app.config import Config
+from app.core.catalog_index import CatalogIndex
 
 logger = logging.getLogger(__name__)
 
@@ -61,19 +62,19 @@ def register_routes(app: Flask, engine, storage, kafka):
         return jsonify(access_token=access_token)
 
 
-    def send_recommendations(user_id: str, recommendations: List, beats_map: Dict[int, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def send_recommendations(user_id: str, recommendations: List, catalog: CatalogIndex) -> List[Dict[str, Any]]:
         beats = []
 
         for rec in recommendations[:Config.BATCH_SIZE]:
-            full_beat = beats_map.get(rec[0])
+            full_beat = catalog.beat(rec[0])
             if not full_beat:
-                logger.warning(f"[API] Beat id {rec[0]} не найден в beats_map")
+                logger.warning(f"[API] Beat id {rec[0]} не найден в каталоге")
                 continue
 
-            beat = {**full_beat}
+            beat = full_beat.to_dict()
             beat["timestamp"] = datetime.now().isoformat()
             beats.append(beat)
-            kafka.send_recommendation(user_id, beat)
+            kafka.send_encoded_recommendation(user_id, full_beat.payload(), beat["id"], timestamp=beat["timestamp"])
 
         kafka.flush_producer()
         storage.direct_recommendations[user_id] = beats
@@ -168,7 +169,7 @@ def register_routes(app: Flask, engine, storage, kafka):
             recommendations = engine.generate_recommendations_by_genres(genres)
             logger.info(f"[API] Сгенерировано {len(recommendations)} рекомендаций")
 
-            beats = send_recommendations(user_id, recommendations, {b['id']: b for b in engine.beats})
+            beats = send_recommendations(user_id, recommendations, engine.catalog)
 
             return jsonify({
                 "status": "success",
@@ -235,10 +236,10 @@ def register_routes(app: Flask, engine, storage, kafka):
         storage.clear_recommendations(user_id)
 
         try:
-            recommendations = engine.generate_recommendations_by_likes(liked_ids)
+            recommendations = engine.generate_recommendations_by_likes(liked_ids, user_id=user_id)
             logger.info(f"[API] Сгенерировано {len(recommendations)} рекомендаций")
 
-            beats = send_recommendations(user_id, recommendations, {b['id']: b for b in engine.beats})
+            beats = send_recommendations(user_id, recommendations, engine.catalog)
 
             return jsonify({
                 "status": "success",
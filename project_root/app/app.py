@@ -5,8 +5,10 @@ from app.config import Config
 import threading
 from app.services.kafka_service import consume_recommendations, consume_refill_requests
 import logging
-from app.services.data_loader import load_data, load_lookup_tables
-from app.services.update_dataset import run_nightly_update
+from app.services.data_loader import load_data, load_lookup_tables, load_watermark
+from app.services.update_dataset import (run_nightly_update, run_incremental_refresh, add_update_listener,
+                                        publish_dataset, restore_snapshot, catch_up_dataset,
+                                        wait_for_shared_catalog, run_catalog_watcher)
 import app.services.globals as globals
 from app.core.recommendation_engine import RecommendationEngine
 from app.core.storage import RecommendationStorage
@@ -33,16 +35,17 @@ def create_app():
         """Загрузка и инициализация данных при старте приложения"""
         try:
             logger.info("Initializing dataset...")
-            dataset, features, genres, moods, beats, tags = load_data()
-            logger.info(f"Type of dataset: {type(dataset)}")
-            globals.beats_list = beats
-            globals.dataset_df = dataset
-            globals.df_feature_matrix = features
-            globals.df_genres = genres
-            globals.df_moods = moods
-            globals.df_tags = tags
+            if restore_snapshot():
+                # Отвечаем сразу по снимку, а свежие данные из базы подтягиваем в фоне
+                threading.Thread(target=catch_up_dataset, daemon=True).start()
+            elif not wait_for_shared_catalog():
+                # Обычный режим, загрузчик общего каталога или снимок загрузчика так и не появился
+                watermark = load_watermark() if Config.CATALOG_REFRESH_MINUTES > 0 else None
+                dataset, features, genres, tags, moods = load_data()
+                logger.info(f"Type of dataset: {type(dataset)}")
+                publish_dataset(dataset, features, genres, tags, moods, watermark)
 
-            logger.info(f"Loaded dataset with {len(dataset)} beats")
+            logger.info(f"Loaded dataset with {len(globals.dataset_df)} beats")
 
             logger.info("Loading lookup tables...")
             g, t, m = load_lookup_tables()
@@ -112,17 +115,21 @@ def create_app():
             (consume_recommendations, "Kafka Recommendations Consumer"),
             (consume_refill_requests, "Kafka Refill Consumer"),
             (run_nightly_update, "Nightly Dataset Update"),
+            (run_incremental_refresh, "Incremental Dataset Refresh"),
+            (run_catalog_watcher, "Catalog Snapshot Watcher"),
         ]
 
         for target, name in tasks:
             thread = threading.Thread(
-                target=lambda: run_safe(target, name), daemon=True
+                target=run_safe, args=(target, name), daemon=True
             )
             thread.start()
 
     try:
         initialize_data()
         engine = RecommendationEngine()
+        if Config.FIRST_LAUNCH_CACHE_WARM:
+            add_update_listener(engine.warm_first_launch_cache)
         storage = RecommendationStorage()
         kafka = KafkaClient()
         register_routes(app, engine, storage, kafka)
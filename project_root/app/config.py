@@ -8,9 +8,27 @@ class Config:
     REFILL_COOLDOWN = 300
     REFILL_THRESHOLD = 5  # Пороговое значение для дозапроса
     REFILL_COUNT = 9     
+    REFILL_BATCH_SIZE = 32        # Сколько refill-запросов скорится одним пакетом
+    REFILL_POLL_TIMEOUT_MS = 500
     BATCH_SIZE = 9       # Максимальное кол-во рекомендаций за раз
+    RERANK_CANDIDATES = 300  # Сколько лучших треков участвует в диверсификации по жанрам
     MIN_GENRES = 1       
     MAX_GENRES = 3
+    FIRST_LAUNCH_CACHE_SIZE = 4096      # Наборов жанров в кэше первого запуска
+    FIRST_LAUNCH_CACHE_WARM = True      # Прогревать кэш в фоне после обновления датасета
+    PROFILE_CACHE_SIZE = 10000          # Максимум профилей пользователей в памяти
+    PROFILE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+    CATALOG_WATERMARK_COLUMN = os.getenv("CATALOG_WATERMARK_COLUMN", "updated_at")  # Колонка beats для инкрементального обновления
+    CATALOG_CHUNK_SIZE = int(os.getenv("CATALOG_CHUNK_SIZE", "5000"))            # Строк каталога за одно чтение серверного курсора
+    MFCC_COPY = os.getenv("MFCC_COPY", "true").lower() == "true"                # Аудиофичи двоичным COPY в float32 (psycopg2)
+    CATALOG_REFRESH_MINUTES = int(os.getenv("CATALOG_REFRESH_MINUTES", "0"))     # Период инкрементального обновления, 0 — выключено
+    CATALOG_REFRESH_OVERLAP_SECONDS = float(os.getenv("CATALOG_REFRESH_OVERLAP_SECONDS", "60"))  # Окно перекрытия выборки изменений: опоздавшие коммиты не теряются
+    SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "")                                 # Каталог снимков датасета для быстрого старта, пусто — выключено
+    SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "2"))                         # Сколько последних снимков хранить
+    SNAPSHOT_MIN_INTERVAL_SECONDS = float(os.getenv("SNAPSHOT_MIN_INTERVAL_SECONDS", "600"))  # Снимки инкрементальных обновлений не чаще, полная перезагрузка пишет всегда
+    CATALOG_SHARED = os.getenv("CATALOG_SHARED", "false").lower() == "true"      # Один воркер грузит базу и пишет снимки, остальные открывают их через mmap
+    CATALOG_ATTACH_POLL_SECONDS = float(os.getenv("CATALOG_ATTACH_POLL_SECONDS", "5"))  # Как часто воркер проверяет поколение снимка
+    CATALOG_ATTACH_TIMEOUT_SECONDS = float(os.getenv("CATALOG_ATTACH_TIMEOUT_SECONDS", "60"))  # Сколько воркер при старте ждет снимок загрузчика, потом читает базу сам
     JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY") 
     JWT_TOKEN_LOCATION = ["headers"]          
     JWT_ACCESS_TOKEN_EXPIRES = 3600      
\ No newline at end of file
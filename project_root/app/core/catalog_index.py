@@ -0,0 +1,205 @@
+from itertools import count
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import json
+import logging
+import numpy as np
+import pandas as pd
+from app.core.incidence import CatalogMatrices, safe_parse_ids
+
+logger = logging.getLogger(__name__)
+
+_versions = count(1)
+
+
+def _parse_timestamps(value: Any) -> list:
+    if isinstance(value, list):
+        return value
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except json.JSONDecodeError:
+            logger.warning(f"[Catalog] Невозможно распарсить timestamps: {value}")
+    return []
+
+
+class BeatView:
+    """Легкое представление одной строки каталога без копирования данных"""
+    __slots__ = ("catalog", "row")
+
+    def __init__(self, catalog: "CatalogIndex", row: int):
+        self.catalog = catalog
+        self.row = row
+
+    @property
+    def id(self) -> str:
+        return self.catalog.beat_ids[self.row]
+
+    @property
+    def title(self) -> str:
+        return self.catalog.titles[self.row]
+
+    @property
+    def genres(self) -> List[str]:
+        return self.catalog.genres[self.row]
+
+    @property
+    def tags(self) -> List[str]:
+        return self.catalog.tags[self.row]
+
+    @property
+    def moods(self) -> List[str]:
+        return self.catalog.moods[self.row]
+
+    @property
+    def price(self) -> Optional[float]:
+        price = self.catalog.prices[self.row]
+        return None if np.isnan(price) else float(price)
+
+    def to_dict(self, with_categories: bool = True) -> Dict[str, Any]:
+        """Словарь трека в формате, который отправляется в Kafka"""
+        catalog, row = self.catalog, self.row
+        beat = {"id": self.id, "title": self.title}
+        if with_categories:
+            beat.update(genres=self.genres, tags=self.tags, moods=self.moods)
+        beat.update(
+            timestamps=catalog.timestamps[row],
+            picture=catalog.pictures[row],
+            price=self.price,
+            url=catalog.urls[row]
+        )
+        return beat
+
+    def payload(self, with_categories: bool = True) -> bytes:
+        """to_dict(), сериализованный в JSON один раз на версию каталога"""
+        return self.catalog.payload(self.row, with_categories)
+
+
+class CatalogIndex:
+    """
+    Колоночный каталог треков, который строится один раз на каждую загрузку датасета:
+    beat_id -> номер строки, колонки метаданных в массивах NumPy, категории в CSR-виде
+    (матрицы вхождений и упорядоченные коды) и представления строк BeatView
+    """
+    __slots__ = ("version", "beat_ids", "row_of", "titles", "pictures", "urls", "prices",
+                 "timestamps", "genres", "tags", "moods", "matrices", "_payloads")
+
+    def __init__(self, beat_ids: List[str], genres: List[List[str]],
+                 tags: List[List[str]], moods: List[List[str]],
+                 titles: Optional[np.ndarray] = None, pictures: Optional[np.ndarray] = None,
+                 urls: Optional[np.ndarray] = None, prices: Optional[np.ndarray] = None,
+                 timestamps: Optional[np.ndarray] = None, matrices: Optional[CatalogMatrices] = None,
+                 row_of: Optional[Dict[str, int]] = None):
+        self.version = next(_versions)
+        self.beat_ids = np.asarray(beat_ids, dtype=object)
+        if row_of is None:
+            # При дублях beat_id выигрывает первая строка, как при поиске через df['beat_id'] == id
+            row_of = {}
+            for row, beat_id in enumerate(beat_ids):
+                row_of.setdefault(beat_id, row)
+        self.row_of = row_of
+
+        n = len(beat_ids)
+        self.titles = titles if titles is not None else np.full(n, "", dtype=object)
+        self.pictures = pictures if pictures is not None else np.full(n, None, dtype=object)
+        self.urls = urls if urls is not None else np.full(n, None, dtype=object)
+        self.prices = prices if prices is not None else np.full(n, np.nan)
+        self.timestamps = timestamps if timestamps is not None else np.full(n, None, dtype=object)
+
+        # Матрицы вхождений, собранные при загрузке каталога, переиспользуются без повторного разбора списков
+        self.matrices = matrices if matrices is not None else CatalogMatrices.from_rows(genres, tags, moods)
+        self.genres = self.matrices.genres
+        self.tags = self.matrices.tags
+        self.moods = self.matrices.moods
+        self._payloads: Dict[Tuple[int, bool], bytes] = {}
+
+    def __len__(self) -> int:
+        return len(self.beat_ids)
+
+    def row(self, beat_id: Any) -> Optional[int]:
+        return self.row_of.get(str(beat_id))
+
+    def rows(self, beat_ids: Iterable[Any]) -> np.ndarray:
+        """Номера строк для найденных beat_id (ненайденные пропускаются, дубли схлопываются)"""
+        found = {self.row_of.get(str(b)) for b in beat_ids}
+        found.discard(None)
+        return np.fromiter(sorted(found), dtype=np.int64, count=len(found))
+
+    def beat(self, beat_id: Any) -> Optional[BeatView]:
+        row = self.row(beat_id)
+        return BeatView(self, row) if row is not None else None
+
+    def payload(self, row: int, with_categories: bool = True) -> bytes:
+        """
+        JSON-представление трека для Kafka. Статичные данные трека кодируются один раз
+        и переиспользуются до следующей загрузки датасета (новый каталог — новый кэш)
+        """
+        key = (row, with_categories)
+        encoded = self._payloads.get(key)
+        if encoded is None:
+            encoded = json.dumps(BeatView(self, row).to_dict(with_categories)).encode('utf-8')
+            self._payloads[key] = encoded
+        return encoded
+
+
+def build_catalog_index(df: pd.DataFrame, matrices: Optional[CatalogMatrices] = None) -> CatalogIndex:
+    """
+    matrices — готовые матрицы вхождений жанров, тегов и настроений в порядке строк df;
+    без них категории разбираются из колонок genre_ids/tag_ids/mood_ids
+    """
+    if matrices is None:
+        genres, tags, moods = (df[col].map(safe_parse_ids).tolist() for col in ('genre_ids', 'tag_ids', 'mood_ids'))
+    else:
+        genres = tags = moods = []
+    return CatalogIndex(
+        df['beat_id'].astype(str).tolist(),
+        genres,
+        tags,
+        moods,
+        titles=df['file'].astype(str).to_numpy(dtype=object),
+        pictures=df['picture'].to_numpy(dtype=object),
+        urls=df['url'].to_numpy(dtype=object),
+        prices=pd.to_numeric(df['price'], errors='coerce').to_numpy(dtype=np.float64),
+        timestamps=df['timestamps'].map(_parse_timestamps).to_numpy(dtype=object),
+        matrices=matrices
+    )
+
+
+def _patch_column(values: np.ndarray, source: np.ndarray, changed: List[Any]) -> np.ndarray:
+    """Колонка после обновления: values[source[row]] или по порядку значения changed там, где source == -1"""
+    patched = np.empty(len(source), dtype=values.dtype)
+    kept = source >= 0
+    patched[kept] = values[source[kept]]
+    # Поэлементно: списки (timestamps) не должны разворачиваться NumPy в измерение массива
+    for row, value in zip(np.flatnonzero(~kept).tolist(), changed):
+        patched[row] = value
+    return patched
+
+
+def patch_catalog_index(index: CatalogIndex, df: pd.DataFrame, source: np.ndarray,
+                        matrices: CatalogMatrices) -> CatalogIndex:
+    """
+    Индекс после инкрементального обновления без полной сборки: строки с source[row] >= 0 копируются
+    из index, разбираются только строки df с source == -1 (измененные и добавленные).
+    matrices — уже обновленные матрицы вхождений в порядке строк df
+    """
+    part = df.iloc[np.flatnonzero(source < 0)]
+    beat_ids = _patch_column(index.beat_ids, source, part['beat_id'].astype(str).tolist())
+
+    # Без удалений строки прежних треков остаются на своих местах: достаточно дописать новые id
+    n_old = len(index)
+    row_of = None
+    if len(source) >= n_old and np.all((source[:n_old] == np.arange(n_old)) | (source[:n_old] < 0)):
+        row_of = dict(index.row_of)
+        for row in range(n_old, len(source)):
+            row_of.setdefault(beat_ids[row], row)
+
+    return CatalogIndex(
+        beat_ids, [], [], [],
+        titles=_patch_column(index.titles, source, part['file'].astype(str).tolist()),
+        pictures=_patch_column(index.pictures, source, part['picture'].tolist()),
+        urls=_patch_column(index.urls, source, part['url'].tolist()),
+        prices=_patch_column(index.prices, source, pd.to_numeric(part['price'], errors='coerce').tolist()),
+        timestamps=_patch_column(index.timestamps, source, part['timestamps'].map(_parse_timestamps).tolist()),
+        matrices=matrices,
+        row_of=row_of
+    )
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Optional, Sequence, Tuple
+import logging
+import numpy as np
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+# (строки индекса каталога, скоры) в порядке выдачи
+RankedRows = Tuple[np.ndarray, np.ndarray]
+
+
+def genre_set_key(genres: Sequence[str]) -> Tuple[str, ...]:
+    return tuple(sorted(set(genres)))
+
+
+class FirstLaunchCache:
+    """
+    LRU-кэш результатов /create_rec_first_launch.
+    Ключ — версия каталога и отсортированный набор жанров (скоры зависят только от набора),
+    значение — готовые выдачи для каждого порядка жанров из запроса (от порядка зависит чередование)
+    """
+
+    def __init__(self, max_entries: int = Config.FIRST_LAUNCH_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[int, Tuple[str, ...]], Dict[Tuple[str, ...], RankedRows]]" = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version: int, genres: Sequence[str]) -> Optional[RankedRows]:
+        key = (version, genre_set_key(genres))
+        with self._lock:
+            entry = self._entries.get(key)
+            ranked = entry.get(tuple(genres)) if entry is not None else None
+            if ranked is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return ranked
+
+    def put(self, version: int, genres: Sequence[str], results: Dict[Tuple[str, ...], RankedRows]):
+        key = (version, genre_set_key(genres))
+        with self._lock:
+            # Записи прошлых версий каталога больше не понадобятся
+            stale = [k for k in self._entries if k[0] != version]
+            for k in stale:
+                del self._entries[k]
+
+            self._entries.setdefault(key, {}).update(results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def hot_sets(self) -> List[Tuple[str, ...]]:
+        """Наборы жанров из кэша, начиная с самых свежих — их стоит прогреть после перезагрузки"""
+        with self._lock:
+            return [key[1] for key in reversed(self._entries)]
+
+
+first_launch_cache = FirstLaunchCache()
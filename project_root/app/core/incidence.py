@@ -0,0 +1,194 @@
+from itertools import chain
+from typing import Any, Dict, List, Sequence, Tuple
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+def safe_parse_ids(ids: Any) -> List[str]:
+    """Разбирает поле genre_ids/tag_ids/mood_ids (строка '1||2', список или NaN) в список id"""
+    if ids is None or (isinstance(ids, (float, np.number)) and np.isnan(ids)):
+        return []
+    if isinstance(ids, str):
+        clean_str = ids.strip("[]'\" ")
+        if not clean_str:
+            return []
+        if '||' in clean_str:
+            return [x.strip() for x in clean_str.split('||') if x.strip()]
+        elif '|' in clean_str:
+            return [x.strip() for x in clean_str.split('|') if x.strip()]
+        elif ',' in clean_str:
+            return [x.strip() for x in clean_str.split(',') if x.strip()]
+        else:
+            return [clean_str]
+    elif isinstance(ids, (list, np.ndarray)):
+        return [str(x).strip() for x in ids if str(x).strip()]
+    else:
+        return [str(ids).strip()] if str(ids).strip() else []
+
+
+class CategoryIncidence:
+    """
+    Разреженная матрица вхождений (трек x категория) в формате CSR и словарь категорий.
+    Повторяющиеся категории в строке суммируются, как и в TrackScorer.calculate_score.
+    Исходные списки категорий хранятся целочисленными кодами в CSR-виде (row_indptr, row_codes)
+    с сохранением порядка и повторов; incidence[row] возвращает список названий строки
+    """
+    __slots__ = ("vocabulary", "codes", "matrix", "row_lengths", "presence", "unique_lengths",
+                 "row_indptr", "row_codes")
+
+    def __init__(self, vocabulary: List[str], matrix: sparse.csr_matrix,
+                 row_indptr: np.ndarray, row_codes: np.ndarray):
+        self.vocabulary = vocabulary
+        self.codes: Dict[str, int] = {name: code for code, name in enumerate(vocabulary)}
+        self.matrix = matrix
+        self.row_indptr = row_indptr
+        self.row_codes = row_codes
+        self.row_lengths = np.asarray(matrix.sum(axis=1), dtype=np.float64).ravel()
+        # Бинарная матрица (категория есть/нет) — аналог словаря {категория: вес} без повторов;
+        # структура (indices, indptr) общая с matrix, своим у нее только массив единиц
+        self.presence = sparse.csr_matrix((np.ones(len(matrix.data)), matrix.indices, matrix.indptr),
+                                          shape=matrix.shape, copy=False)
+        self.unique_lengths = np.diff(matrix.indptr).astype(np.float64)
+
+    @classmethod
+    def from_arrays(cls, vocabulary: List[str], arrays: Dict[str, np.ndarray]) -> "CategoryIncidence":
+        """
+        Матрица по массивам arrays() (например, открытым через mmap из снимка каталога) без копирования:
+        массивы уже в каноническом виде CSR, поэтому scipy не нужно их сортировать или сливать повторы
+        """
+        matrix = sparse.csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]),
+                                   shape=(len(arrays["indptr"]) - 1, len(vocabulary)), copy=False)
+        matrix.has_canonical_format = True
+        return cls(vocabulary, matrix, arrays["row_indptr"], arrays["row_codes"])
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Массивы, по которым матрица восстанавливается через from_arrays"""
+        return {"data": self.matrix.data, "indices": self.matrix.indices, "indptr": self.matrix.indptr,
+                "row_indptr": self.row_indptr, "row_codes": self.row_codes}
+
+    def __len__(self) -> int:
+        return len(self.row_indptr) - 1
+
+    def __getitem__(self, row: int) -> List[str]:
+        vocabulary = self.vocabulary
+        return [vocabulary[c] for c in self.row_codes[self.row_indptr[row]:self.row_indptr[row + 1]]]
+
+    def weights_vector(self, weights: Dict[str, float]) -> Tuple[np.ndarray, np.ndarray]:
+        """Переводит словарь весов в плотный вектор по словарю категорий и маску присутствующих ключей"""
+        vector = np.zeros(len(self.vocabulary))
+        mask = np.zeros(len(self.vocabulary))
+        for name, weight in weights.items():
+            code = self.codes.get(name)
+            if code is not None:
+                vector[code] = weight
+                mask[code] = 1.0
+        return vector, mask
+
+    def indicator(self, names) -> np.ndarray:
+        """Индикатор категорий словаря, входящих в names"""
+        vector = np.zeros(len(self.vocabulary))
+        for name in names:
+            code = self.codes.get(name)
+            if code is not None:
+                vector[code] = 1.0
+        return vector
+
+    def propagate(self, names) -> np.ndarray:
+        """
+        Распространение набора names на категории этого словаря через треки каталога.
+        Для каждого трека считается косинус между равномерным вектором names и вектором
+        {категория: 1 / длина списка} трека, затем категории трека получают вклад
+        1 / длина списка * косинус. Ключи сопоставляются по строковому id
+        """
+        unique_names = set(names)
+        if not unique_names:
+            return np.zeros(len(self.vocabulary))
+
+        overlap = self.presence @ self.indicator(unique_names)
+        denom = np.sqrt(len(unique_names) * self.unique_lengths)
+        lengths = self.row_lengths
+        weights = np.divide(overlap, denom * lengths, out=np.zeros_like(overlap), where=denom > 0)
+        return self.presence.T @ weights
+
+
+def build_incidence(rows: Sequence[List[str]]) -> CategoryIncidence:
+    """Строит CSR-матрицу вхождений по спискам категорий каждого трека"""
+    lengths = np.fromiter((len(r) for r in rows), dtype=np.int64, count=len(rows))
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+
+    flat = np.fromiter(chain.from_iterable(rows), dtype=object, count=int(indptr[-1]))
+    codes, uniques = pd.factorize(flat)
+    return incidence_from_codes([str(u) for u in uniques], indptr, codes.astype(np.int32))
+
+
+def incidence_from_codes(vocabulary: List[str], row_indptr: np.ndarray, row_codes: np.ndarray) -> CategoryIncidence:
+    """Матрица вхождений по уже закодированным спискам: категории строки row — row_codes[row_indptr[row]:row_indptr[row + 1]]"""
+    matrix = sparse.csr_matrix(
+        (np.ones(len(row_codes)), row_codes.copy(), row_indptr.copy()),
+        shape=(len(row_indptr) - 1, len(vocabulary))
+    )
+    matrix.sum_duplicates()
+    return CategoryIncidence(vocabulary, matrix, row_indptr, row_codes)
+
+
+def _patch_take(source: np.ndarray, n_rows: int) -> np.ndarray:
+    """Номера строк в [прежние строки | новые строки] для каждой строки после обновления (см. patch_incidence)"""
+    take = source.copy()
+    fresh = np.flatnonzero(source < 0)
+    take[fresh] = n_rows + np.arange(len(fresh))
+    return take
+
+
+def take_ragged(indptr: np.ndarray, values: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Строки rows массива переменной длины (indptr, values) с сохранением порядка внутри строк"""
+    lengths = np.diff(indptr)[rows]
+    taken_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=taken_indptr[1:])
+    positions = np.arange(taken_indptr[-1]) - np.repeat(taken_indptr[:-1] - indptr[rows], lengths)
+    return taken_indptr, values[positions]
+
+
+def patch_incidence(incidence: CategoryIncidence, source: np.ndarray, rows: Sequence[List[str]]) -> CategoryIncidence:
+    """
+    Матрица вхождений после инкрементального обновления каталога: строка row берется из incidence[source[row]],
+    а строки с source == -1 по порядку — из списков rows. Разбираются только rows, остальные строки
+    копируются. Новые категории дописываются в конец словаря; категории, оставшиеся без треков,
+    остаются пустыми колонками до полной перезагрузки
+    """
+    vocabulary = list(incidence.vocabulary)
+    codes = dict(incidence.codes)
+    fresh_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(r) for r in rows], out=fresh_indptr[1:])
+    fresh_codes = np.fromiter((codes.setdefault(name, len(codes)) for r in rows for name in r),
+                              dtype=np.int32, count=int(fresh_indptr[-1]))
+    vocabulary.extend(list(codes)[len(vocabulary):])
+
+    n_rows = len(incidence)
+    take = _patch_take(source, n_rows)
+    row_indptr, row_codes = take_ragged(
+        np.concatenate([incidence.row_indptr, incidence.row_indptr[-1] + fresh_indptr[1:]]),
+        np.concatenate([incidence.row_codes, fresh_codes]).astype(np.int32), take)
+
+    width = len(vocabulary)
+    matrix = incidence.matrix
+    matrix = sparse.csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(n_rows, width), copy=False)
+    fresh = incidence_from_codes(vocabulary, fresh_indptr, fresh_codes).matrix
+    matrix = sparse.vstack([matrix, fresh], format='csr')[take]
+    return CategoryIncidence(vocabulary, matrix, row_indptr, row_codes)
+
+
+class CatalogMatrices:
+    """Матрицы вхождений жанров, тегов и настроений, выровненные по порядку треков"""
+    __slots__ = ("genres", "tags", "moods")
+
+    def __init__(self, genres: CategoryIncidence, tags: CategoryIncidence, moods: CategoryIncidence):
+        self.genres = genres
+        self.tags = tags
+        self.moods = moods
+
+    @classmethod
+    def from_rows(cls, genres: Sequence[List[str]], tags: Sequence[List[str]],
+                  moods: Sequence[List[str]]) -> "CatalogMatrices":
+        return cls(build_incidence(genres), build_incidence(tags), build_incidence(moods))
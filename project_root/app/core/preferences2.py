@@ -8,27 +8,22 @@ class UserPreferenceAnalyzer:
     """
     @staticmethod
     def analyze_preferences(liked_ids: List[int]) -> Tuple[Dict[str, float], Dict[str, float], Dict[str, float]]:
-        if globals.dataset_df is None:
+        if globals.catalog_index is None:
             raise ValueError("Данные не загружены в глобальные переменные")
-        
+
         genre_counts = defaultdict(int)
         tag_counts = defaultdict(int)
         mood_counts = defaultdict(int)
 
-        # Проходим по всему датасету, ищем лайкнутые треки и считаем категории
-        for _, row in globals.dataset_df.iterrows():
-            if row['beat_id'] in liked_ids:
-                genres = row['genre_ids'].split('||') if isinstance(row['genre_ids'], str) else []
-                for genre in genres:
-                    genre_counts[genre.strip()] += 1
-                
-                tags = row['tag_ids'].split('||') if isinstance(row['tag_ids'], str) else []
-                for tag in tags:
-                    tag_counts[tag.strip()] += 1
-                
-                moods = row['mood_ids'].split('||') if isinstance(row['mood_ids'], str) else []
-                for mood in moods:
-                    mood_counts[mood.strip()] += 1
+        # Находим лайкнутые треки через индекс каталога и считаем категории
+        index = globals.catalog_index
+        for row in index.rows(liked_ids):
+            for genre in index.genres[row]:
+                genre_counts[genre] += 1
+            for tag in index.tags[row]:
+                tag_counts[tag] += 1
+            for mood in index.moods[row]:
+                mood_counts[mood] += 1
 
         total = len(liked_ids) or 1  
 
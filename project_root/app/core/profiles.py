@@ -0,0 +1,121 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import logging
+import numpy as np
+import app.services.globals as globals
+from app.core.catalog_index import CatalogIndex
+from app.core.incidence import CategoryIncidence
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def _row_sums(incidence: CategoryIncidence, rows: Sequence[int]) -> np.ndarray:
+    if len(rows) == 0:
+        return np.zeros(len(incidence.vocabulary))
+    return np.asarray(incidence.matrix[list(rows)].sum(axis=0), dtype=np.float64).ravel()
+
+
+class UserProfile:
+    """
+    Профиль предпочтений пользователя: счетчики жанров, тегов и настроений лайкнутых треков
+    в координатах словарей категорий конкретной версии индекса каталога
+    """
+    __slots__ = ("version", "liked_ids", "rows", "genre_counts", "tag_counts", "mood_counts")
+
+    def __init__(self, index: CatalogIndex):
+        self.version = index.version
+        self.liked_ids: List[str] = []
+        self.rows: Dict[str, int] = {}  # beat_id -> строка индекса для найденных в каталоге лайков
+        self.genre_counts = np.zeros(len(index.matrices.genres.vocabulary))
+        self.tag_counts = np.zeros(len(index.matrices.tags.vocabulary))
+        self.mood_counts = np.zeros(len(index.matrices.moods.vocabulary))
+
+    @property
+    def nbytes(self) -> int:
+        return self.genre_counts.nbytes + self.tag_counts.nbytes + self.mood_counts.nbytes
+
+    def apply_likes(self, index: CatalogIndex, liked_ids: Sequence[Any]):
+        """Доводит профиль до нового списка лайков, пересчитывая только добавленные и убранные треки"""
+        new_ids = [str(b) for b in liked_ids]
+        wanted = set(new_ids)
+
+        removed = [self.rows.pop(b) for b in list(self.rows) if b not in wanted]
+        added = []
+        for beat_id in wanted:
+            if beat_id not in self.rows:
+                row = index.row_of.get(beat_id)
+                if row is not None:
+                    self.rows[beat_id] = row
+                    added.append(row)
+
+        matrices = index.matrices
+        for rows, sign in ((added, 1.0), (removed, -1.0)):
+            if rows:
+                self.genre_counts += sign * _row_sums(matrices.genres, rows)
+                self.tag_counts += sign * _row_sums(matrices.tags, rows)
+                self.mood_counts += sign * _row_sums(matrices.moods, rows)
+
+        self.liked_ids = new_ids
+
+    def vectors(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Вектора предпочтений как в UserPreferenceAnalyzer: нормализация по количеству лайков"""
+        total = len(self.liked_ids) or 1
+        return (
+            self.genre_counts / total,
+            (self.genre_counts > 0).astype(np.float64),
+            self.tag_counts / total,
+            self.mood_counts / total
+        )
+
+
+class UserProfileStore:
+    """
+    LRU-хранилище профилей пользователей с ограничением по количеству и по памяти.
+    Профиль обновляется инкрементально при изменении лайков и пересобирается по лайкам
+    (без прохода по каталогу) после перезагрузки датасета
+    """
+
+    def __init__(self, max_profiles: int = Config.PROFILE_CACHE_SIZE,
+                 max_bytes: int = Config.PROFILE_CACHE_MAX_BYTES):
+        self.max_profiles = max_profiles
+        self.max_bytes = max_bytes
+        self._profiles: "OrderedDict[str, UserProfile]" = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+
+    def get(self, user_id: str, liked_ids: Sequence[Any],
+            index: Optional[CatalogIndex] = None) -> UserProfile:
+        index = index or globals.catalog_index
+        if index is None:
+            raise ValueError("Данные не загружены в глобальные переменные")
+
+        with self._lock:
+            profile = self._profiles.pop(user_id, None)
+            if profile is not None:
+                self._bytes -= profile.nbytes
+                if profile.version != index.version:
+                    logger.debug(f"[Profiles] Пересборка профиля {user_id} под новую версию каталога")
+                    profile = None
+
+            if profile is None:
+                profile = UserProfile(index)
+            if profile.liked_ids != [str(b) for b in liked_ids]:
+                profile.apply_likes(index, liked_ids)
+
+            self._profiles[user_id] = profile
+            self._bytes += profile.nbytes
+            self._evict()
+            return profile
+
+    def _evict(self):
+        while self._profiles and (len(self._profiles) > self.max_profiles or self._bytes > self.max_bytes):
+            _, profile = self._profiles.popitem(last=False)
+            self._bytes -= profile.nbytes
+
+    def __len__(self) -> int:
+        return len(self._profiles)
+
+
+profile_store = UserProfileStore()
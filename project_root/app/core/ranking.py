@@ -0,0 +1,26 @@
+from typing import Iterable, Optional
+import numpy as np
+
+
+def top_k(scores: np.ndarray, k: int, exclude: Optional[Iterable[int]] = None) -> np.ndarray:
+    """
+    Индексы k наибольших значений scores по убыванию за O(N) (np.partition) плюс сортировка k элементов.
+    Равные значения упорядочиваются по возрастанию индекса, как при стабильной сортировке.
+    exclude — индексы, которые не должны попасть в результат (лайкнутые треки, сам трек-запрос)
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    available = np.ones(len(scores), dtype=bool)
+    if exclude is not None:
+        excluded = np.fromiter(exclude, dtype=np.int64)
+        available[excluded] = False
+        scores = np.where(available, scores, -np.inf)
+
+    k = min(int(k), int(available.sum()))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+    above = np.flatnonzero((scores > threshold) & available)
+    ties = np.flatnonzero((scores == threshold) & available)[:k - len(above)]
+    selected = np.concatenate([above, ties])
+    return selected[np.lexsort((selected, -scores[selected]))]
@@ -1,192 +1,179 @@
-from typing import List, Tuple, Dict, Any
-from collections import defaultdict
+from typing import List, Tuple, Dict, Optional
+from itertools import permutations
 import numpy as np
 import logging
-import json 
-import pandas as pd
 import app.services.globals as globals
 from app.core.scoring import TrackScorer
+from app.core.catalog_index import CatalogIndex
 from app.core.preferences2 import UserPreferenceAnalyzer
+from app.core.profiles import profile_store
+from app.core.ranking import top_k
+from app.core.first_launch_cache import first_launch_cache, genre_set_key, RankedRows
 from app.config import Config
 
 logger = logging.getLogger(__name__)
 
-class SimilarityCalculator:
-    """Класс для вычисления косинусного сходства между двумя словарями-векторами"""
-    @staticmethod
-    def cosine_similarity(vec1: Dict[str, float], vec2: Dict[str, float]) -> float:
-        all_keys = set(vec1.keys()).union(vec2.keys())
-        v1 = np.array([vec1.get(k, 0) for k in all_keys])
-        v2 = np.array([vec2.get(k, 0) for k in all_keys])
-        norm1 = np.linalg.norm(v1)
-        norm2 = np.linalg.norm(v2)
-        if norm1 == 0 or norm2 == 0:
-            return 0.0
-        return float(np.dot(v1, v2) / (norm1 * norm2))
-
-
 class RecommendationEngine:
     """Генерация рекомендаций по жанрам или по лайкам"""
 
     def __init__(self):
         self.scorer = TrackScorer()
-        self.similarity = SimilarityCalculator()
         self.preference = UserPreferenceAnalyzer()
 
-        if globals.dataset_df is None:
+        if globals.catalog_index is None:
             logger.error("[Engine] Глобальные данные не загружены")
             raise ValueError("Данные не загружены в глобальные переменные")
 
         logger.info("[Engine] Инициализация RecommendationEngine")
-        self.beats = self._prepare_beats_data()
-        logger.info(f"[Engine] Загружено {len(self.beats)} треков")
-
-    def _prepare_beats_data(self) -> List[Dict[str, Any]]:
-            import json 
-
-            beats = []
-
-            def safe_parse_ids(ids):
-                if ids is None or (isinstance(ids, (float, np.number)) and np.isnan(ids)):
-                    return []
-                if isinstance(ids, str):
-                    clean_str = ids.strip("[]'\" ")
-                    if not clean_str:
-                        return []
-                    if '||' in clean_str:
-                        return [x.strip() for x in clean_str.split('||') if x.strip()]
-                    elif '|' in clean_str:
-                        return [x.strip() for x in clean_str.split('|') if x.strip()]
-                    elif ',' in clean_str:
-                        return [x.strip() for x in clean_str.split(',') if x.strip()]
-                    else:
-                        return [clean_str]
-                elif isinstance(ids, (list, np.ndarray)):
-                    return [str(x).strip() for x in ids if str(x).strip()]
-                else:
-                    return [str(ids).strip()] if str(ids).strip() else []
-
-            for _, row in globals.dataset_df.iterrows():
-                try:
-                    # Обработка timestamps
-                    timestamps_raw = row.get('timestamps', [])
-                    timestamps = []
-                    if isinstance(timestamps_raw, str):
-                        try:
-                            timestamps = json.loads(timestamps_raw)
-                        except json.JSONDecodeError:
-                            logger.warning(f"[Engine] Невозможно распарсить timestamps у трека {row.get('beat_id')}: {timestamps_raw}")
-                    elif isinstance(timestamps_raw, list):
-                        timestamps = timestamps_raw
-                    else:
-                        timestamps = []
-
-                    beat = {
-                        "id": str(row['beat_id']),
-                        "title": str(row['file']),
-                        "genres": safe_parse_ids(row.get('genre_ids')),
-                        "tags": safe_parse_ids(row.get('tag_ids')),
-                        "moods": safe_parse_ids(row.get('mood_ids')),
-                        "timestamps": timestamps,
-                        "picture": row['picture'],
-                        "price": float(row['price']),
-                        "url": row['url'],
-                        # "audio_features": {
-                        #     "crm": [float(row.get(f'crm{i}', 0)) for i in range(1, 13)],
-                        #     "melspectrogram": row.get('melspectrogram', []),
-                        #     "spectral_centroid": float(row.get('spectral_centroid', 0)),
-                        #     "mfcc": [float(row.get(f'mfcc{i}', 0)) for i in range(1, 51)]
-                        # }
-                    }
-                    beats.append(beat)
-
-                    logger.debug(f"Processed beat: {beat['id']}")
-                    logger.debug(f"Genres: {beat['genres']}")
-                    logger.debug(f"Tags: {beat['tags']}")
-                    logger.debug(f"Moods: {beat['moods']}")
-
-                except Exception as e:
-                    logger.error(f"Error processing beat {row.get('beat_id')}: {str(e)}")
-                    continue
-
-            return beats
-
-    def alternate_genres(self, tracks: List[Tuple], preferred_genres: List[str]) -> List[Tuple]:
+        logger.info(f"[Engine] Загружено {len(self.catalog)} треков")
+
+    @property
+    def catalog(self) -> CatalogIndex:
+        """Актуальный колоночный каталог треков (подменяется при обновлении датасета)"""
+        return globals.catalog_index
+
+    def _ranked_tracks(self, index: CatalogIndex, rows: np.ndarray, scores: np.ndarray) -> List[Tuple]:
+        """Кортежи (id, title, genres, tags, moods, score) для отобранных строк индекса и их скоров"""
+        return [
+            (index.beat_ids[row], index.titles[row], index.genres[row], index.tags[row], index.moods[row], float(score))
+            for row, score in zip(rows, scores)
+        ]
+
+    def rerank_by_genres(self, index: CatalogIndex, scores: np.ndarray,
+                         preferred_genres: List[str], limit: int) -> np.ndarray:
+        """
+        Диверсификация выдачи по жанрам (round-robin) поверх Config.RERANK_CANDIDATES лучших треков.
+        Трек попадает в корзину первого предпочтенного жанра, который у него есть, корзины выдаются
+        по кругу в порядке preferred_genres. Треки без предпочтенных жанров не выбрасываются,
+        а идут в конец выдачи. Стоимость не зависит от размера каталога, кроме одного top_k
+        """
         logger.debug("[Engine] Перемешивание по жанрам")
-        genre_map = {genre: [] for genre in preferred_genres}
-        for track in tracks:
-            for genre in preferred_genres:
-                if genre in track[2]:
-                    genre_map[genre].append(track)
-                    break
-
-        alternated = []
-        max_len = max(len(lst) for lst in genre_map.values()) if genre_map else 0
-        for i in range(max_len):
-            for genre in preferred_genres:
-                if i < len(genre_map[genre]):
-                    alternated.append(genre_map[genre][i])
-
-        logger.debug(f"[Engine] После перемешивания {len(alternated)} треков")
-        return alternated
+        candidates = top_k(scores, max(limit, Config.RERANK_CANDIDATES))
+        if len(candidates) == 0:
+            return candidates
+
+        genres = index.matrices.genres
+        preferred = list(dict.fromkeys(preferred_genres))
+        codes = [genres.codes.get(genre) for genre in preferred]
+        membership = np.zeros((len(candidates), len(preferred)), dtype=bool)
+        known = [i for i, code in enumerate(codes) if code is not None]
+        if known:
+            columns = [codes[i] for i in known]
+            membership[:, known] = genres.presence[candidates][:, columns].toarray() > 0
+
+        # Корзина — первый подходящий жанр, len(preferred) — треки без предпочтенных жанров
+        bucket = np.where(membership.any(axis=1), membership.argmax(axis=1), len(preferred))
+
+        # Позиция трека внутри своей корзины (кандидаты уже отсортированы по скору)
+        order = np.argsort(bucket, kind='stable')
+        starts = np.flatnonzero(np.r_[True, np.diff(bucket[order]) != 0])
+        sizes = np.diff(np.r_[starts, len(order)])
+        rank = np.empty(len(candidates), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - np.repeat(starts, sizes)
+
+        fallback = bucket == len(preferred)
+        reranked = candidates[np.lexsort((bucket, rank, fallback))]
+        logger.debug(f"[Engine] После перемешивания {len(reranked)} кандидатов")
+        return reranked[:limit]
+
+    def genre_scores(self, index: CatalogIndex, genres: List[str]) -> np.ndarray:
+        """Скоры всех строк каталога для набора жанров первого запуска"""
+        genre_vec = {genre: 1 / len(genres) for genre in genres}
+        matrices = index.matrices
+
+        # Распространение жанров на теги и настроения: два разреженных умножения матрица-вектор на словарь
+        tag_scores = matrices.tags.propagate(genres)
+        mood_scores = matrices.moods.propagate(genres)
+        genre_v, genre_mask = matrices.genres.weights_vector(genre_vec)
+
+        return self.scorer.score_vectors(
+            matrices, genre_v, genre_mask, tag_scores, mood_scores,
+            genre_total=sum(genre_vec.values())
+        )
+
+    def rank_genres(self, index: CatalogIndex, genres: List[str]) -> RankedRows:
+        """
+        Считает выдачу для genres и кладет в кэш выдачи для всех порядков этого набора жанров:
+        скоры от порядка не зависят и считаются один раз
+        """
+        scores = self.genre_scores(index, genres)
+        orders = {tuple(genres)} | set(permutations(genre_set_key(genres)))
+        results = {}
+        for order in orders:
+            rows = self.rerank_by_genres(index, scores, list(order), Config.BATCH_SIZE)
+            results[order] = (rows, scores[rows])
+        first_launch_cache.put(index.version, genres, results)
+        return results[tuple(genres)]
+
+    def warm_first_launch_cache(self, index: CatalogIndex):
+        """Прогрев кэша первого запуска после перезагрузки датасета: горячие наборы и все одиночные жанры"""
+        genre_sets = first_launch_cache.hot_sets()
+        genre_sets += [(genre,) for genre in index.matrices.genres.vocabulary]
+        genre_sets = list(dict.fromkeys(genre_sets))[:first_launch_cache.max_entries]
+
+        logger.info(f"[Engine] Прогрев кэша первого запуска: {len(genre_sets)} наборов жанров")
+        for genre_set in genre_sets:
+            try:
+                self.rank_genres(index, list(genre_set))
+            except Exception as e:
+                logger.error(f"[Engine] Ошибка прогрева для жанров {genre_set}: {e}")
+        logger.info("[Engine] Прогрев кэша первого запуска завершен")
 
     def generate_recommendations_by_genres(self, genres: List[str]) -> List[Tuple]:
         logger.info(f"[Engine] Генерация по жанрам: {genres}")
         if len(genres) < Config.MIN_GENRES or len(genres) > Config.MAX_GENRES:
             raise ValueError(f"Количество жанров должно быть от {Config.MIN_GENRES} до {Config.MAX_GENRES}")
 
-        genre_vec = {genre: 1 / len(genres) for genre in genres}
-        tag_scores = defaultdict(float)
-        mood_scores = defaultdict(float)
-        print(self.beats)
-
-        for beat in self.beats:
-            beat_vec = {
-                "genres": {g: 1 / len(beat["genres"]) for g in beat["genres"]} if beat["genres"] else {},
-                "tags": {t: 1 / len(beat["tags"]) for t in beat["tags"]} if beat["tags"] else {},
-                "moods": {m: 1 / len(beat["moods"]) for m in beat["moods"]} if beat["moods"] else {}
-            }
-            tag_sim = self.similarity.cosine_similarity(genre_vec, beat_vec["tags"])
-            mood_sim = self.similarity.cosine_similarity(genre_vec, beat_vec["moods"])
-
-            for tag, val in beat_vec["tags"].items():
-                tag_scores[tag] += val * tag_sim
-            for mood, val in beat_vec["moods"].items():
-                mood_scores[mood] += val * mood_sim
-
-        scored_tracks = [
-            (
-                beat["id"],
-                beat["title"],
-                beat["genres"],
-                beat["tags"],
-                beat["moods"],
-                self.scorer.calculate_score(beat["id"], genre_vec, tag_scores, mood_scores)
-            ) for beat in self.beats
-        ]
-        scored_tracks.sort(key=lambda x: x[5], reverse=True)
-        logger.info(f"[Engine] Отсортировано {len(scored_tracks)} треков, лучшие: {[s[5] for s in scored_tracks[:5]]}")
+        index = globals.catalog_index
+        ranked = first_launch_cache.get(index.version, genres)
+        if ranked is None:
+            ranked = self.rank_genres(index, genres)
+        rows, scores = ranked
 
-        alternated = self.alternate_genres(scored_tracks, genres)
-        return alternated[:Config.BATCH_SIZE]
+        tracks = self._ranked_tracks(index, rows, scores)
+        logger.info(f"[Engine] Отобрано {len(tracks)} треков, лучшие: {[s[5] for s in tracks[:5]]}")
+        return tracks
 
-    def generate_recommendations_by_likes(self, liked_ids: List[int], count: int = Config.REFILL_COUNT) -> List[Tuple]:
+    def generate_recommendations_by_likes(self, liked_ids: List[int], count: int = Config.REFILL_COUNT,
+                                          user_id: Optional[str] = None) -> List[Tuple]:
         logger.info(f"[Engine] Генерация по лайкам: {liked_ids}")
-        genre_v, tag_v, mood_v = self.preference.analyze_preferences(liked_ids)
-        logger.debug(f"[Engine] Вектора предпочтений: genre={genre_v}, tag={tag_v}, mood={mood_v}")
-
-        candidates = [
-            (
-                beat["id"],
-                beat["title"],
-                beat["genres"],
-                beat["tags"],
-                beat["moods"],
-                self.scorer.calculate_score(beat["id"], genre_v, tag_v, mood_v)
-            )
-            for beat in self.beats if beat["id"] not in liked_ids
-        ]
-
-        candidates.sort(key=lambda x: x[5], reverse=True)
+        index = globals.catalog_index
+        if user_id is not None:
+            # Профиль пользователя обновляется инкрементально и переиспользуется между refill-ами
+            profile = profile_store.get(user_id, liked_ids, index)
+            scores = self.scorer.score_vectors(index.matrices, *profile.vectors())
+        else:
+            genre_v, tag_v, mood_v = self.preference.analyze_preferences(liked_ids)
+            logger.debug(f"[Engine] Вектора предпочтений: genre={genre_v}, tag={tag_v}, mood={mood_v}")
+            scores = self.scorer.score_catalog(index.matrices, genre_v, tag_v, mood_v)
+
+        # Частичный отбор top-k по строкам индекса вместо сортировки всего каталога
+        top_rows = top_k(scores, count, exclude=index.rows(liked_ids))
+        candidates = self._ranked_tracks(index, top_rows, scores[top_rows])
         logger.info(f"[Engine] Отобрано {len(candidates)} кандидатов, лучшие: {[s[5] for s in candidates[:5]]}")
-        return candidates[:count]
+        return candidates
+
+    def generate_recommendations_batch(self, users: Dict[str, List[int]],
+                                       count: int = Config.REFILL_COUNT) -> Dict[str, List[Tuple]]:
+        """
+        Рекомендации по лайкам сразу для нескольких пользователей: профили складываются
+        в матрицы (категория x пользователь) и скорятся одним умножением матрица-матрица,
+        затем для каждого пользователя отбирается top-k без его лайкнутых треков
+        """
+        if not users:
+            return {}
+
+        logger.info(f"[Engine] Пакетная генерация по лайкам для {len(users)} пользователей")
+        index = globals.catalog_index
+        user_ids = list(users)
+        vectors = [profile_store.get(user_id, users[user_id], index).vectors() for user_id in user_ids]
+        genre_v, genre_mask, tag_v, mood_v = (np.column_stack([v[i] for v in vectors]) for i in range(4))
+
+        scores = self.scorer.score_vectors(index.matrices, genre_v, genre_mask, tag_v, mood_v)
+
+        results = {}
+        for col, user_id in enumerate(user_ids):
+            user_scores = scores[:, col]
+            top_rows = top_k(user_scores, count, exclude=index.rows(users[user_id]))
+            results[user_id] = self._ranked_tracks(index, top_rows, user_scores[top_rows])
+        return results
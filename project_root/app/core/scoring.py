@@ -1,5 +1,13 @@
-from typing import Dict
+from typing import Dict, Optional
+import numpy as np
 from app.services import globals
+from app.core.incidence import CatalogMatrices
+
+
+def _nonzero(total):
+    """Нулевая сумма весов заменяется на 1, как `sum(...) or 1` в calculate_score"""
+    return np.where(total == 0, 1, total)
+
 
 class TrackScorer:
     """
@@ -15,28 +23,27 @@ class TrackScorer:
                         genre_weights: Dict[str, float],
                         tag_weights: Dict[str, float],
                         mood_weights: Dict[str, float]) -> float:
-        if globals.dataset_df is None:
+        if globals.catalog_index is None:
             raise ValueError("Данные не загружены в глобальные переменные")
-        
-        # Поиск строки трека по ID
-        track_row = globals.dataset_df[globals.dataset_df['beat_id'] == track_id]
-        if track_row.empty:
+
+        # Поиск строки трека по ID через индекс каталога
+        index = globals.catalog_index
+        row = index.row(track_id)
+        if row is None:
             return 0.0
-        
-        row = track_row.iloc[0]
-        
-        # Получаем жанры, теги и настроения 
-        genres = row['genre_ids'].split('||') if isinstance(row['genre_ids'], str) else []
-        tags = row['tag_ids'].split('||') if isinstance(row['tag_ids'], str) else []
-        moods = row['mood_ids'].split('||') if isinstance(row['mood_ids'], str) else []
+
+        # Получаем заранее разобранные жанры, теги и настроения
+        genres = index.genres[row]
+        tags = index.tags[row]
+        moods = index.moods[row]
 
         # Вычисляем сумму весов для каждого типа признаков
-        genre_score = sum(genre_weights.get(g.strip(), 0) for g in genres)
-        tag_score = sum(tag_weights.get(t.strip(), 0) for t in tags)
-        mood_score = sum(mood_weights.get(m.strip(), 0) for m in moods)
+        genre_score = sum(genre_weights.get(g, 0) for g in genres)
+        tag_score = sum(tag_weights.get(t, 0) for t in tags)
+        mood_score = sum(mood_weights.get(m, 0) for m in moods)
 
         # Применяем штраф за неподходящие жанры
-        extra_genres = [g for g in genres if g.strip() not in genre_weights]
+        extra_genres = [g for g in genres if g not in genre_weights]
         if extra_genres:
             genre_score *= self.penalty ** len(extra_genres)
 
@@ -52,3 +59,58 @@ class TrackScorer:
             self.mood_weight * mood_norm
         )
         return final_score
+
+    def score_catalog(self, matrices: CatalogMatrices,
+                      genre_weights: Dict[str, float],
+                      tag_weights: Dict[str, float],
+                      mood_weights: Dict[str, float]) -> np.ndarray:
+        """
+        Векторный аналог calculate_score сразу для всех треков каталога.
+        Возвращает массив скоров в порядке строк матриц вхождений
+        """
+        genre_vec, genre_mask = matrices.genres.weights_vector(genre_weights)
+        tag_vec, _ = matrices.tags.weights_vector(tag_weights)
+        mood_vec, _ = matrices.moods.weights_vector(mood_weights)
+
+        # Суммы берутся по исходным словарям: ключи вне словаря категорий тоже участвуют в нормализации
+        return self.score_vectors(
+            matrices, genre_vec, genre_mask, tag_vec, mood_vec,
+            genre_total=sum(genre_weights.values()),
+            tag_total=sum(tag_weights.values()),
+            mood_total=sum(mood_weights.values())
+        )
+
+    def score_vectors(self, matrices: CatalogMatrices,
+                      genre_vec: np.ndarray,
+                      genre_mask: np.ndarray,
+                      tag_vec: np.ndarray,
+                      mood_vec: np.ndarray,
+                      genre_total: Optional[float] = None,
+                      tag_total: Optional[float] = None,
+                      mood_total: Optional[float] = None) -> np.ndarray:
+        """
+        Скоринг каталога по готовым векторам весов в координатах словарей категорий.
+        genre_mask отмечает жанры, присутствующие среди весов (для штрафа за лишние жанры).
+        Вектора могут быть матрицами (категория x пользователь) — тогда за одно умножение
+        матрица-матрица считаются скоры сразу для нескольких пользователей (трек x пользователь)
+        """
+        genre_score = matrices.genres.matrix @ genre_vec
+        tag_score = matrices.tags.matrix @ tag_vec
+        mood_score = matrices.moods.matrix @ mood_vec
+
+        # Штраф за жанры трека, отсутствующие среди весов
+        row_lengths = matrices.genres.row_lengths
+        if genre_vec.ndim == 2:
+            row_lengths = row_lengths[:, None]
+        extra_genres = row_lengths - matrices.genres.matrix @ genre_mask
+        genre_score *= np.power(self.penalty, extra_genres)
+
+        genre_total = genre_vec.sum(axis=0) if genre_total is None else genre_total
+        tag_total = tag_vec.sum(axis=0) if tag_total is None else tag_total
+        mood_total = mood_vec.sum(axis=0) if mood_total is None else mood_total
+
+        return (
+            self.genre_weight * genre_score / _nonzero(genre_total) +
+            self.tag_weight * tag_score / _nonzero(tag_total) +
+            self.mood_weight * mood_score / _nonzero(mood_total)
+        )
@@ -0,0 +1,213 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+import numpy as np
+import pandas as pd
+from app.services.catalog_stream import AUDIO_COLUMNS, CATEGORY_COLUMNS, META_COLUMNS
+from app.core.incidence import CatalogMatrices, CategoryIncidence
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 2
+CURRENT_FILE = "CURRENT"
+GENERATION_LOCK_FILE = ".generation.lock"
+META_FILE = "meta.json"
+TABLE_FILE = "table.json"
+TABLE_COLUMNS = ['beat_id', 'file', 'picture', 'url', 'timestamps']
+
+
+def write_current(root: str, version: str):
+    """Атомарно переключает указатель на готовый снимок"""
+    tmp_path = os.path.join(root, CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(root, CURRENT_FILE))
+
+
+def read_current(root: str) -> Optional[str]:
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def snapshot_generation(version: Optional[str]) -> int:
+    """Номер поколения из имени снимка '<поколение>-<время>-<суффикс>' (0 — снимка нет)"""
+    try:
+        return int(version.split("-", 1)[0]) if version else 0
+    except ValueError:
+        return 0
+
+
+def read_generation(root: str) -> int:
+    """Поколение текущего снимка: растет с каждым записанным снимком, воркеры сравнивают его для переподключения"""
+    return snapshot_generation(read_current(root))
+
+
+def _encode_watermark(watermark: Any) -> Dict[str, Any]:
+    if isinstance(watermark, datetime):
+        return {"watermark": watermark.isoformat(), "watermark_type": "datetime"}
+    return {"watermark": watermark, "watermark_type": None}
+
+
+def _decode_watermark(meta: Dict[str, Any]) -> Any:
+    if meta.get("watermark_type") == "datetime" and meta.get("watermark") is not None:
+        return datetime.fromisoformat(meta["watermark"])
+    return meta.get("watermark")
+
+
+@contextmanager
+def _generation_lock(root: str):
+    """
+    flock на отдельном файле каталога снимков (не .loader.lock: его держит загрузчик, и повторный
+    flock из того же процесса заблокировался бы). В файле хранится последнее выданное поколение
+    """
+    fd = os.open(os.path.join(root, GENERATION_LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def allocate_generation(root: str) -> int:
+    """
+    Следующее поколение снимка. Выдается под блокировкой и сразу записывается в файл блокировки,
+    поэтому несколько процессов, пишущих снимки одновременно, не получат одно и то же поколение
+    """
+    with _generation_lock(root) as fd:
+        try:
+            last = int(os.pread(fd, 32, 0).decode().strip() or 0)
+        except ValueError:
+            last = 0
+        generation = max([last, read_generation(root)] + [snapshot_generation(v) for v in list_snapshots(root)]) + 1
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, str(generation).encode(), 0)
+        return generation
+
+
+def write_snapshot(root: str, df: pd.DataFrame, feature_matrix: np.ndarray, matrices: CatalogMatrices,
+                   watermark: Any = None, keep: int = 2) -> str:
+    """
+    Пишет снимок каталога в новую версионированную директорию: аудиофичи и матрица признаков (.npy),
+    массивы матриц вхождений категорий (.npy, см. CategoryIncidence.arrays), таблица метаданных (table.json)
+    и meta.json. Директория собирается под временным именем и переименовывается целиком, затем переключается CURRENT
+    """
+    os.makedirs(root, exist_ok=True)
+    generation = allocate_generation(root)
+    # Суффикс делает имя уникальным, даже если два процесса пишут снимки в одну секунду
+    version = f"{generation:010d}-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    tmp_path = os.path.join(root, f".tmp-{version}")
+    os.makedirs(tmp_path)
+    try:
+        np.save(os.path.join(tmp_path, "features.npy"), np.ascontiguousarray(feature_matrix))
+        np.save(os.path.join(tmp_path, "audio.npy"), np.ascontiguousarray(df[AUDIO_COLUMNS].to_numpy(dtype=np.float64)))
+        np.save(os.path.join(tmp_path, "price.npy"), pd.to_numeric(df['price'], errors='coerce').to_numpy(dtype=np.float64))
+        vocabularies = {}
+        for col, incidence in zip(CATEGORY_COLUMNS, (matrices.genres, matrices.tags, matrices.moods)):
+            for name, array in incidence.arrays().items():
+                np.save(os.path.join(tmp_path, f"{col}_{name}.npy"), array)
+            vocabularies[col] = incidence.vocabulary
+        with open(os.path.join(tmp_path, TABLE_FILE), "w") as f:
+            json.dump({col: df[col].tolist() for col in TABLE_COLUMNS}, f, default=str)
+        with open(os.path.join(tmp_path, META_FILE), "w") as f:
+            json.dump({
+                "format": SNAPSHOT_FORMAT,
+                "rows": len(df),
+                "feature_columns": int(feature_matrix.shape[1]),
+                "vocabularies": vocabularies,
+                "created_at": time.time(),
+                **_encode_watermark(watermark)
+            }, f)
+        os.rename(tmp_path, os.path.join(root, version))
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    with _generation_lock(root):
+        # Снимок, дописанный позже более нового, не откатывает CURRENT назад
+        if generation > read_generation(root):
+            write_current(root, version)
+    prune_snapshots(root, keep)
+    logger.info(f"Catalog snapshot {version} written: {len(df)} beats")
+    return version
+
+
+def list_snapshots(root: str) -> List[str]:
+    """Версии снимков от новых к старым"""
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return []
+    return sorted((name for name in names if not name.startswith(".") and name != CURRENT_FILE
+                   and os.path.isdir(os.path.join(root, name))), reverse=True)
+
+
+def prune_snapshots(root: str, keep: int):
+    current = read_current(root)
+    for version in list_snapshots(root)[max(keep, 1):]:
+        if version != current:
+            shutil.rmtree(os.path.join(root, version), ignore_errors=True)
+
+
+def _open_snapshot(path: str):
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    if meta.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"unsupported snapshot format {meta.get('format')}")
+    n_rows = int(meta["rows"])
+
+    features = np.load(os.path.join(path, "features.npy"), mmap_mode="r")
+    audio = np.load(os.path.join(path, "audio.npy"), mmap_mode="r")
+    price = np.load(os.path.join(path, "price.npy"), mmap_mode="r")
+    if features.shape != (n_rows, meta["feature_columns"]) or audio.shape != (n_rows, len(AUDIO_COLUMNS)) \
+            or price.shape != (n_rows,):
+        raise ValueError("array shapes do not match metadata")
+    with open(os.path.join(path, TABLE_FILE)) as f:
+        table = json.load(f)
+    if any(len(table[col]) != n_rows for col in TABLE_COLUMNS):
+        raise ValueError("metadata table does not match row count")
+
+    # Матрицы вхождений собираются прямо над массивами снимка: воркеры делят их страницы через page cache
+    incidences = []
+    for col in CATEGORY_COLUMNS:
+        arrays = {name: np.load(os.path.join(path, f"{col}_{name}.npy"), mmap_mode="r")
+                  for name in ("data", "indices", "indptr", "row_indptr", "row_codes")}
+        if len(arrays["indptr"]) != n_rows + 1 or len(arrays["row_indptr"]) != n_rows + 1 \
+                or arrays["row_indptr"][-1] != len(arrays["row_codes"]) \
+                or arrays["indptr"][-1] != len(arrays["indices"]) or len(arrays["indices"]) != len(arrays["data"]):
+            raise ValueError(f"{col} incidence does not match row count")
+        incidences.append(CategoryIncidence.from_arrays(meta["vocabularies"][col], arrays))
+
+    df = pd.DataFrame(audio, columns=AUDIO_COLUMNS, copy=False)
+    for position, col in enumerate(META_COLUMNS):
+        df.insert(position, col, price if col == 'price' else pd.Series(table[col], dtype=object))
+    return (df, features, *incidences, _decode_watermark(meta))
+
+
+def load_latest_snapshot(root: str):
+    """
+    Последний целый снимок: (df, feature_matrix, genres, tags, moods, watermark)
+    или None. Массивы открываются через mmap; поврежденные снимки и снимки старого формата пропускаются
+    """
+    if not root:
+        return None
+    current = read_current(root)
+    candidates = ([current] if current else []) + [v for v in list_snapshots(root) if v != current]
+    for version in candidates:
+        try:
+            snapshot = _open_snapshot(os.path.join(root, version))
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Skipping catalog snapshot {version}: {e}")
+            continue
+        logger.info(f"Catalog snapshot {version} loaded: {len(snapshot[0])} beats")
+        return snapshot
+    return None
@@ -0,0 +1,218 @@
+import json
+import logging
+from typing import Any, Dict, List, Sequence, Tuple
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from app.services.mfcc_copy import (COPY_ERRORS, copy_mfcc_features, copy_supported, reset_connection,
+                                    select_mfcc_features)
+from app.core.incidence import CategoryIncidence, incidence_from_codes
+
+logger = logging.getLogger(__name__)
+
+# Выборка каталога через заранее агрегированные связи: каждая таблица связей агрегируется
+# один раз GROUP BY и присоединяется, вместо коррелированного подзапроса на каждый трек
+CATALOG_STREAM_QUERY = """
+    WITH bg AS (
+        SELECT beat_id, string_agg(genre_id::text, '||') AS genre_ids FROM beat_genres GROUP BY beat_id
+    ), bt AS (
+        SELECT beat_id, string_agg(tag_id::text, '||') AS tag_ids FROM beat_tags GROUP BY beat_id
+    ), bm AS (
+        SELECT beat_id, string_agg(mood_id::text, '||') AS mood_ids FROM beat_moods GROUP BY beat_id
+    ), ts AS (
+        SELECT beat_id, json_agg(json_build_object(
+            'id', id,
+            'name', name,
+            'time_start', time_start,
+            'time_end', time_end
+        )) AS timestamps
+        FROM timestamps GROUP BY beat_id
+    )
+    SELECT
+        b.id AS beat_id,
+        b.name AS file,
+        b.picture,
+        b.price,
+        b.url,
+        COALESCE(ts.timestamps, '[]') AS timestamps,
+        bg.genre_ids,
+        bt.tag_ids,
+        bm.mood_ids{audio_select}
+    FROM beats b
+    {audio_join}
+    LEFT JOIN bg ON bg.beat_id = b.id
+    LEFT JOIN bt ON bt.beat_id = b.id
+    LEFT JOIN bm ON bm.beat_id = b.id
+    LEFT JOIN ts ON ts.beat_id = b.id
+"""
+
+# Аудиофичи из mfccs; при чтении через двоичный COPY в выборку не входят
+AUDIO_SELECT = """,
+        mf.crm1, mf.crm2, mf.crm3, mf.crm4, mf.crm5, mf.crm6, mf.crm7, mf.crm8,
+        mf.crm9, mf.crm10, mf.crm11, mf.crm12,
+        mf.mlspc AS melspectrogram,
+        mf.spc AS spectral_centroid,
+        mf.mfcc1, mf.mfcc2, mf.mfcc3, mf.mfcc4, mf.mfcc5, mf.mfcc6, mf.mfcc7, mf.mfcc8,
+        mf.mfcc9, mf.mfcc10, mf.mfcc11, mf.mfcc12, mf.mfcc13, mf.mfcc14, mf.mfcc15,
+        mf.mfcc16, mf.mfcc17, mf.mfcc18, mf.mfcc19, mf.mfcc20, mf.mfcc21, mf.mfcc22,
+        mf.mfcc23, mf.mfcc24, mf.mfcc25, mf.mfcc26, mf.mfcc27, mf.mfcc28, mf.mfcc29,
+        mf.mfcc30, mf.mfcc31, mf.mfcc32, mf.mfcc33, mf.mfcc34, mf.mfcc35, mf.mfcc36,
+        mf.mfcc37, mf.mfcc38, mf.mfcc39, mf.mfcc40, mf.mfcc41, mf.mfcc42, mf.mfcc43,
+        mf.mfcc44, mf.mfcc45, mf.mfcc46, mf.mfcc47, mf.mfcc48, mf.mfcc49, mf.mfcc50"""
+AUDIO_JOIN = "LEFT JOIN mfccs mf ON b.id = mf.beat_id"
+
+META_COLUMNS = ['beat_id', 'file', 'picture', 'price', 'url', 'timestamps']
+CATEGORY_COLUMNS = ['genre_ids', 'tag_ids', 'mood_ids']
+# Аудиофичи в порядке колонок выборки
+AUDIO_COLUMNS = [f'crm{i}' for i in range(1, 13)] + ['melspectrogram', 'spectral_centroid'] + \
+                [f'mfcc{i}' for i in range(1, 51)]
+# Порядок колонок матрицы признаков (как в build_feature_blocks)
+FEATURE_COLUMNS = [f'crm{i}' for i in range(1, 13)] + [f'mfcc{i}' for i in range(1, 51)] + \
+                  ['melspectrogram', 'spectral_centroid']
+
+AUDIO_OFFSET = len(META_COLUMNS) + len(CATEGORY_COLUMNS)
+
+
+def split_ids(value: Any) -> List[str]:
+    return [] if not value else [item.strip() for item in value.split('||') if item.strip()]
+
+
+class IncidenceBuilder:
+    """Накопитель пар (строка, категория) для матрицы вхождений; словарь категорий растет по мере чтения"""
+    __slots__ = ("vocabulary", "rows", "codes")
+
+    def __init__(self):
+        self.vocabulary: Dict[str, int] = {}
+        self.rows: List[int] = []
+        self.codes: List[int] = []
+
+    def add(self, row: int, ids: Sequence[str]):
+        for name in ids:
+            self.rows.append(row)
+            self.codes.append(self.vocabulary.setdefault(name, len(self.vocabulary)))
+
+    def incidence(self, n_rows: int) -> CategoryIncidence:
+        """CSR-матрица вхождений; словарь в порядке первого появления, повторы в строке суммируются (как build_incidence)"""
+        row_indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(np.asarray(self.rows, dtype=np.int64), minlength=n_rows), out=row_indptr[1:])
+        return incidence_from_codes(list(self.vocabulary), row_indptr, np.asarray(self.codes, dtype=np.int32))
+
+
+def impute_mean_(matrix: np.ndarray) -> np.ndarray:
+    """
+    Замена NaN средним по колонке на месте, по одной колонке за раз.
+    Колонки без единого значения выбрасываются, как в SimpleImputer(strategy='mean')
+    """
+    empty = []
+    for col in range(matrix.shape[1]):
+        values = matrix[:, col]
+        missing = np.isnan(values)
+        if missing.all():
+            empty.append(col)
+        elif missing.any():
+            values[missing] = values[~missing].mean()
+    return np.delete(matrix, empty, axis=1) if empty else matrix
+
+
+class CatalogBuffers:
+    """
+    Предвыделенные массивы каталога, в которые по частям складываются строки выборки.
+    Емкость берется из количества треков; если во время чтения треков стало больше, массивы растут
+    """
+
+    def __init__(self, capacity: int):
+        capacity = max(capacity, 1)
+        self.size = 0
+        self.meta = {col: np.empty(capacity, dtype=object) for col in META_COLUMNS if col != 'price'}
+        self.price = np.empty(capacity, dtype=np.float64)
+        self.audio = np.empty((capacity, len(AUDIO_COLUMNS)), dtype=np.float64)
+        self.incidence = {col: IncidenceBuilder() for col in CATEGORY_COLUMNS}
+
+    def _reserve(self, needed: int):
+        capacity = len(self.price)
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2)
+        for col, values in self.meta.items():
+            self.meta[col] = np.resize(values, capacity)
+        self.price = np.resize(self.price, capacity)
+        self.audio = np.resize(self.audio, (capacity, len(AUDIO_COLUMNS)))
+
+    def add_chunk(self, rows: Sequence[Sequence[Any]]):
+        start, stop = self.size, self.size + len(rows)
+        self._reserve(stop)
+
+        # None из базы превращается в NaN при записи в float-массив
+        if rows and len(rows[0]) > AUDIO_OFFSET:
+            self.audio[start:stop] = [row[AUDIO_OFFSET:] for row in rows]
+        self.price[start:stop] = [np.nan if row[3] is None else float(row[3]) for row in rows]
+
+        meta = self.meta
+        for position, row in enumerate(rows, start):
+            timestamps = row[5]
+            meta['beat_id'][position] = row[0]
+            meta['file'][position] = row[1]
+            meta['picture'][position] = row[2]
+            meta['url'][position] = row[4]
+            meta['timestamps'][position] = json.loads(timestamps) if isinstance(timestamps, str) else timestamps
+            for col, value in zip(CATEGORY_COLUMNS, row[6:9]):
+                self.incidence[col].add(position, split_ids(value))
+        self.size = stop
+
+    def finish(self) -> Tuple[pd.DataFrame, np.ndarray, CategoryIncidence, CategoryIncidence, CategoryIncidence]:
+        """
+        (df, feature_matrix, genres, tags, moods) в формате load_data.
+        Категории треков хранятся только в матрицах вхождений, отдельных колонок списков в df нет
+        """
+        n = self.size
+        audio = self.audio[:n]
+        df = pd.DataFrame(audio, columns=AUDIO_COLUMNS, copy=False)
+        for position, col in enumerate(META_COLUMNS):
+            df.insert(position, col, self.price[:n] if col == 'price' else self.meta[col][:n])
+
+        order = [AUDIO_COLUMNS.index(col) for col in FEATURE_COLUMNS]
+        feature_matrix = impute_mean_(audio[:, order])
+        genres, tags, moods = (self.incidence[col].incidence(n) for col in CATEGORY_COLUMNS)
+        return df, feature_matrix, genres, tags, moods
+
+
+def match_copy_precision(conn, df: pd.DataFrame, copy_audio: bool) -> pd.DataFrame:
+    """
+    Аудиофичи выборки изменений в той же точности, что у полной загрузки: через двоичный COPY
+    они читаются в float32, и без такого же округления хэши содержимого строк поменялись бы
+    """
+    if copy_audio and copy_supported(conn) and not df.empty:
+        audio = df[AUDIO_COLUMNS].apply(pd.to_numeric, errors='coerce')
+        df[AUDIO_COLUMNS] = audio.to_numpy(dtype=np.float32).astype(np.float64)
+    return df
+
+
+def stream_catalog(conn, chunk_size: int, copy_audio: bool = False):
+    """
+    Читает каталог серверным курсором по chunk_size строк и складывает каждую часть
+    сразу в предвыделенные массивы: полная выборка в памяти целиком не материализуется.
+    copy_audio — аудиофичи читаются отдельно двоичным COPY таблицы mfccs (если драйвер умеет)
+    """
+    use_copy = copy_audio and copy_supported(conn)
+    query = CATALOG_STREAM_QUERY.format(audio_select="" if use_copy else AUDIO_SELECT,
+                                        audio_join="" if use_copy else AUDIO_JOIN)
+
+    capacity = conn.execute(text("SELECT count(*) FROM beats")).scalar() or 0
+    buffers = CatalogBuffers(capacity)
+    result = conn.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(text(query))
+    for rows in result.partitions(chunk_size):
+        buffers.add_chunk(rows)
+        logger.debug(f"Catalog rows streamed: {buffers.size}")
+
+    if use_copy:
+        beat_ids = buffers.meta['beat_id'][:buffers.size]
+        try:
+            audio = copy_mfcc_features(conn, beat_ids)
+        except COPY_ERRORS as e:
+            # Поток COPY не того формата или ошибка драйвера: каталог уже прочитан,
+            # после отката обычной выборкой перечитываются только аудиофичи
+            logger.warning(f"Binary COPY of mfcc features failed, selecting them instead: {e}")
+            reset_connection(conn)
+            audio = select_mfcc_features(conn, beat_ids, chunk_size)
+        buffers.audio[:buffers.size] = audio
+    return buffers.finish()
@@ -1,13 +1,18 @@
 import json
+from datetime import datetime, timedelta
 import os
+import re
 import pandas as pd
 import numpy as np
-from typing import List, Dict, Any, Tuple, Optional
+from typing import List, Any, Tuple, Optional
 import logging
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 from sklearn.impute import SimpleImputer
 import app.services as globals
+from app.config import Config
+from app.services.catalog_stream import CATEGORY_COLUMNS, FEATURE_COLUMNS, stream_catalog, match_copy_precision
+from app.core.incidence import CatalogMatrices, CategoryIncidence, build_incidence
 
 
 logging.basicConfig(
@@ -19,6 +24,53 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+# Денормализованная выборка каталога с коррелированными подзапросами; {where} — фильтр по beats b.
+# Используется для небольших выборок изменений, полная загрузка идет через stream_catalog
+CATALOG_QUERY = """
+    SELECT 
+        b.id AS beat_id,
+        b.name AS file,
+        b.picture,
+        b.price,
+        b.url,
+        COALESCE((
+            SELECT json_agg(json_build_object(
+                'id', t.id,
+                'name', t.name,
+                'time_start', t.time_start,
+                'time_end', t.time_end
+            ))
+            FROM timestamps t WHERE t.beat_id = b.id
+        ), '[]') AS timestamps,
+        (SELECT string_agg(bg.genre_id::text, '||') FROM beat_genres bg WHERE bg.beat_id = b.id) AS genre_ids,
+        (SELECT string_agg(bt.tag_id::text, '||') FROM beat_tags bt WHERE bt.beat_id = b.id) AS tag_ids,
+        (SELECT string_agg(bm.mood_id::text, '||') FROM beat_moods bm WHERE bm.beat_id = b.id) AS mood_ids,
+        mf.crm1, mf.crm2, mf.crm3, mf.crm4, mf.crm5, mf.crm6, mf.crm7, mf.crm8,
+        mf.crm9, mf.crm10, mf.crm11, mf.crm12,
+        mf.mlspc AS melspectrogram,
+        mf.spc AS spectral_centroid,
+        mf.mfcc1, mf.mfcc2, mf.mfcc3, mf.mfcc4, mf.mfcc5, mf.mfcc6, mf.mfcc7, mf.mfcc8,
+        mf.mfcc9, mf.mfcc10, mf.mfcc11, mf.mfcc12, mf.mfcc13, mf.mfcc14, mf.mfcc15,
+        mf.mfcc16, mf.mfcc17, mf.mfcc18, mf.mfcc19, mf.mfcc20, mf.mfcc21, mf.mfcc22,
+        mf.mfcc23, mf.mfcc24, mf.mfcc25, mf.mfcc26, mf.mfcc27, mf.mfcc28, mf.mfcc29,
+        mf.mfcc30, mf.mfcc31, mf.mfcc32, mf.mfcc33, mf.mfcc34, mf.mfcc35, mf.mfcc36,
+        mf.mfcc37, mf.mfcc38, mf.mfcc39, mf.mfcc40, mf.mfcc41, mf.mfcc42, mf.mfcc43,
+        mf.mfcc44, mf.mfcc45, mf.mfcc46, mf.mfcc47, mf.mfcc48, mf.mfcc49, mf.mfcc50
+    FROM beats b
+    LEFT JOIN mfccs mf ON b.id = mf.beat_id
+    {where}
+"""
+
+IDENTIFIER_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def watermark_column() -> str:
+    """Колонка beats, по которой отбираются изменения для инкрементального обновления"""
+    column = Config.CATALOG_WATERMARK_COLUMN
+    if not IDENTIFIER_RE.match(column):
+        raise ValueError(f"Invalid watermark column: {column!r}")
+    return column
+
 def get_db_engine():
     return create_engine(
         f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}"
@@ -49,12 +101,11 @@ def load_lookup_tables() -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]
         return None, None, None
 
 def load_data() -> Tuple[
-    Optional[pd.DataFrame],  # исходный DataFrame
-    Optional[List[Dict[str, Any]]],  # beats — список словарей
+    Optional[pd.DataFrame],  # исходный DataFrame (без колонок категорий: они в матрицах вхождений)
     Optional[np.ndarray],  # feature_matrix
-    Optional[pd.DataFrame],  # df_genres
-    Optional[pd.DataFrame],  # df_tags
-    Optional[pd.DataFrame]   # df_moods
+    Optional[CategoryIncidence],  # genres — CSR-матрица вхождений
+    Optional[CategoryIncidence],  # tags
+    Optional[CategoryIncidence]   # moods
 ]:
     try:
         logger.info("Starting data loading process...")
@@ -64,57 +115,25 @@ def load_data() -> Tuple[
             conn.execute(text("SELECT 1"))
             logger.info("Database connection established")
 
-            query = text("""
-                SELECT 
-                    b.id AS beat_id,
-                    b.name AS file,
-                    b.picture,
-                    b.price,
-                    b.url,
-                    COALESCE((
-                        SELECT json_agg(json_build_object(
-                            'id', t.id,
-                            'name', t.name,
-                            'time_start', t.time_start,
-                            'time_end', t.time_end
-                        ))
-                        FROM timestamps t WHERE t.beat_id = b.id
-                    ), '[]') AS timestamps,
-                    (SELECT string_agg(bg.genre_id::text, '||') FROM beat_genres bg WHERE bg.beat_id = b.id) AS genre_ids,
-                    (SELECT string_agg(bt.tag_id::text, '||') FROM beat_tags bt WHERE bt.beat_id = b.id) AS tag_ids,
-                    (SELECT string_agg(bm.mood_id::text, '||') FROM beat_moods bm WHERE bm.beat_id = b.id) AS mood_ids,
-                    mf.crm1, mf.crm2, mf.crm3, mf.crm4, mf.crm5, mf.crm6, mf.crm7, mf.crm8,
-                    mf.crm9, mf.crm10, mf.crm11, mf.crm12,
-                    mf.mlspc AS melspectrogram,
-                    mf.spc AS spectral_centroid,
-                    mf.mfcc1, mf.mfcc2, mf.mfcc3, mf.mfcc4, mf.mfcc5, mf.mfcc6, mf.mfcc7, mf.mfcc8,
-                    mf.mfcc9, mf.mfcc10, mf.mfcc11, mf.mfcc12, mf.mfcc13, mf.mfcc14, mf.mfcc15,
-                    mf.mfcc16, mf.mfcc17, mf.mfcc18, mf.mfcc19, mf.mfcc20, mf.mfcc21, mf.mfcc22,
-                    mf.mfcc23, mf.mfcc24, mf.mfcc25, mf.mfcc26, mf.mfcc27, mf.mfcc28, mf.mfcc29,
-                    mf.mfcc30, mf.mfcc31, mf.mfcc32, mf.mfcc33, mf.mfcc34, mf.mfcc35, mf.mfcc36,
-                    mf.mfcc37, mf.mfcc38, mf.mfcc39, mf.mfcc40, mf.mfcc41, mf.mfcc42, mf.mfcc43,
-                    mf.mfcc44, mf.mfcc45, mf.mfcc46, mf.mfcc47, mf.mfcc48, mf.mfcc49, mf.mfcc50
-                FROM beats b
-                LEFT JOIN mfccs mf ON b.id = mf.beat_id
-            """)
-            
-            df = pd.read_sql(query, conn)
+            df, feature_matrix, genres, tags, moods = stream_catalog(
+                conn, Config.CATALOG_CHUNK_SIZE, copy_audio=Config.MFCC_COPY)
             
             if df.empty:
                 logger.error("Query returned empty dataframe")
-                return None, None, None, None, None, None
-
-            # Обработка данных
-            beats, feature_matrix, df_genres, df_tags, df_moods = process_raw_data(df)
+                return None, None, None, None, None
             
-            logger.info(f"Data loaded successfully. Beats: {len(beats)}")
-            return df, beats, feature_matrix, df_genres, df_tags, df_moods
+            logger.info(f"Data loaded successfully. Beats: {len(df)}")
+            return df, feature_matrix, genres, tags, moods
             
     except Exception as e:
         logger.error(f"Data loading failed: {str(e)}", exc_info=True)
-        return None, None, None, None, None, None
+        return None, None, None, None, None
+
+def process_raw_data(df: pd.DataFrame) -> Tuple[np.ndarray, CategoryIncidence, CategoryIncidence, CategoryIncidence]:
+    return build_feature_blocks(normalize_raw_data(df))
 
-def process_raw_data(df: pd.DataFrame) -> Tuple[List[Dict[str, Any]], np.ndarray, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+def normalize_raw_data(df: pd.DataFrame) -> pd.DataFrame:
+    """Разбор сырых колонок выборки на месте: JSON таймкодов и списки id категорий"""
     # Обработка JSON
     df['timestamps'] = df['timestamps'].apply(
         lambda x: json.loads(x) if isinstance(x, str) else x
@@ -123,42 +142,131 @@ def process_raw_data(df: pd.DataFrame) -> Tuple[List[Dict[str, Any]], np.ndarray
     # Преобразование строк в списки
     for col in ['genre_ids', 'tag_ids', 'mood_ids']:
         df[col] = df[col].apply(lambda x: safe_str_split(x, '||'))
-    
-    # Создание списка треков
-    beats = []
-    for _, row in df.iterrows():
-        beats.append({
-            "beat_id": row['beat_id'],
-            "file": row['file'],
-            "picture": row['picture'],
-            "price": float(row['price']),
-            "url": row['url'],
-            "timestamps": row['timestamps'],
-            "genres": row['genre_ids'],
-            "tags": row['tag_ids'],
-            "moods": row['mood_ids'],
-            "audio_features": get_audio_features(row)
-        })
-    
-    # One-hot encoding
-    df_genres = pd.get_dummies(df['genre_ids'].explode()).groupby(level=0).sum()
-    df_tags = pd.get_dummies(df['tag_ids'].explode()).groupby(level=0).sum()
-    df_moods = pd.get_dummies(df['mood_ids'].explode()).groupby(level=0).sum()
-    
-    # Матрица mfcc фичей
+    return df
+
+def build_feature_blocks(df: pd.DataFrame) -> Tuple[np.ndarray, CategoryIncidence, CategoryIncidence, CategoryIncidence]:
+    """Матрица аудио-признаков и разреженные (CSR) матрицы вхождений категорий по уже разобранному df"""
+    # Матрицы вхождений вместо плотного one-hot: ширина по числу категорий, в памяти только ненулевые
+    genres = build_incidence(df['genre_ids'].tolist())
+    tags = build_incidence(df['tag_ids'].tolist())
+    moods = build_incidence(df['mood_ids'].tolist())
+    return build_audio_features(df), genres, tags, moods
+
+def build_audio_features(df: pd.DataFrame) -> np.ndarray:
+    """Матрица mfcc фичей с заменой пропусков средним по колонке"""
     audio_cols = [f'crm{i}' for i in range(1, 13)] + \
                 [f'mfcc{i}' for i in range(1, 51)] + \
                 ['melspectrogram', 'spectral_centroid']
     
-    feature_matrix = SimpleImputer(strategy='mean').fit_transform(df[audio_cols].values)
-    
-    return beats, feature_matrix, df_genres, df_tags, df_moods
-
-def get_audio_features(row) -> Dict[str, Any]:
-    """Извлекаем аудио-фичи из строки DataFrame"""
-    return {
-        "crm": [row[f'crm{i}'] for i in range(1, 13)],
-        "melspectrogram": row['melspectrogram'],
-        "spectral_centroid": row['spectral_centroid'],
-        "mfcc": [row[f'mfcc{i}'] for i in range(1, 51)]
-    }
\ No newline at end of file
+    return SimpleImputer(strategy='mean').fit_transform(df[audio_cols].values)
+
+def load_watermark() -> Optional[Any]:
+    """Текущее значение watermark-колонки каталога (None, если недоступно)"""
+    try:
+        with get_db_engine().connect() as conn:
+            return conn.execute(text(f"SELECT max(b.{watermark_column()}) FROM beats b")).scalar()
+    except Exception as e:
+        logger.warning(f"Catalog watermark is unavailable, incremental refresh disabled: {str(e)}")
+        return None
+
+def load_catalog_delta(since: Any) -> Optional[Tuple[pd.DataFrame, List[str], Any]]:
+    """
+    Изменения каталога после watermark since: (разобранные строки добавленных и измененных
+    треков, id всех треков в базе для поиска удаленных, новый watermark).
+    Предполагается, что watermark-колонка beats обновляется и при правке связанных
+    таблиц (mfccs, beat_genres, beat_tags, beat_moods, timestamps)
+    """
+    try:
+        column = watermark_column()
+        with get_db_engine().connect() as conn:
+            # Сначала фиксируем верхнюю границу, чтобы изменения во время выборки попали в следующий проход
+            until = conn.execute(text(f"SELECT max(b.{column}) FROM beats b")).scalar()
+            alive_ids = [str(x) for x in conn.execute(text("SELECT b.id FROM beats b")).scalars()]
+            if until is None:
+                return pd.DataFrame(), alive_ids, since
+            # Окно перекрытия перечитывается каждый проход, поэтому равенство until и since не повод пропустить выборку
+            query = text(CATALOG_QUERY.format(where=f"WHERE b.{column} > :since AND b.{column} <= :until"))
+            changed = pd.read_sql(query, conn, params={"since": overlap_start(since), "until": until})
+            return match_copy_precision(conn, normalize_raw_data(changed), Config.MFCC_COPY), alive_ids, until
+    except Exception as e:
+        logger.error(f"Catalog delta loading failed: {str(e)}", exc_info=True)
+        return None
+
+def overlap_start(since: Any) -> Any:
+    """
+    Нижняя граница выборки изменений с окном перекрытия: транзакция, закоммиченная после прошлого
+    прохода, может нести watermark меньше уже прочитанного максимума. Окно задается в секундах
+    и применяется к колонкам-временам; числовые watermark-колонки читаются без перекрытия
+    """
+    if isinstance(since, datetime) and Config.CATALOG_REFRESH_OVERLAP_SECONDS > 0:
+        return since - timedelta(seconds=Config.CATALOG_REFRESH_OVERLAP_SECONDS)
+    return since
+
+def drop_unchanged_rows(df: pd.DataFrame, matrices: CatalogMatrices, changed: pd.DataFrame) -> pd.DataFrame:
+    """
+    Убирает из изменений строки, совпадающие с уже загруженными: окно перекрытия перечитывает
+    последние правки, и без этого каждый проход пересобирал бы каталог без реальных изменений.
+    Категории загруженных треков берутся из матриц вхождений каталога
+    """
+    if changed.empty or df.empty:
+        return changed
+    positions = pd.Series(np.arange(len(df)), index=df['beat_id'].astype(str))
+    positions = positions[~positions.index.duplicated()]
+    known = changed['beat_id'].astype(str).isin(positions.index).to_numpy()
+    if not known.any():
+        return changed
+    rows = positions[changed['beat_id'].astype(str)[known]].to_numpy()
+    same = np.zeros(len(changed), dtype=bool)
+    same[known] = _row_hashes(df.iloc[rows]) == _row_hashes(changed[known][df.columns])
+    for col, incidence in zip(CATEGORY_COLUMNS, (matrices.genres, matrices.tags, matrices.moods)):
+        lists = changed[col][known].tolist()
+        same[known] &= [incidence[row] == ids for row, ids in zip(rows, lists)]
+    return changed[~same].reset_index(drop=True)
+
+def _row_hashes(frame: pd.DataFrame) -> np.ndarray:
+    # Колонки со списками (timestamps) не хэшируются pandas напрямую, поэтому сравниваем строковый вид
+    return pd.util.hash_pandas_object(frame.astype(str), index=False).to_numpy()
+
+def merge_catalog_delta(df: pd.DataFrame, changed: pd.DataFrame,
+                        alive_ids: List[str]) -> Tuple[pd.DataFrame, np.ndarray, pd.DataFrame]:
+    """
+    Накладывает изменения на разобранный каталог: строки удаленных треков выкидываются (сжатие),
+    измененные заменяются на своих местах, добавленные дописываются в конец.
+    Возвращает (новый каталог, source, изменения): source[row] — строка прежнего каталога, из которой
+    взята строка row, или -1 для измененных и добавленных строк; изменения — строки changed в порядке
+    строк с source == -1 (по их спискам категорий дописываются матрицы вхождений)
+    """
+    beat_ids = df['beat_id'].astype(str)
+    take = np.flatnonzero(beat_ids.isin(set(alive_ids)).to_numpy())
+    combined = df
+    if not changed.empty:
+        new_rows = pd.Series(np.arange(len(take)), index=beat_ids.to_numpy()[take])
+        new_rows = new_rows[~new_rows.index.duplicated()]
+        targets = new_rows.reindex(changed['beat_id'].astype(str).to_numpy()).to_numpy()
+        in_place = ~np.isnan(targets)
+        take[targets[in_place].astype(np.int64)] = len(df) + np.flatnonzero(in_place)
+        take = np.concatenate([take, len(df) + np.flatnonzero(~in_place)])
+        combined = pd.concat([df, changed[df.columns]], ignore_index=True)
+    merged = combined.take(take).reset_index(drop=True)
+    fresh = take[take >= len(df)] - len(df)
+    return merged, np.where(take < len(df), take, -1), changed.iloc[fresh].reset_index(drop=True)
+
+def patch_audio_features(df: pd.DataFrame, source: np.ndarray, feature_matrix: np.ndarray) -> Optional[np.ndarray]:
+    """
+    Матрица mfcc фичей после merge_catalog_delta без повторного импутинга всего каталога: строки
+    прежнего каталога копируются, пропуски в строках с source == -1 заполняются средними текущей матрицы.
+    None, если матрица не совпадает по колонкам с FEATURE_COLUMNS (нужна полная сборка)
+    """
+    if feature_matrix.ndim != 2 or feature_matrix.shape[1] != len(FEATURE_COLUMNS):
+        return None
+    fresh = np.flatnonzero(source < 0)
+    audio = df[FEATURE_COLUMNS].iloc[fresh].to_numpy(dtype=np.float64, copy=True)
+    missing = np.isnan(audio)
+    if missing.any():
+        audio[missing] = feature_matrix.mean(axis=0)[np.nonzero(missing)[1]]
+
+    patched = np.empty((len(source), feature_matrix.shape[1]), dtype=feature_matrix.dtype)
+    kept = source >= 0
+    patched[kept] = feature_matrix[source[kept]]
+    patched[fresh] = audio
+    return patched
@@ -1,15 +1,21 @@
 import pandas as pd
-from typing import Optional
+from typing import Any, Optional
 import numpy as np
+from app.core.catalog_index import CatalogIndex
+from app.core.incidence import CategoryIncidence
 
 
 
 dataset_df: Optional[pd.DataFrame] = None
 df_feature_matrix: Optional[np.ndarray] = None
+catalog_index: Optional[CatalogIndex] = None
+catalog_watermark: Optional[Any] = None  # Значение watermark-колонки, до которого загружен каталог
+catalog_generation: int = 0  # Поколение снимка, к которому подключен процесс (режим общего каталога)
 
-df_genres: Optional[pd.DataFrame] = None
-df_moods: Optional[pd.DataFrame] = None
-df_tags: Optional[pd.DataFrame] = None
+# Разреженные (CSR) матрицы вхождений категорий, общие с catalog_index.matrices
+df_genres: Optional[CategoryIncidence] = None
+df_moods: Optional[CategoryIncidence] = None
+df_tags: Optional[CategoryIncidence] = None
 
 df_genres_lookup: Optional[pd.DataFrame] = None
 df_tags_lookup: Optional[pd.DataFrame] = None
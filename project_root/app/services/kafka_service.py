@@ -1,6 +1,7 @@
 import json
 import time
 import logging
+from typing import Optional
 from kafka import KafkaProducer, KafkaConsumer
 from app.config import Config
 from app.core.storage import RecommendationStorage
@@ -18,7 +19,8 @@ class KafkaClient:
 
         self.producer = KafkaProducer(
             bootstrap_servers=Config.KAFKA_BOOTSTRAP_SERVERS,
-            value_serializer=lambda x: json.dumps(x).encode('utf-8'),
+            # Готовые байты (заранее закодированные рекомендации) уходят как есть
+            value_serializer=lambda x: x if isinstance(x, bytes) else json.dumps(x).encode('utf-8'),
             retries=3,
             acks='all'
         )
@@ -63,6 +65,25 @@ class KafkaClient:
         except Exception as e:
             logger.error(f"[KafkaProducer] Failed to send recommendation for user_id={user_id}: {str(e)}")
 
+    def send_encoded_recommendation(self, user_id: str, beat_payload: bytes, beat_id: str,
+                                    timestamp: Optional[str] = None):
+        """
+        Отправка рекомендации по заранее сериализованному треку (CatalogIndex.payload):
+        конверт с user_id и timestamp дописывается к готовым байтам без повторного кодирования трека
+        """
+        try:
+            if timestamp is not None:
+                beat_payload = beat_payload[:-1] + b', "timestamp": ' + json.dumps(timestamp).encode('utf-8') + b'}'
+            payload = b'{"user_id": ' + json.dumps(user_id).encode('utf-8') + b', "beat": ' + beat_payload + b'}'
+            self.producer.send(
+                topic=Config.REC_BEATS_TOPIC,
+                value=payload,
+                key=user_id.encode('utf-8')
+            )
+            logger.info(f"[KafkaProducer] Queued recommendation for user_id={user_id}, beat_id={beat_id}")
+        except Exception as e:
+            logger.error(f"[KafkaProducer] Failed to send recommendation for user_id={user_id}: {str(e)}")
+
     def flush_producer(self):
         try:
             logger.debug("[KafkaProducer] Flushing producer buffer")
@@ -126,6 +147,64 @@ def consume_recommendations():
             except Exception as ce:
                 logger.error(f"[KafkaConsumer] Commit failed after exception: {str(ce)}")
 
+def _send_refill(user_id: str, recommendations, count: int, catalog):
+    for rec in recommendations[:count]:
+        beat_id = rec[0]
+        full_beat = catalog.beat(beat_id)
+        if not full_beat:
+            logger.warning(f"[KafkaConsumer] Beat id {beat_id} not found in catalog")
+            continue
+        kafka_client.send_encoded_recommendation(user_id, full_beat.payload(with_categories=False), beat_id)
+
+
+def _process_refill_batch(messages):
+    """Пользователи с лайками скорятся одним пакетом, остальные — по жанрам по отдельности"""
+    by_likes = {}
+    by_genres = {}
+    counts = {}
+
+    for msg in messages:
+        logger.debug(f"[KafkaConsumer] Received refill message: {msg.value}")
+        data = msg.value
+        user_id = data.get("user_id")
+        if not user_id:
+            logger.warning("[KafkaConsumer] Refill message missing user_id")
+            continue
+
+        counts[user_id] = max(counts.get(user_id, 0), data.get("count", Config.REFILL_COUNT))
+        logger.info(f"[KafkaConsumer] Processing refill request for user_id={user_id}, count={counts[user_id]}")
+
+        liked_ids = storage.user_likes.get(user_id, [56, 70, 82])
+        if liked_ids:
+            by_likes[user_id] = liked_ids
+        else:
+            genres = storage.user_genres.get(user_id, [])
+            if not genres:
+                logger.warning(f"[KafkaConsumer] No genres found for user_id={user_id}, skipping refill")
+                continue
+            by_genres[user_id] = genres
+
+    recommendations = {}
+    if by_likes:
+        batch_count = max(counts[user_id] for user_id in by_likes)
+        recommendations.update(recommendation_engine.generate_recommendations_batch(by_likes, batch_count))
+    for user_id, genres in by_genres.items():
+        try:
+            recommendations[user_id] = recommendation_engine.generate_recommendations_by_genres(genres)
+            logger.info(f"[Engine] Recommendations: {recommendations[user_id]}")
+        except Exception as e:
+            logger.error(f"[KafkaConsumer] Error generating refill for user_id={user_id}: {str(e)}")
+
+    for user_id, recs in recommendations.items():
+        try:
+            _send_refill(user_id, recs, counts[user_id], recommendation_engine.catalog)
+            logger.info(f"[KafkaConsumer] Completed refill for user_id={user_id}")
+        except Exception as e:
+            logger.error(f"[KafkaConsumer] Error sending refill for user_id={user_id}: {str(e)}")
+
+    kafka_client.flush_producer()
+
+
 def consume_refill_requests():
     global kafka_client, recommendation_engine
     if not kafka_client:
@@ -133,63 +212,21 @@ def consume_refill_requests():
     if not recommendation_engine:
         recommendation_engine = RecommendationEngine()
 
-    beats_map = {beat['id']: beat for beat in recommendation_engine.beats}
+    while True:
+        # Забираем пачку refill-запросов и скорим их вместе
+        batch = kafka_client.refill_consumer.poll(
+            timeout_ms=Config.REFILL_POLL_TIMEOUT_MS,
+            max_records=Config.REFILL_BATCH_SIZE
+        )
+        messages = [msg for records in batch.values() for msg in records]
+        if not messages:
+            continue
 
-    for msg in kafka_client.refill_consumer:
         try:
-            logger.debug(f"[KafkaConsumer] Received refill message: {msg.value}")
-            data = msg.value
-            user_id = data.get("user_id")
-            count = data.get("count", Config.REFILL_COUNT)
-
-            if not user_id:
-                logger.warning("[KafkaConsumer] Refill message missing user_id")
-                kafka_client.refill_consumer.commit()
-                continue
-
-            logger.info(f"[KafkaConsumer] Processing refill request for user_id={user_id}, count={count}")
-
-            liked_ids = storage.user_likes.get(user_id, [56, 70, 82])
-            if liked_ids:
-                recommendations = recommendation_engine.generate_recommendations_by_likes(liked_ids, count)
-            else:
-                genres = storage.user_genres.get(user_id, [])
-                if not genres:
-                    logger.warning(f"[KafkaConsumer] No genres found for user_id={user_id}, skipping refill")
-                    kafka_client.refill_consumer.commit()
-                    continue
-                recommendations = recommendation_engine.generate_recommendations_by_genres(genres)
-                logger.info(f"[Engine] Recommendations: {recommendations}")
-
-            for rec in recommendations[:count]:
-                beat_id = rec[0]
-                full_beat = beats_map.get(beat_id)
-                if not full_beat:
-                    logger.warning(f"[KafkaConsumer] Beat id {beat_id} not found in engine.beats")
-                    continue
-
-                timestamps = []
-                if len(rec) > 6:
-                    try:
-                        timestamps = json.loads(rec[6])
-                    except Exception as e:
-                        logger.error(f"[KafkaConsumer] Failed to parse timestamps for beat_id={beat_id}: {e}")
-
-                beat = {
-                    **full_beat, # распаковка словаря в Python
-                    # "timestamps": timestamps
-                }
-                for field in ["genres", "tags", "moods"]:
-                    beat.pop(field, None)
-
-                kafka_client.send_recommendation(user_id, beat)
-
-            kafka_client.flush_producer()
-            kafka_client.refill_consumer.commit()
-            logger.info(f"[KafkaConsumer] Completed refill for user_id={user_id}")
+            _process_refill_batch(messages)
         except Exception as e:
-            logger.error(f"[KafkaConsumer] Error processing refill message: {str(e)}")
-            try:
-                kafka_client.refill_consumer.commit()
-            except Exception as ce:
-                logger.error(f"[KafkaConsumer] Commit failed after exception: {str(ce)}")
+            logger.error(f"[KafkaConsumer] Error processing refill batch: {str(e)}")
+        try:
+            kafka_client.refill_consumer.commit()
+        except Exception as ce:
+            logger.error(f"[KafkaConsumer] Commit failed after refill batch: {str(ce)}")
@@ -1,5 +1,14 @@
-from app.services.data_loader import load_data
+from app.services.data_loader import (load_data, load_watermark, load_catalog_delta,
+                                      merge_catalog_delta, drop_unchanged_rows, build_audio_features,
+                                      patch_audio_features)
+from app.config import Config
+from app.services.catalog_snapshot import write_snapshot, load_latest_snapshot, read_generation
+from app.services.catalog_leader import CatalogLeader
 import app.services.globals as globals
+from app.core.catalog_index import CatalogIndex, build_catalog_index, patch_catalog_index
+from app.core.incidence import CatalogMatrices, patch_incidence
+from app.services.catalog_stream import CATEGORY_COLUMNS
+from typing import Callable, List, Optional
 import pandas as pd
 import logging
 from threading import Lock
@@ -9,23 +18,210 @@ from datetime import datetime
 
 logger = logging.getLogger(__name__)
 update_lock = Lock()
-def update_dataset() -> bool:
-    try:
-        df, features, genres, moods, tags = load_data()
+# Полная перезагрузка и инкрементальное обновление не выполняются одновременно
+reload_lock = Lock()
+update_listeners: List[Callable[[CatalogIndex], None]] = []
+# Снимки пишутся в фоне по одному
+snapshot_lock = Lock()
+# Снимки после инкрементальных обновлений пишутся не чаще SNAPSHOT_MIN_INTERVAL_SECONDS:
+# время последней записи (time.monotonic) и признак отложенного снимка
+last_snapshot_at = None
+snapshot_pending = False
+# В режиме общего каталога базу грузит только один процесс, остальные подключаются к его снимкам
+catalog_leader = CatalogLeader(Config.SNAPSHOT_DIR) if Config.CATALOG_SHARED and Config.SNAPSHOT_DIR else None
+if Config.CATALOG_SHARED and not Config.SNAPSHOT_DIR:
+    logger.warning("CATALOG_SHARED requires SNAPSHOT_DIR, every worker will load the catalog itself")
+
+
+def owns_catalog() -> bool:
+    """Процесс сам грузит каталог из базы: вне режима общего каталога или если он загрузчик"""
+    return catalog_leader is None or catalog_leader.acquire()
+
+
+def add_update_listener(listener: Callable[[CatalogIndex], None]):
+    """Регистрирует обработчик, который вызывается в фоне с новым индексом после каждого обновления"""
+    update_listeners.append(listener)
+
+
+def publish_dataset(df: pd.DataFrame, features, genres, tags, moods, watermark=None,
+                    snapshot: bool = True, index: Optional[CatalogIndex] = None) -> CatalogIndex:
+    """
+    Строит индекс и подменяет данные каталога, затем оповещает обработчиков обновления.
+    snapshot — в фоне записать снимок датасета для быстрого старта (если задан SNAPSHOT_DIR);
+    index — уже собранный по df индекс (инкрементальное обновление), иначе строится заново
+    """
+    if index is None:
+        index = build_catalog_index(df, CatalogMatrices(genres, tags, moods))
 
+    # Подменяем данные и индекс одним блоком, чтобы читатели не видели их вперемешку
+    with update_lock:
         globals.dataset_df = df
         globals.df_feature_matrix = features
         globals.df_genres = genres
         globals.df_moods = moods
         globals.df_tags = tags
+        globals.catalog_index = index
+        globals.catalog_watermark = watermark
 
-        logger.info(f"Dataset updated. Records: {len(df)}")
+    for listener in update_listeners:
+        threading.Thread(target=listener, args=(index,), daemon=True).start()
+    if snapshot:
+        _schedule_snapshot(df, features, index.matrices, watermark)
+    return index
+
+
+def _snapshot_due() -> bool:
+    return last_snapshot_at is None or time.monotonic() - last_snapshot_at >= Config.SNAPSHOT_MIN_INTERVAL_SECONDS
+
+
+def _schedule_snapshot(df, features, matrices, watermark):
+    """В фоне пишет снимок датасета; снимки пишет только загрузчик общего каталога (или любой процесс вне этого режима)"""
+    global last_snapshot_at, snapshot_pending
+    if not Config.SNAPSHOT_DIR or (catalog_leader is not None and not catalog_leader.is_leader):
+        return
+    last_snapshot_at = time.monotonic()
+    snapshot_pending = False
+    threading.Thread(target=_save_snapshot, args=(df, features, matrices, watermark), daemon=True).start()
+
+
+def _save_snapshot(df: pd.DataFrame, features, matrices: CatalogMatrices, watermark):
+    try:
+        with snapshot_lock:
+            write_snapshot(Config.SNAPSHOT_DIR, df, features, matrices, watermark, keep=Config.SNAPSHOT_KEEP)
+    except Exception as e:
+        logger.error(f"Failed to write dataset snapshot: {e}")
+
+
+def restore_snapshot() -> bool:
+    """Поднимает датасет из последнего снимка на диске (без обращения к базе)"""
+    if not Config.SNAPSHOT_DIR:
+        return False
+    try:
+        generation = read_generation(Config.SNAPSHOT_DIR)
+        snapshot = load_latest_snapshot(Config.SNAPSHOT_DIR)
+        if snapshot is None:
+            return False
+        df, features, genres, tags, moods, watermark = snapshot
+        with reload_lock:
+            publish_dataset(df, features, genres, tags, moods, watermark, snapshot=False)
+            globals.catalog_generation = generation
+        logger.info(f"Dataset restored from snapshot. Records: {len(df)}, generation: {generation}")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to restore dataset snapshot: {e}")
+        return False
+
+
+def attach_snapshot() -> bool:
+    """Подключается к последнему снимку загрузчика, если его поколение сменилось"""
+    if globals.dataset_df is not None and read_generation(Config.SNAPSHOT_DIR) == globals.catalog_generation:
         return True
+    return restore_snapshot()
+
+
+def wait_for_shared_catalog() -> bool:
+    """
+    Старт воркера общего каталога: ждет первый снимок загрузчика не дольше CATALOG_ATTACH_TIMEOUT_SECONDS.
+    На каждой итерации процесс пробует сам стать загрузчиком: прежний мог упасть, не записав снимок.
+    True — подключился к снимку; False — нужно грузить из базы самому (режим выключен,
+    процесс стал загрузчиком или загрузчик не записал снимок вовремя)
+    """
+    if catalog_leader is None:
+        return False
+    deadline = time.monotonic() + Config.CATALOG_ATTACH_TIMEOUT_SECONDS
+    while not owns_catalog():
+        if attach_snapshot():
+            return True
+        if time.monotonic() >= deadline:
+            logger.warning("No catalog snapshot from the loader in time, loading from the database")
+            return False
+        time.sleep(Config.CATALOG_ATTACH_POLL_SECONDS)
+    return False
+
+
+def catch_up_dataset() -> bool:
+    """
+    Догоняет базу после старта из снимка: изменения после watermark снимка,
+    если включено инкрементальное обновление, иначе полная перезагрузка
+    """
+    if Config.CATALOG_REFRESH_MINUTES > 0 and globals.catalog_watermark is not None:
+        if refresh_dataset():
+            return True
+    return update_dataset()
+
+
+def update_dataset() -> bool:
+    if not owns_catalog():
+        return attach_snapshot()
+    try:
+        with reload_lock:
+            # watermark читаем до выборки: изменения во время загрузки подхватит следующий инкрементальный проход
+            watermark = load_watermark() if Config.CATALOG_REFRESH_MINUTES > 0 else None
+            df, features, genres, tags, moods = load_data()
+            publish_dataset(df, features, genres, tags, moods, watermark)
+
+            logger.info(f"Dataset updated. Records: {len(df)}")
+            return True
 
     except Exception as e:
         logger.error(f"Failed to update dataset: {e}")
         return False
 
+
+def refresh_dataset() -> bool:
+    """
+    Инкрементальное обновление: из базы читаются только треки, измененные после watermark,
+    и список id для поиска удаленных. Измененные строки заменяются на своих местах, новые дописываются
+    в конец; в матрице признаков, матрицах вхождений и индексе разбираются только они, остальные строки
+    копируются. Новые категории дописываются в конец словарей, а пустые колонки и точные средние
+    для импутинга восстанавливает ночная полная перезагрузка (update_dataset)
+    """
+    global snapshot_pending
+    if not owns_catalog():
+        return attach_snapshot()
+    try:
+        with reload_lock:
+            since = globals.catalog_watermark
+            current_df, current_index = globals.dataset_df, globals.catalog_index
+            if since is None or current_df is None or current_index is None:
+                return False
+
+            delta = load_catalog_delta(since)
+            if delta is None:
+                return False
+            changed, alive_ids, watermark = delta
+            changed = drop_unchanged_rows(current_df, current_index.matrices, changed)
+
+            deleted = len(current_df) - int(current_df['beat_id'].astype(str).isin(set(alive_ids)).sum())
+            if changed.empty and not deleted:
+                globals.catalog_watermark = watermark
+                # Отложенный снимок прошлых изменений дописывается, когда подошел интервал
+                if snapshot_pending and _snapshot_due():
+                    _schedule_snapshot(current_df, globals.df_feature_matrix, current_index.matrices, watermark)
+                return True
+
+            df, source, fresh = merge_catalog_delta(current_df, changed, alive_ids)
+            current = current_index.matrices
+            matrices = CatalogMatrices(*(
+                patch_incidence(incidence, source, fresh[col].tolist())
+                for col, incidence in zip(CATEGORY_COLUMNS, (current.genres, current.tags, current.moods))
+            ))
+            features = patch_audio_features(df, source, globals.df_feature_matrix)
+            if features is None:
+                features = build_audio_features(df)
+            index = patch_catalog_index(current_index, df, source, matrices)
+            due = _snapshot_due()
+            publish_dataset(df, features, matrices.genres, matrices.tags, matrices.moods, watermark,
+                            snapshot=due, index=index)
+            snapshot_pending = not due
+
+            logger.info(f"Dataset refreshed. Changed: {len(changed)}, deleted: {deleted}, records: {len(df)}")
+            return True
+
+    except Exception as e:
+        logger.error(f"Failed to refresh dataset: {e}")
+        return False
+
 def run_nightly_update():
     def scheduler():
         while True:
@@ -36,4 +232,32 @@ def run_nightly_update():
             time.sleep(30)
 
     thread = threading.Thread(target=scheduler, daemon=True)
-    thread.start()
\ No newline at end of file
+    thread.start()
+
+
+def run_incremental_refresh():
+    if Config.CATALOG_REFRESH_MINUTES <= 0:
+        return
+
+    def scheduler():
+        while True:
+            time.sleep(Config.CATALOG_REFRESH_MINUTES * 60)
+            refresh_dataset()
+
+    thread = threading.Thread(target=scheduler, daemon=True)
+    thread.start()
+
+
+def run_catalog_watcher():
+    """В режиме общего каталога воркеры следят за поколением снимков и переподключаются к новым"""
+    if catalog_leader is None:
+        return
+
+    def watcher():
+        while True:
+            time.sleep(Config.CATALOG_ATTACH_POLL_SECONDS)
+            if not owns_catalog():
+                attach_snapshot()
+
+    thread = threading.Thread(target=watcher, daemon=True)
+    thread.start()
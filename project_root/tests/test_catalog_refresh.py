@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+from app.core.catalog_index import build_catalog_index, patch_catalog_index
+from app.core.incidence import CatalogMatrices, patch_incidence
+from app.services.catalog_stream import CATEGORY_COLUMNS, FEATURE_COLUMNS, META_COLUMNS
+from app.services.data_loader import merge_catalog_delta, patch_audio_features
+
+GENRES = [["1", "2", "1"], [], ["3"], ["2", "3"]]
+TAGS = [["5"], ["5", "6"], [], []]
+MOODS = [[], ["7"], ["7", "7"], ["8"]]
+
+
+def frame(ids, genres, tags, moods, seed):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.standard_normal((len(ids), len(FEATURE_COLUMNS))), columns=FEATURE_COLUMNS)
+    meta = {
+        "beat_id": ids,
+        "file": [f"file {beat_id}" for beat_id in ids],
+        "picture": [f"p-{beat_id}" for beat_id in ids],
+        "price": np.arange(len(ids), dtype=np.float64) + seed,
+        "url": [None] * len(ids),
+        "timestamps": [[{"id": seed, "name": beat_id}] for beat_id in ids],
+    }
+    for position, col in enumerate(META_COLUMNS):
+        df.insert(position, col, meta[col])
+    return df, (genres, tags, moods)
+
+
+def test_refresh_patches_changed_rows_in_place():
+    ids = [f"beat-{row}" for row in range(len(GENRES))]
+    current, lists = frame(ids, GENRES, TAGS, MOODS, seed=0)
+    matrices = CatalogMatrices.from_rows(*lists)
+    index = build_catalog_index(current, matrices)
+    features = current[FEATURE_COLUMNS].to_numpy()
+
+    # beat-1 изменен (новая категория), beat-2 удален, beat-9 добавлен
+    changed, changed_lists = frame(["beat-9", "beat-1"], [["4"], ["9", "1"]], [[], ["6"]], [["8"], []], seed=1)
+    changed.loc[0, "mfcc3"] = np.nan
+    for col, values in zip(CATEGORY_COLUMNS, changed_lists):
+        changed[col] = values
+    df, source, fresh = merge_catalog_delta(current, changed, ["beat-0", "beat-1", "beat-3", "beat-9"])
+
+    assert df["beat_id"].tolist() == ["beat-0", "beat-1", "beat-3", "beat-9"]
+    np.testing.assert_array_equal(source, [0, -1, 3, -1])
+    assert fresh["beat_id"].tolist() == ["beat-1", "beat-9"]
+
+    expected = (
+        [GENRES[0], ["9", "1"], GENRES[3], ["4"]],
+        [TAGS[0], ["6"], TAGS[3], []],
+        [MOODS[0], [], MOODS[3], ["8"]],
+    )
+    patched = CatalogMatrices(*(
+        patch_incidence(incidence, source, fresh[col].tolist())
+        for col, incidence in zip(CATEGORY_COLUMNS, (matrices.genres, matrices.tags, matrices.moods))
+    ))
+    for incidence, rows in zip((patched.genres, patched.tags, patched.moods), expected):
+        assert [incidence[row] for row in range(len(df))] == rows
+        rebuilt = CatalogMatrices.from_rows(rows, [], []).genres
+        # Словарь патча дополнен новыми категориями, поэтому сравниваем по названиям колонок
+        order = [incidence.codes[name] for name in rebuilt.vocabulary]
+        assert (incidence.matrix[:, order] != rebuilt.matrix).nnz == 0
+        np.testing.assert_array_equal(incidence.row_lengths, rebuilt.row_lengths)
+
+    patched_features = patch_audio_features(df, source, features)
+    np.testing.assert_array_equal(patched_features[[0, 2]], features[[0, 3]])
+    assert patched_features[3, FEATURE_COLUMNS.index("mfcc3")] == features[:, FEATURE_COLUMNS.index("mfcc3")].mean()
+    assert not np.isnan(patched_features).any()
+    assert patch_audio_features(df, source, features[:, :-1]) is None
+
+    patched_index = patch_catalog_index(index, df, source, patched)
+    full_index = build_catalog_index(df, patched)
+    assert patched_index.row_of == full_index.row_of
+    for name in ("beat_ids", "titles", "pictures", "urls", "prices", "timestamps"):
+        assert getattr(patched_index, name).tolist() == getattr(full_index, name).tolist()
+    assert patched_index.matrices is patched
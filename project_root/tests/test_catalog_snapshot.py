@@ -0,0 +1,54 @@
+import mmap
+import numpy as np
+import pandas as pd
+from app.core.incidence import CatalogMatrices
+from app.services.catalog_snapshot import load_latest_snapshot, write_snapshot
+from app.services.catalog_stream import AUDIO_COLUMNS, META_COLUMNS
+
+GENRES = [["1", "2", "1"], [], ["3"], ["2", "3"]]
+TAGS = [["5"], ["5", "6"], [], []]
+MOODS = [[], ["7"], ["7", "7"], ["8"]]
+
+
+def mmapped(array) -> bool:
+    while array is not None:
+        if isinstance(array, (np.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, "base", None)
+    return False
+
+
+def catalog():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.standard_normal((len(GENRES), len(AUDIO_COLUMNS))), columns=AUDIO_COLUMNS)
+    meta = {
+        "beat_id": [f"beat-{row}" for row in range(len(GENRES))],
+        "file": [f"file {row}" for row in range(len(GENRES))],
+        "picture": [None, "p1", "p2", None],
+        "price": [1.0, np.nan, 3.5, 0.0],
+        "url": ["u0", "u1", None, "u3"],
+        "timestamps": [[], [{"id": 1, "name": "drop"}], [], []],
+    }
+    for position, col in enumerate(META_COLUMNS):
+        df.insert(position, col, meta[col])
+    return df, df[AUDIO_COLUMNS].to_numpy(), CatalogMatrices.from_rows(GENRES, TAGS, MOODS)
+
+
+def test_snapshot_round_trip_shares_mmapped_arrays(tmp_path):
+    df, features, matrices = catalog()
+    write_snapshot(str(tmp_path), df, features, matrices, watermark=42)
+
+    loaded_df, loaded_features, genres, tags, moods, watermark = load_latest_snapshot(str(tmp_path))
+
+    assert watermark == 42
+    pd.testing.assert_frame_equal(loaded_df, df, check_dtype=False)
+    np.testing.assert_array_equal(loaded_features, features)
+    for loaded, original, lists in ((genres, matrices.genres, GENRES), (tags, matrices.tags, TAGS),
+                                    (moods, matrices.moods, MOODS)):
+        assert [loaded[row] for row in range(len(lists))] == lists
+        assert (loaded.matrix != original.matrix).nnz == 0
+        np.testing.assert_array_equal(loaded.row_lengths, original.row_lengths)
+        # Матрица и коды строк открыты прямо над файлами снимка, без копий в памяти процесса
+        for array in (loaded.matrix.data, loaded.matrix.indices, loaded.matrix.indptr,
+                      loaded.presence.indices, loaded.row_codes, loaded.row_indptr):
+            assert mmapped(array)
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from app.core.catalog_index import CatalogIndex
+from app.core.scoring import TrackScorer
+from app.services import globals
+
+# Синтетический каталог: повторы категорий, пустые списки и жанры вне весов пользователя
+GENRES = [["rap", "trap"], ["rap", "rap"], [], ["pop", "rock", "jazz"], ["trap"], ["jazz", "jazz", "pop"]]
+TAGS = [["dark"], [], ["dark", "dark", "sad"], ["happy"], ["sad", "happy"], []]
+MOODS = [[], ["calm"], ["calm", "calm"], ["angry"], [], ["angry", "calm"]]
+
+USERS = [
+    ({"rap": 0.7, "trap": 0.3}, {"dark": 1.0}, {"calm": 0.5}),
+    ({"pop": 0.4, "unknown": 0.6}, {"happy": 0.2, "sad": 0.8}, {}),
+    ({}, {}, {}),
+    ({"jazz": 1.0, "rap": 0.5, "trap": 0.25}, {"missing": 1.0}, {"angry": 0.3, "calm": 0.3}),
+]
+
+
+@pytest.fixture
+def index(monkeypatch) -> CatalogIndex:
+    index = CatalogIndex([f"beat-{row}" for row in range(len(GENRES))], GENRES, TAGS, MOODS)
+    monkeypatch.setattr(globals, "catalog_index", index)
+    return index
+
+
+def expected(scorer, index, user):
+    return np.array([scorer.calculate_score(beat_id, *user) for beat_id in index.beat_ids])
+
+
+@pytest.mark.parametrize("user", USERS)
+def test_score_catalog_matches_calculate_score(index, user):
+    scorer = TrackScorer()
+    np.testing.assert_allclose(scorer.score_catalog(index.matrices, *user), expected(scorer, index, user))
+
+
+def test_extra_genres_are_penalised(index):
+    scorer = TrackScorer()
+    user = ({"rap": 1.0}, {}, {})
+    scores = scorer.score_catalog(index.matrices, *user)
+    # beat-0: rap + лишний trap -> 0.6 * 1.0 * 0.5; beat-1: rap дважды без штрафа
+    assert scores[0] == pytest.approx(0.3)
+    assert scores[1] == pytest.approx(1.2)
+    assert scores[2] == 0
+
+
+def test_score_vectors_batches_users(index):
+    scorer = TrackScorer()
+    matrices = index.matrices
+    vectors = [[], [], [], []]
+    for genres, tags, moods in USERS:
+        genre_vec, genre_mask = matrices.genres.weights_vector(genres)
+        for column, vector in zip(vectors, (genre_vec, genre_mask,
+                                            matrices.tags.weights_vector(tags)[0],
+                                            matrices.moods.weights_vector(moods)[0])):
+            column.append(vector)
+    genre_vec, genre_mask, tag_vec, mood_vec = (np.column_stack(v) for v in vectors)
+    totals = [np.array([sum(user[i].values()) for user in USERS]) for i in range(3)]
+
+    scores = scorer.score_vectors(matrices, genre_vec, genre_mask, tag_vec, mood_vec, *totals)
+
+    assert scores.shape == (len(GENRES), len(USERS))
+    for column, user in enumerate(USERS):
+        np.testing.assert_allclose(scores[:, column], expected(scorer, index, user))
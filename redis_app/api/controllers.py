@@ -1,6 +1,8 @@
 from flask import request, jsonify
-from core.use_cases import get_similar_tracks_use_case
+from core.use_cases import get_similar_tracks_use_case, get_similar_tracks_batch_use_case
 from infrastructure.redis_cache import redis_cache
+from infrastructure.similar_tracks_cache import similar_tracks_cache
+from config import BATCH_MAX_TRACKS
 import uuid
 
 def home():
@@ -32,6 +34,37 @@ def get_similar_tracks():
         return jsonify({"error": str(e)}), 500
 
 
+def get_similar_tracks_batch():
+    body = request.get_json(silent=True) or {}
+    track_ids = body.get('track_ids')
+    top_n = body.get('top_n', 10)
+
+    if not isinstance(track_ids, list) or not track_ids:
+        return jsonify({"error": "track_ids must be a non-empty list"}), 400
+
+    if len(track_ids) > BATCH_MAX_TRACKS:
+        return jsonify({"error": f"track_ids must contain at most {BATCH_MAX_TRACKS} ids"}), 400
+
+    if not isinstance(top_n, int) or isinstance(top_n, bool) or top_n <= 0:
+        return jsonify({"error": "top_n must be a positive integer"}), 400
+
+    try:
+        for track_id in track_ids:
+            uuid.UUID(str(track_id))
+    except ValueError:
+        return jsonify({"error": "track_ids must be valid UUIDs"}), 400
+
+    try:
+        results = get_similar_tracks_batch_use_case([str(t) for t in track_ids], top_n)
+        return jsonify(results)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+def get_cache_stats():
+    return jsonify(similar_tracks_cache.stats())
+
+
 # def clear_cache():
 #     track_id = request.args.get('track_id')
 
@@ -4,4 +4,6 @@ from api import controllers
 def configure_routes(app):
     app.add_url_rule("/", view_func=controllers.home, methods=["GET"])
     app.add_url_rule("/similar_tracks", view_func=controllers.get_similar_tracks, methods=["GET"])
+    app.add_url_rule("/similar_tracks/batch", view_func=controllers.get_similar_tracks_batch, methods=["POST"])
+    app.add_url_rule("/cache_stats", view_func=controllers.get_cache_stats, methods=["GET"])
     # app.add_url_rule("/clear_cache", view_func=controllers.clear_cache, methods=["DELETE"])
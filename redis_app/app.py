@@ -2,7 +2,10 @@ from flask import Flask
 from api.routes import configure_routes
 from flask_swagger_ui import get_swaggerui_blueprint
 from flask_cors import CORS
-from services.update_dataset import run_nightly_update, update_dataset
+from services.update_dataset import (run_nightly_update, run_incremental_refresh, update_dataset,
+                                    restore_snapshot, catch_up_dataset, run_catalog_watcher,
+                                    wait_for_shared_catalog, run_neighbour_table_watcher)
+import threading
 from infrastructure.data_loader import load_data
 def create_app():
     app = Flask(__name__)
@@ -10,7 +13,14 @@ def create_app():
     
     configure_routes(app)
     run_nightly_update()
-    update_dataset()
+    if restore_snapshot():
+        # Отвечаем сразу по снимку, а свежие данные из базы подтягиваем в фоне
+        threading.Thread(target=catch_up_dataset, daemon=True).start()
+    elif not wait_for_shared_catalog():
+        update_dataset(force=True)
+    run_incremental_refresh()
+    run_catalog_watcher()
+    run_neighbour_table_watcher()
     SWAGGER_URL = '/api/docs'
     API_URL = '/static/swagger.json'
     swaggerui_blueprint = get_swaggerui_blueprint(
@@ -0,0 +1,79 @@
+"""
+Бенчмарк IVF-индекса против полного перебора на синтетическом каталоге: recall@k и задержка запроса.
+
+    cd redis_app && python -m benchmarks.ann_recall --rows 200000 --nprobe 1 4 8 16 32
+"""
+import argparse
+import time
+import numpy as np
+from scipy import sparse
+from services.ann_index import build_ivf_index
+from services.ranking import top_k
+from services.similarity_kernel import build_similarity_kernel
+
+WEIGHTS = (0.2, 0.3, 0.3, 0.2)
+
+
+def one_hot(rng: np.random.Generator, topics: np.ndarray, n_topics: int, width: int, per_row: int) -> sparse.csr_matrix:
+    """Категории трека: в основном из "своей" части словаря (по теме трека), иногда случайные"""
+    n_rows = len(topics)
+    block = np.zeros((n_rows, width), dtype=np.float32)
+    span = max(1, width // n_topics)
+    for _ in range(per_row):
+        local = (topics * span + rng.integers(0, span, n_rows)) % width
+        random = rng.integers(0, width, n_rows)
+        block[np.arange(n_rows), np.where(rng.random(n_rows) < 0.8, local, random)] = 1.0
+    return sparse.csr_matrix(block)
+
+
+def synthetic_catalog(n_rows: int, seed: int = 0):
+    """Аудиопризнаки — смесь гауссиан, жанры/теги/настроения коррелируют с компонентой смеси"""
+    rng = np.random.default_rng(seed)
+    n_topics = 64
+    topics = rng.integers(0, n_topics, n_rows)
+    centers = rng.normal(size=(n_topics, 64)).astype(np.float32)
+    audio = centers[topics] + rng.normal(scale=0.8, size=(n_rows, 64)).astype(np.float32)
+    genres = one_hot(rng, topics, n_topics, 40, 2)
+    tags = one_hot(rng, topics, n_topics, 600, 5)
+    moods = one_hot(rng, topics, n_topics, 20, 2)
+    return build_similarity_kernel(audio, genres, tags, moods)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=0)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    kernel = synthetic_catalog(args.rows, args.seed)
+    started = time.perf_counter()
+    ann = build_ivf_index(kernel, nlist=args.nlist, seed=args.seed)
+    print(f"rows={args.rows} nlist={ann.nlist} build={time.perf_counter() - started:.1f}s")
+
+    rows = np.random.default_rng(args.seed + 1).choice(args.rows, args.queries, replace=False)
+    exact, exact_times = [], []
+    for row in rows:
+        started = time.perf_counter()
+        exact.append(set(top_k(kernel.similarities(row, WEIGHTS), args.k, exclude=[row]).tolist()))
+        exact_times.append(time.perf_counter() - started)
+    print(f"exact      p50={np.percentile(exact_times, 50) * 1e3:7.2f}ms "
+          f"p99={np.percentile(exact_times, 99) * 1e3:7.2f}ms")
+
+    for nprobe in args.nprobe:
+        hits, times = 0, []
+        for row, truth in zip(rows, exact):
+            started = time.perf_counter()
+            found, _ = ann.search(kernel, kernel.query(row, WEIGHTS), args.k, exclude_row=row, nprobe=nprobe)
+            times.append(time.perf_counter() - started)
+            hits += len(truth & set(found.tolist()))
+        recall = hits / sum(len(t) for t in exact)
+        print(f"nprobe={nprobe:<4} p50={np.percentile(times, 50) * 1e3:7.2f}ms "
+              f"p99={np.percentile(times, 99) * 1e3:7.2f}ms recall@{args.k}={recall:.3f}")
+
+
+if __name__ == "__main__":
+    main()
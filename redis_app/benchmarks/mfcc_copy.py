@@ -0,0 +1,118 @@
+"""
+Бенчмарк чтения аудиофичей: двоичный COPY таблицы mfccs в буфер float32 против pd.read_sql.
+
+Без базы оба пути сравниваются на файловых заменителях: pd.read_sql читает ту же таблицу
+из SQLite-файла, COPY-декодер разбирает файл в формате PGCOPY, который отдает PostgreSQL.
+С --database-url оба пути идут в настоящий PostgreSQL (таблица mfccs должна существовать).
+
+    cd redis_app && python -m benchmarks.mfcc_copy --rows 100000
+"""
+import argparse
+import os
+import struct
+import tempfile
+import time
+import uuid
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+from infrastructure.mfcc_copy import (MFCC_SOURCE_COLUMNS, COPY_SIGNATURE, COPY_TRAILER, BinaryCopyDecoder,
+                                      align_to_beats, copy_mfcc_features)
+
+READ_QUERY = "SELECT beat_id, {columns} FROM mfccs".format(columns=", ".join(MFCC_SOURCE_COLUMNS))
+
+
+def synthetic_mfccs(n_rows: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    beat_ids = [str(uuid.UUID(bytes=rng.bytes(16))) for _ in range(n_rows)]
+    values = rng.normal(size=(n_rows, len(MFCC_SOURCE_COLUMNS))).astype(np.float32)
+    values[rng.random(values.shape) < 0.02] = np.nan
+    return beat_ids, values
+
+
+def write_copy_file(path: str, beat_ids, values: np.ndarray):
+    """Файл в формате COPY ... TO STDOUT (FORMAT binary) для MFCC_COPY_QUERY"""
+    row_prefix = struct.pack(">hi", len(MFCC_SOURCE_COLUMNS) + 1, 16)
+    cells = np.empty(values.shape, dtype=[("length", ">i4"), ("value", ">f4")])
+    cells["length"] = 4
+    cells["value"] = values
+    with open(path, "wb") as f:
+        f.write(COPY_SIGNATURE + struct.pack(">ii", 0, 0))
+        for beat_id, row in zip(beat_ids, cells):
+            f.write(row_prefix + uuid.UUID(beat_id).bytes + row.tobytes())
+        f.write(COPY_TRAILER)
+
+
+def read_sql_path(engine, beat_ids) -> np.ndarray:
+    """Текущий путь: строки SQLAlchemy -> DataFrame -> pd.to_numeric -> .values в порядке треков"""
+    df = pd.read_sql(text(READ_QUERY), engine)
+    df['beat_id'] = df['beat_id'].astype(str)
+    df = pd.DataFrame({'beat_id': beat_ids}).merge(df, on='beat_id', how='left')
+    return df[MFCC_SOURCE_COLUMNS].apply(pd.to_numeric, errors='coerce').values
+
+
+def copy_file_path(path: str, beat_ids, read_size: int = 1 << 16) -> np.ndarray:
+    """COPY-путь на файле: данные подаются декодеру кусками read_size, как из copy_expert"""
+    decoder = BinaryCopyDecoder(len(beat_ids))
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(read_size)
+            if not data:
+                break
+            decoder.write(data)
+    ids, values = decoder.finish()
+    return align_to_beats(ids, values, beat_ids)
+
+
+def timed(fn, *args, repeat: int = 3):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--database-url", default="", help="PostgreSQL с таблицей mfccs вместо файловых заменителей")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.database_url:
+        engine = create_engine(args.database_url)
+        with engine.connect() as conn:
+            beat_ids = [str(x) for x in conn.execute(text("SELECT b.id FROM beats b")).scalars()]
+        sql_time, expected = timed(read_sql_path, engine, beat_ids, repeat=args.repeat)
+
+        def copy_path():
+            with engine.connect() as conn:
+                return copy_mfcc_features(conn, beat_ids)
+        copy_time, copied = timed(copy_path, repeat=args.repeat)
+    else:
+        beat_ids, values = synthetic_mfccs(args.rows, args.seed)
+        order = np.random.default_rng(args.seed + 1).permutation(len(beat_ids))
+        beat_ids = [beat_ids[i] for i in order]
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "mfccs.sqlite")
+            engine = create_engine(f"sqlite:///{db_path}")
+            frame = pd.DataFrame(values, columns=MFCC_SOURCE_COLUMNS)
+            frame.insert(0, "beat_id", [beat_ids[i] for i in np.argsort(order)])
+            frame.to_sql("mfccs", engine, index=False, chunksize=10000)
+            copy_file = os.path.join(tmp, "mfccs.copy")
+            write_copy_file(copy_file, frame["beat_id"], values)
+
+            sql_time, expected = timed(read_sql_path, engine, beat_ids, repeat=args.repeat)
+            copy_time, copied = timed(copy_file_path, copy_file, beat_ids, repeat=args.repeat)
+            engine.dispose()
+
+    same = np.allclose(copied, expected.astype(np.float32), equal_nan=True)
+    print(f"rows={len(beat_ids)} read_sql={sql_time:.3f}s copy={copy_time:.3f}s "
+          f"speedup={sql_time / copy_time:.1f}x identical={same}")
+    print(f"buffer: read_sql {expected.nbytes / 2**20:.1f} MiB float64, copy {copied.nbytes / 2**20:.1f} MiB float32")
+
+
+if __name__ == "__main__":
+    main()
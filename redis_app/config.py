@@ -15,3 +15,66 @@ DB_CONFIG = {
 def get_database_url():
     return f"postgresql://{DB_CONFIG['user']}:{DB_CONFIG['password']}@" \
            f"{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['dbname']}?sslmode={DB_CONFIG['sslmode']}"
+
+
+# Поиск похожих треков: "exact" — полный перебор каталога, "ivf" — приближенный индекс IVF
+SIMILARITY_SEARCH = os.getenv("SIMILARITY_SEARCH", "exact")
+# Количество кластеров IVF (0 — 4 * sqrt(числа треков))
+ANN_NLIST = int(os.getenv("ANN_NLIST", "0"))
+# Сколько кластеров просматривается на запрос: больше — выше полнота и медленнее
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "8"))
+# На каталогах меньше этого размера полный перебор быстрее, индекс не строится
+ANN_MIN_ROWS = int(os.getenv("ANN_MIN_ROWS", "50000"))
+
+# Каталог предпосчитанной таблицы соседей (precompute_neighbours.py); пусто — не используется
+NEIGHBOUR_TABLE_DIR = os.getenv("NEIGHBOUR_TABLE_DIR", "")
+# Как часто проверять, не появилась ли новая версия таблицы соседей, в секундах
+NEIGHBOUR_TABLE_POLL_SECONDS = float(os.getenv("NEIGHBOUR_TABLE_POLL_SECONDS", "60"))
+
+# L1-кэш похожих треков в памяти процесса (перед Redis)
+L1_CACHE_MAX_ENTRIES = int(os.getenv("L1_CACHE_MAX_ENTRIES", "10000"))
+L1_CACHE_MAX_BYTES = int(os.getenv("L1_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+L1_CACHE_TTL_SECONDS = float(os.getenv("L1_CACHE_TTL_SECONDS", "600"))
+
+# Межпроцессная блокировка расчета похожих треков в Redis (SET NX PX)
+COMPUTE_LOCK_TTL_MS = int(os.getenv("COMPUTE_LOCK_TTL_MS", "5000"))
+# Сколько ждать результата другого процесса, прежде чем считать самим
+COMPUTE_LOCK_WAIT_MS = int(os.getenv("COMPUTE_LOCK_WAIT_MS", "3000"))
+# Блокировка переноса кэша между версиями каталога: переносит один процесс, должна пережить весь перенос
+CACHE_MIGRATION_LOCK_TTL_MS = int(os.getenv("CACHE_MIGRATION_LOCK_TTL_MS", str(30 * 60 * 1000)))
+COMPUTE_LOCK_POLL_MS = int(os.getenv("COMPUTE_LOCK_POLL_MS", "50"))
+# Сколько соседей считается и кэшируется при промахе: запросы с top_n не больше этого числа
+# обслуживаются одной записью кэша и ждут одну блокировку
+SIMILAR_TRACKS_CACHE_K = int(os.getenv("SIMILAR_TRACKS_CACHE_K", "50"))
+
+# Максимум треков в одном запросе /similar_tracks/batch
+BATCH_MAX_TRACKS = int(os.getenv("BATCH_MAX_TRACKS", "100"))
+# Сколько запросов батча считается одним умножением матрица-матрица (память: треки каталога x чанк)
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "64"))
+
+# Строк каталога за одно чтение серверного курсора при полной загрузке
+CATALOG_CHUNK_SIZE = int(os.getenv("CATALOG_CHUNK_SIZE", "5000"))
+# Аудиофичи читаются двоичным COPY таблицы mfccs в float32 (только psycopg2), иначе — обычной выборкой
+MFCC_COPY = os.getenv("MFCC_COPY", "true").lower() == "true"
+
+# Инкрементальное обновление каталога: колонка beats, которая растет при изменении трека
+CATALOG_WATERMARK_COLUMN = os.getenv("CATALOG_WATERMARK_COLUMN", "updated_at")
+# Период инкрементального обновления в минутах (0 — выключено, только ночная полная перезагрузка)
+CATALOG_REFRESH_MINUTES = int(os.getenv("CATALOG_REFRESH_MINUTES", "0"))
+# Окно перекрытия выборки изменений в секундах: правки, закоммиченные с опозданием, не теряются
+CATALOG_REFRESH_OVERLAP_SECONDS = float(os.getenv("CATALOG_REFRESH_OVERLAP_SECONDS", "60"))
+
+# Каталог снимков датасета на диске для быстрого старта (пусто — не используется)
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "")
+# Сколько последних снимков хранить
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "2"))
+# Снимки после инкрементальных обновлений — не чаще раза в столько секунд (полная перезагрузка пишет всегда)
+SNAPSHOT_MIN_INTERVAL_SECONDS = float(os.getenv("SNAPSHOT_MIN_INTERVAL_SECONDS", "600"))
+
+# Общий каталог для нескольких воркеров: один процесс (держатель блокировки в SNAPSHOT_DIR) грузит базу
+# и пишет снимки, остальные открывают снимки через mmap и переподключаются при смене поколения
+CATALOG_SHARED = os.getenv("CATALOG_SHARED", "false").lower() == "true"
+# Как часто воркер проверяет поколение снимка, в секундах
+CATALOG_ATTACH_POLL_SECONDS = float(os.getenv("CATALOG_ATTACH_POLL_SECONDS", "5"))
+# Сколько воркер при старте ждет первый снимок загрузчика, прежде чем читать базу сам
+CATALOG_ATTACH_TIMEOUT_SECONDS = float(os.getenv("CATALOG_ATTACH_TIMEOUT_SECONDS", "60"))
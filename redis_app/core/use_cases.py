@@ -1,12 +1,227 @@
+from infrastructure.similar_tracks_cache import similar_tracks_cache
 from infrastructure.redis_cache import redis_cache
-from services.similarity_service import find_similar_tracks
+from infrastructure.single_flight import SingleFlight
+from config import COMPUTE_LOCK_TTL_MS, COMPUTE_LOCK_WAIT_MS, COMPUTE_LOCK_POLL_MS, SIMILAR_TRACKS_CACHE_K
+from services.similarity_service import get_updated_data, rank_similar, rank_similar_batch, tracks_from_rows
+from services.catalog_index import CatalogIndex
 import services.globals as globals
 from services.update_dataset import update_dataset
-from typing import List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+import time
+import numpy as np
 import pandas as pd
 import logging
 
 logger = logging.getLogger(__name__)
+
+# Запись в Redis не должна задерживать ответ на запрос
+cache_writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="redis-cache-writer")
+
+
+# Одновременные промахи по одному треку в процессе считаются один раз: ключ (track_id, глубина расчета),
+# как и у блокировки в Redis, поэтому запросы с разным top_n <= SIMILAR_TRACKS_CACHE_K ждут один расчет
+similar_tracks_flight = SingleFlight()
+
+# Результат расчета: (датасет, индекс каталога, строки соседей по убыванию скора)
+RankedRows = Tuple[pd.DataFrame, CatalogIndex, List[int]]
+
+
+def similar_tracks_depth(top_n: int) -> int:
+    """Сколько соседей считается и кэшируется для запроса top_n"""
+    return max(top_n, SIMILAR_TRACKS_CACHE_K)
+
+
+def _cache_similar_tracks(track_id: str, beat_ids: Sequence[str], scores: np.ndarray,
+                          version: str, lock_name: Optional[str] = None, lock_token: Optional[str] = None):
+    try:
+        similar_tracks_cache.set(track_id, beat_ids, scores, version)
+    except Exception as e:
+        logger.error(f"Failed to cache results: {str(e)}")
+    finally:
+        if lock_token is not None:
+            _release_compute_lock(lock_name, lock_token)
+
+
+def _compute_lock_name(track_id: str, depth: int) -> str:
+    """
+    Блокировка на трек и глубину расчета: все запросы с top_n <= SIMILAR_TRACKS_CACHE_K ждут один
+    расчет на K соседей, запросам с большим top_n чужой результат не подходит — у них своя блокировка
+    """
+    return f"similar_tracks:{track_id}:{depth}"
+
+
+def _acquire_compute_lock(lock_name: str) -> Tuple[bool, Optional[str]]:
+    """(получена ли блокировка, токен). Без Redis считаем сами, без блокировки"""
+    try:
+        token = redis_cache.acquire_lock(lock_name, COMPUTE_LOCK_TTL_MS)
+        return token is not None, token
+    except Exception as e:
+        logger.warning(f"Compute lock {lock_name} unavailable: {str(e)}")
+        return True, None
+
+
+def _release_compute_lock(lock_name: str, token: str):
+    try:
+        redis_cache.release_lock(lock_name, token)
+    except Exception as e:
+        logger.warning(f"Failed to release compute lock {lock_name}: {str(e)}")
+
+
+def cached_rows(cached: Optional[Tuple[List[str], np.ndarray]], top_n: int) -> Optional[RankedRows]:
+    """
+    Строки текущего каталога для id соседей из кэша.
+    None, если записи нет или в ней меньше top_n треков, которые есть в каталоге
+    """
+    if cached is None:
+        return None
+    beat_ids, _ = cached
+
+    df, _, _, _, _, index = get_updated_data()
+    rows = [row for row in map(index.row, beat_ids) if row is not None]
+    if len(rows) < min(top_n, len(index) - 1):
+        return None
+    return df, index, rows
+
+
+def hydrate_similar_tracks(cached: Optional[Tuple[List[str], np.ndarray]],
+                           top_n: int) -> Optional[List[Dict[str, Any]]]:
+    """Подставляет данные треков из текущего каталога вместо id соседей из кэша (None — см. cached_rows)"""
+    found = cached_rows(cached, top_n)
+    if found is None:
+        return None
+    df, index, rows = found
+    return tracks_from_rows(df, index, rows[:top_n])
+
+
+def cached_similar_tracks(track_id: str, top_n: int) -> Optional[List[Dict[str, Any]]]:
+    """Похожие треки из кэша (L1 в памяти, затем Redis)"""
+    return hydrate_similar_tracks(similar_tracks_cache.get(track_id), top_n)
+
+
+def _wait_for_other_processes(track_ids: Sequence[str], depth: int) -> Dict[str, RankedRows]:
+    """
+    Ждет, пока процессы, взявшие блокировки треков, запишут результаты в Redis. Трек перестает
+    ждать, как только его блокировка снята: держатель снимает ее после записи, поэтому если
+    результата к этому моменту нет, то его и не будет. Ошибки Redis означают расчет своими силами.
+    Возвращает найденные результаты; остальные треки вызывающий считает сам
+    """
+    found: Dict[str, RankedRows] = {}
+    pending = list(track_ids)
+    deadline = time.monotonic() + COMPUTE_LOCK_WAIT_MS / 1000
+    while pending and time.monotonic() < deadline:
+        time.sleep(COMPUTE_LOCK_POLL_MS / 1000)
+        try:
+            # Блокировки проверяются до чтения: если блокировка уже снята, запись (если была) уже видна
+            held = redis_cache.locks_held([_compute_lock_name(track_id, depth) for track_id in pending])
+            cached = redis_cache.get_many_similar_tracks(pending, globals.dataset_version)
+        except Exception as e:
+            logger.warning(f"Failed to poll similar tracks of {len(pending)} tracks: {str(e)}, computing locally")
+            return found
+        still_pending = []
+        for track_id, is_held, entry in zip(pending, held, cached):
+            result = cached_rows(entry, depth)
+            if result is not None:
+                found[track_id] = result
+            elif is_held:
+                still_pending.append(track_id)
+            else:
+                logger.debug(f"Compute lock of {track_id} released without a usable result, computing locally")
+        pending = still_pending
+    if pending:
+        logger.warning(f"Timed out waiting for similar tracks of {len(pending)} tracks, computing locally")
+    return found
+
+
+def _compute_similar_rows(track_id: str, depth: int) -> RankedRows:
+    """
+    Расчет depth соседей трека при промахе кэша. Между процессами расчет защищен блокировкой
+    в Redis: не получивший ее процесс ждет результат из Redis и считает сам,
+    если блокировка снята без результата или истек таймаут
+    """
+    lock_name = _compute_lock_name(track_id, depth)
+    acquired, lock_token = _acquire_compute_lock(lock_name)
+    if not acquired:
+        waited = _wait_for_other_processes([track_id], depth).get(track_id)
+        if waited is not None:
+            return waited
+
+    try:
+        # Один расчет похожих треков: id и скоры идут в кэш, данные треков — в ответ
+        df, index, rows, scores = rank_similar(track_id, top_n=depth)
+    except Exception:
+        if lock_token is not None:
+            _release_compute_lock(lock_name, lock_token)
+        raise
+
+    if len(rows) == 0:
+        if lock_token is not None:
+            _release_compute_lock(lock_name, lock_token)
+        logger.warning(f"No similar tracks found for {track_id}")
+        return df, index, []
+
+    # Блокировка снимается после записи в Redis, чтобы ждущие процессы нашли результат
+    cache_writer.submit(_cache_similar_tracks, track_id, [index.beat_ids[row] for row in rows], scores,
+                        index.content_version, lock_name, lock_token)
+    return df, index, list(rows)
+
+
+def compute_similar_tracks(track_id: str, top_n: int) -> List[Dict[str, Any]]:
+    """
+    Похожие треки при промахе кэша. Считается и кэшируется similar_tracks_depth(top_n) соседей,
+    чтобы запись подошла и запросам с другим top_n; одновременные запросы процесса
+    с той же глубиной ждут один расчет
+    """
+    depth = similar_tracks_depth(top_n)
+    found = similar_tracks_flight.do((track_id, depth), _compute_similar_rows, track_id, depth)
+    if found is None:
+        # Пакетный расчет того же трека не нашел его в каталоге (каталог сменился во время запроса)
+        raise ValueError(f"Track {track_id} not found in dataset")
+    df, index, rows = found
+    return tracks_from_rows(df, index, rows[:top_n])
+
+
+def _rank_and_cache(track_ids: Sequence[str], depth: int,
+                    lock_tokens: Dict[str, Optional[str]]) -> Dict[str, RankedRows]:
+    """
+    depth соседей для треков одним умножением матрица-матрица (rank_similar_batch) с записью в кэш.
+    Блокировки из lock_tokens снимаются после записи в Redis, а треков без записи — сразу
+    """
+    results: Dict[str, RankedRows] = {}
+    handed_off = set()
+    try:
+        if track_ids:
+            df, index, ranked = rank_similar_batch(track_ids, top_n=depth)
+            for track_id, (rows, scores) in ranked.items():
+                results[track_id] = (df, index, list(rows))
+                if len(rows):
+                    cache_writer.submit(_cache_similar_tracks, track_id, [index.beat_ids[row] for row in rows],
+                                        scores, index.content_version, _compute_lock_name(track_id, depth),
+                                        lock_tokens.get(track_id))
+                    handed_off.add(track_id)
+    finally:
+        for track_id, token in lock_tokens.items():
+            if token is not None and track_id not in handed_off:
+                _release_compute_lock(_compute_lock_name(track_id, depth), token)
+    return results
+
+
+def _compute_similar_rows_batch(track_ids: Sequence[str], depth: int) -> Dict[str, RankedRows]:
+    """
+    Расчет depth соседей для нескольких треков с теми же блокировками в Redis, что у одиночного расчета.
+    Сначала считаются треки, чьи блокировки получены (их могут ждать другие процессы), затем
+    ожидаются результаты остальных; не дождавшиеся треки считаются вторым пакетом без блокировки
+    """
+    locks = {track_id: _acquire_compute_lock(_compute_lock_name(track_id, depth)) for track_id in track_ids}
+    mine = [track_id for track_id in track_ids if locks[track_id][0]]
+    others = [track_id for track_id in track_ids if not locks[track_id][0]]
+
+    results = _rank_and_cache(mine, depth, {track_id: locks[track_id][1] for track_id in mine})
+    if others:
+        results.update(_wait_for_other_processes(others, depth))
+        results.update(_rank_and_cache([track_id for track_id in others if track_id not in results], depth, {}))
+    return results
+
 # def _map_ids_to_names(id_list: List[str], lookup_df: pd.DataFrame, id_col: str = "id") -> List[str]:
 #     """Преобразуем список ID в список названий"""
 #     if lookup_df is None or not isinstance(lookup_df, pd.DataFrame) or lookup_df.empty:
@@ -20,6 +235,29 @@ logger = logging.getLogger(__name__)
 #         logger.error(f"Error mapping IDs to names: {str(e)}")
 #         return []
 
+def ensure_dataset():
+    """Загружает датасет, если он еще не загружен или пустой"""
+    # Проверяем и загружаем данные
+    if (globals.dataset_df is None or 
+        globals.df_feature_matrix is None or 
+        globals.df_genres is None or 
+        globals.df_moods is None or 
+        globals.df_tags is None):
+        
+        logger.info("Initial dataset load...")
+        if not update_dataset():
+            logger.error("Initial dataset load failed")
+            raise RuntimeError("Could not load dataset")
+    
+    # Проверяем что данные не пустые
+    if (not isinstance(globals.dataset_df, pd.DataFrame) or 
+        globals.dataset_df.empty or 
+        globals.df_feature_matrix.size == 0):
+        
+        logger.warning("Data appears to be empty, trying to reload...")
+        if not update_dataset():
+            raise RuntimeError("Dataset reload failed")
+
 def get_similar_tracks_use_case(track_id: str, top_n: int) -> List[Dict[str, Any]]:
     """
     Получаем похожие треки для заданного track_id
@@ -32,63 +270,77 @@ def get_similar_tracks_use_case(track_id: str, top_n: int) -> List[Dict[str, Any
         Список словарей с информацией о похожих треках (без genres/moods/tags)
     """
     try:
-        # Проверяем и загружаем данные
-        if (globals.dataset_df is None or 
-            globals.df_feature_matrix is None or 
-            globals.df_genres is None or 
-            globals.df_moods is None or 
-            globals.df_tags is None):
-            
-            logger.info("Initial dataset load...")
-            if not update_dataset():
-                logger.error("Initial dataset load failed")
-                raise RuntimeError("Could not load dataset")
-        
-        # Проверяем что данные не пустые
-        if (not isinstance(globals.dataset_df, pd.DataFrame) or 
-            globals.dataset_df.empty or 
-            globals.df_feature_matrix.size == 0):
-            
-            logger.warning("Data appears to be empty, trying to reload...")
-            if not update_dataset():
-                raise RuntimeError("Dataset reload failed")
-        
-        if str(track_id) not in globals.dataset_df['beat_id'].astype(str).values:
+        ensure_dataset()
+
+        if track_id not in globals.catalog_index:
             logger.warning(f"Track {track_id} not found in dataset")
             raise ValueError(f"Track {track_id} not found")
 
         # Пытаемся найти в кэше
-        cached_data = redis_cache.get_similar_tracks(track_id)
-        if cached_data:
+        cached_data = cached_similar_tracks(track_id, top_n)
+        if cached_data is not None:
             logger.debug(f"Returning cached data for track {track_id}")
-            return [{
-                "beat_id": item["beat_id"],
-                "file": item["file"],
-                "url": item["url"],
-                "price": item["price"],
-                "picture": item["picture"],
-                "timestamps": item["timestamps"],
-                # "genres": item.get("genres", []),
-                # "moods": item.get("moods", []),
-                # "tags": item.get("tags", [])
-            } for item in cached_data]
-
-        # Получаем похожие треки
-        similar_tracks = find_similar_tracks(track_id, top_n=top_n, return_full_data=False)
-        
-        if not similar_tracks:
-            logger.warning(f"No similar tracks found for {track_id}")
-            return []
+            return cached_data
 
-        # Получаем и кэшируем полные данные
-        try:
-            full_data = find_similar_tracks(track_id, top_n=top_n, return_full_data=True)
-            redis_cache.set_similar_tracks(track_id, full_data)
-        except Exception as e:
-            logger.error(f"Failed to cache full results: {str(e)}")
-
-        return similar_tracks
+        return compute_similar_tracks(track_id, top_n)
 
     except Exception as e:
         logger.error(f"Error in get_similar_tracks_use_case: {str(e)}", exc_info=True)
-        raise RuntimeError(f"Service unavailable: {str(e)}")
\ No newline at end of file
+        raise RuntimeError(f"Service unavailable: {str(e)}")
+
+def get_similar_tracks_batch_use_case(track_ids: List[str], top_n: int) -> Dict[str, Optional[List[Dict[str, Any]]]]:
+    """
+    Похожие треки сразу для нескольких track_id: закэшированные берутся одним запросом
+    к кэшу (L1, затем MGET в Redis), промахи считаются вместе одним умножением матрица-матрица
+    на глубину similar_tracks_depth(top_n), как и при одиночном запросе
+
+    Returns:
+        {track_id: список похожих треков или None, если трека нет в каталоге}
+    """
+    try:
+        ensure_dataset()
+        track_ids = list(dict.fromkeys(track_ids))
+        results: Dict[str, Optional[List[Dict[str, Any]]]] = {
+            track_id: None for track_id in track_ids if track_id not in globals.catalog_index
+        }
+        known = [track_id for track_id in track_ids if track_id not in results]
+
+        cached = similar_tracks_cache.get_many(known)
+        missing = []
+        for track_id in known:
+            hydrated = hydrate_similar_tracks(cached.get(track_id), top_n)
+            if hydrated is not None:
+                results[track_id] = hydrated
+            else:
+                missing.append(track_id)
+
+        if missing:
+            # Промахи считаются на той же глубине и под теми же ключами, что и одиночные запросы:
+            # треки, которые уже считает другой поток процесса, ждут его результат
+            depth = similar_tracks_depth(top_n)
+            claims = {track_id: similar_tracks_flight.claim((track_id, depth)) for track_id in missing}
+            led = [track_id for track_id in missing if claims[track_id][0]]
+            try:
+                computed = _compute_similar_rows_batch(led, depth) if led else {}
+            except Exception as e:
+                for track_id in led:
+                    similar_tracks_flight.resolve((track_id, depth), claims[track_id][1], error=e)
+                raise
+            for track_id in led:
+                similar_tracks_flight.resolve((track_id, depth), claims[track_id][1], computed.get(track_id))
+
+            for track_id in missing:
+                leader, call = claims[track_id]
+                found = computed.get(track_id) if leader else similar_tracks_flight.wait(call)
+                if found is None:
+                    results[track_id] = None
+                    continue
+                df, index, rows = found
+                results[track_id] = tracks_from_rows(df, index, rows[:top_n])
+
+        logger.info(f"Batch of {len(track_ids)} tracks: {len(known) - len(missing)} cached, {len(missing)} computed")
+        return {track_id: results[track_id] for track_id in track_ids}
+
+    except Exception as e:
+        logger.error(f"Error in get_similar_tracks_batch_use_case: {str(e)}", exc_info=True)
+        raise RuntimeError(f"Service unavailable: {str(e)}")
@@ -0,0 +1,42 @@
+import fcntl
+import logging
+import os
+from threading import Lock
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+LOCK_FILE = ".loader.lock"
+
+
+class CatalogLeader:
+    """
+    Выбор процесса-загрузчика каталога среди воркеров через flock на файле в каталоге снимков.
+    Загрузчик держит блокировку, пока жив; после его падения ее забирает следующий воркер,
+    который первым попробует. Остальные процессы только подключаются к снимкам
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._fd: Optional[int] = None
+        self._lock = Lock()
+
+    @property
+    def is_leader(self) -> bool:
+        return self._fd is not None
+
+    def acquire(self) -> bool:
+        """Неблокирующая попытка стать загрузчиком; True, если процесс уже или теперь загрузчик"""
+        with self._lock:
+            if self._fd is not None:
+                return True
+            os.makedirs(self.root, exist_ok=True)
+            fd = os.open(os.path.join(self.root, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            self._fd = fd
+            logger.info(f"Process {os.getpid()} became the catalog loader")
+            return True
@@ -0,0 +1,260 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from infrastructure.catalog_stream import AUDIO_COLUMNS, CATEGORY_COLUMNS, FRAME_COLUMNS, split_ids
+from infrastructure.version_pointer import CURRENT_FILE, write_current
+from services.similarity_kernel import SimilarityKernel
+from services.ann_index import IVFIndex
+
+logger = logging.getLogger(__name__)
+
+# 2 — feature_matrix без one-hot категорий, ядро схожести из плотной и разреженной частей
+SNAPSHOT_FORMAT = 2
+GENERATION_LOCK_FILE = ".generation.lock"
+META_FILE = "meta.json"
+TABLE_FILE = "table.json"
+TABLE_COLUMNS = ['beat_id', 'file', 'picture', 'url', 'timestamps']
+
+
+def read_current(root: str) -> Optional[str]:
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def snapshot_generation(version: Optional[str]) -> int:
+    """Номер поколения из имени снимка '<поколение>-<время>-<суффикс>' (0 — снимка нет)"""
+    try:
+        return int(version.split("-", 1)[0]) if version else 0
+    except ValueError:
+        return 0
+
+
+def read_generation(root: str) -> int:
+    """Поколение текущего снимка: растет с каждым записанным снимком, воркеры сравнивают его для переподключения"""
+    return snapshot_generation(read_current(root))
+
+
+def encode_categories(lists: Sequence[List[str]]) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """Списки категорий строк в CSR-вид: (indptr, коды в отсортированном словаре, словарь)"""
+    vocabulary = sorted({name for ids in lists for name in ids})
+    code_of = {name: code for code, name in enumerate(vocabulary)}
+    indptr = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(ids) for ids in lists], out=indptr[1:])
+    codes = np.fromiter((code_of[name] for ids in lists for name in ids), dtype=np.int32, count=int(indptr[-1]))
+    return indptr, codes, vocabulary
+
+
+def decode_categories(indptr: np.ndarray, codes: np.ndarray, vocabulary: List[str]) -> List[str]:
+    """Обратно в формат колонок genre_ids/tag_ids/mood_ids после load_data: '1,3,5'"""
+    names = [vocabulary[code] for code in codes.tolist()]
+    return [','.join(names[indptr[row]:indptr[row + 1]]) for row in range(len(indptr) - 1)]
+
+
+def categories_matrix(indptr: np.ndarray, codes: np.ndarray, vocabulary: List[str]) -> sparse.csr_matrix:
+    """Разреженный one-hot блок, как category_matrix в build_feature_blocks (коды строки уникальны)"""
+    return sparse.csr_matrix((np.ones(len(codes), dtype=np.float32), codes, indptr),
+                             shape=(len(indptr) - 1, len(vocabulary)))
+
+
+def _encode_watermark(watermark: Any) -> Dict[str, Any]:
+    if isinstance(watermark, datetime):
+        return {"watermark": watermark.isoformat(), "watermark_type": "datetime"}
+    return {"watermark": watermark, "watermark_type": None}
+
+
+def _decode_watermark(meta: Dict[str, Any]) -> Any:
+    if meta.get("watermark_type") == "datetime" and meta.get("watermark") is not None:
+        return datetime.fromisoformat(meta["watermark"])
+    return meta.get("watermark")
+
+
+@contextmanager
+def _generation_lock(root: str):
+    """
+    flock на отдельном файле каталога снимков (не .loader.lock: его держит загрузчик, и повторный
+    flock из того же процесса заблокировался бы). В файле хранится последнее выданное поколение
+    """
+    fd = os.open(os.path.join(root, GENERATION_LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def allocate_generation(root: str) -> int:
+    """
+    Следующее поколение снимка. Выдается под блокировкой и сразу записывается в файл блокировки,
+    поэтому несколько процессов, пишущих снимки одновременно, не получат одно и то же поколение
+    """
+    with _generation_lock(root) as fd:
+        try:
+            last = int(os.pread(fd, 32, 0).decode().strip() or 0)
+        except ValueError:
+            last = 0
+        generation = max([last, read_generation(root)] + [snapshot_generation(v) for v in list_snapshots(root)]) + 1
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, str(generation).encode(), 0)
+        return generation
+
+
+def write_snapshot(root: str, df: pd.DataFrame, feature_matrix: np.ndarray, watermark: Any = None,
+                   keep: int = 2, kernel: Optional[SimilarityKernel] = None,
+                   ann: Optional[IVFIndex] = None) -> str:
+    """
+    Пишет снимок каталога в новую версионированную директорию: аудиофичи и матрица признаков (.npy),
+    категории в CSR-виде (indptr/codes .npy), таблица метаданных (table.json) и meta.json.
+    Если переданы ядро схожести и IVF-индекс, их массивы тоже сохраняются, чтобы воркеры
+    открывали их через mmap, а не строили заново.
+    Директория собирается под временным именем и переименовывается целиком, затем переключается CURRENT
+    """
+    os.makedirs(root, exist_ok=True)
+    generation = allocate_generation(root)
+    # Суффикс делает имя уникальным, даже если два процесса пишут снимки в одну секунду
+    version = f"{generation:010d}-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    tmp_path = os.path.join(root, f".tmp-{version}")
+    os.makedirs(tmp_path)
+    try:
+        np.save(os.path.join(tmp_path, "features.npy"), np.ascontiguousarray(feature_matrix))
+        np.save(os.path.join(tmp_path, "audio.npy"), np.ascontiguousarray(df[AUDIO_COLUMNS].to_numpy(dtype=np.float64)))
+        np.save(os.path.join(tmp_path, "price.npy"), pd.to_numeric(df['price'], errors='coerce').to_numpy(dtype=np.float64))
+        vocabularies = {}
+        for col in CATEGORY_COLUMNS:
+            indptr, codes, vocabulary = encode_categories([split_ids(x) for x in df[col]])
+            np.save(os.path.join(tmp_path, f"{col}_indptr.npy"), indptr)
+            np.save(os.path.join(tmp_path, f"{col}_codes.npy"), codes)
+            vocabularies[col] = vocabulary
+        with open(os.path.join(tmp_path, TABLE_FILE), "w") as f:
+            json.dump({col: df[col].tolist() for col in TABLE_COLUMNS}, f, default=str)
+        extra: Dict[str, Any] = {}
+        if kernel is not None:
+            for name, array in kernel.arrays().items():
+                np.save(os.path.join(tmp_path, f"kernel_{name}.npy"), array)
+            extra["kernel_blocks"] = [list(block) for block in kernel.blocks]
+        if ann is not None:
+            np.save(os.path.join(tmp_path, "ann_centroids.npy"), ann.centroids)
+            np.save(os.path.join(tmp_path, "ann_offsets.npy"), ann.list_offsets)
+            np.save(os.path.join(tmp_path, "ann_rows.npy"), ann.list_rows)
+            extra["ann_nprobe"] = ann.nprobe
+            extra["ann_vocabulary"] = ann.vocabulary
+        with open(os.path.join(tmp_path, META_FILE), "w") as f:
+            json.dump({
+                "format": SNAPSHOT_FORMAT,
+                "rows": len(df),
+                "feature_columns": int(feature_matrix.shape[1]),
+                "vocabularies": vocabularies,
+                "created_at": time.time(),
+                **_encode_watermark(watermark),
+                **extra
+            }, f)
+        os.rename(tmp_path, os.path.join(root, version))
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    with _generation_lock(root):
+        # Снимок, дописанный позже более нового, не откатывает CURRENT назад
+        if generation > read_generation(root):
+            write_current(root, version)
+    prune_snapshots(root, keep)
+    logger.info(f"Catalog snapshot {version} written: {len(df)} beats")
+    return version
+
+
+def list_snapshots(root: str) -> List[str]:
+    """Версии снимков от новых к старым"""
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return []
+    return sorted((name for name in names if not name.startswith(".") and name != CURRENT_FILE
+                   and os.path.isdir(os.path.join(root, name))), reverse=True)
+
+
+def prune_snapshots(root: str, keep: int):
+    current = read_current(root)
+    for version in list_snapshots(root)[max(keep, 1):]:
+        if version != current:
+            shutil.rmtree(os.path.join(root, version), ignore_errors=True)
+
+
+def _open_snapshot(path: str):
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    if meta.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"unsupported snapshot format {meta.get('format')}")
+    n_rows = int(meta["rows"])
+
+    features = np.load(os.path.join(path, "features.npy"), mmap_mode="r")
+    audio = np.load(os.path.join(path, "audio.npy"), mmap_mode="r")
+    price = np.load(os.path.join(path, "price.npy"), mmap_mode="r")
+    if features.shape != (n_rows, meta["feature_columns"]) or audio.shape != (n_rows, len(AUDIO_COLUMNS)) \
+            or price.shape != (n_rows,):
+        raise ValueError("array shapes do not match metadata")
+    with open(os.path.join(path, TABLE_FILE)) as f:
+        table = json.load(f)
+    if any(len(table[col]) != n_rows for col in TABLE_COLUMNS):
+        raise ValueError("metadata table does not match row count")
+
+    columns: Dict[str, Any] = dict(table)
+    blocks = []
+    for col in CATEGORY_COLUMNS:
+        indptr = np.load(os.path.join(path, f"{col}_indptr.npy"))
+        codes = np.load(os.path.join(path, f"{col}_codes.npy"), mmap_mode="r")
+        vocabulary = meta["vocabularies"][col]
+        if len(indptr) != n_rows + 1 or indptr[-1] != len(codes):
+            raise ValueError(f"{col} incidence does not match row count")
+        columns[col] = decode_categories(indptr, codes, vocabulary)
+        blocks.append(categories_matrix(indptr, codes, vocabulary))
+
+    df = pd.DataFrame(audio, columns=AUDIO_COLUMNS, copy=False)
+    for position, col in enumerate(FRAME_COLUMNS):
+        df.insert(position, col, price if col == 'price' else pd.Series(columns[col], dtype=object))
+
+    kernel = ann = None
+    if "kernel_blocks" in meta:
+        arrays = {name: np.load(os.path.join(path, f"kernel_{name}.npy"), mmap_mode="r")
+                  for name in ("dense", "sparse_data", "sparse_indices", "sparse_indptr")}
+        if len(arrays["dense"]) != n_rows or len(arrays["sparse_indptr"]) != n_rows + 1:
+            raise ValueError("kernel arrays do not match row count")
+        kernel = SimilarityKernel.from_arrays(arrays, meta["kernel_blocks"])
+    if "ann_nprobe" in meta and kernel is not None:
+        ann = IVFIndex.from_lists(np.load(os.path.join(path, "ann_centroids.npy"), mmap_mode="r"),
+                                  np.load(os.path.join(path, "ann_offsets.npy")),
+                                  np.load(os.path.join(path, "ann_rows.npy"), mmap_mode="r"),
+                                  int(meta["ann_nprobe"]), meta.get("ann_vocabulary"))
+    return (df, features, *blocks, _decode_watermark(meta), kernel, ann)
+
+
+def load_latest_snapshot(root: str):
+    """
+    Последний целый снимок: (df, feature_matrix, genres, tags, moods, watermark, kernel, ann)
+    или None; kernel и ann — None, если в снимке их нет. Массивы открываются через mmap,
+    поврежденные снимки пропускаются
+    """
+    if not root:
+        return None
+    current = read_current(root)
+    candidates = ([current] if current else []) + [v for v in list_snapshots(root) if v != current]
+    for version in candidates:
+        try:
+            snapshot = _open_snapshot(os.path.join(root, version))
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Skipping catalog snapshot {version}: {e}")
+            continue
+        logger.info(f"Catalog snapshot {version} loaded: {len(snapshot[0])} beats")
+        return snapshot
+    return None
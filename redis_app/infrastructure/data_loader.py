@@ -1,12 +1,19 @@
 import json
+from datetime import datetime, timedelta
+from typing import Any, List, Optional, Sequence, Tuple
 import os
+import re
 import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
+from scipy import sparse
 from sklearn.impute import SimpleImputer
 import logging
 import services.globals as globals
+from config import CATALOG_WATERMARK_COLUMN, CATALOG_CHUNK_SIZE, MFCC_COPY, CATALOG_REFRESH_OVERLAP_SECONDS
+from infrastructure.catalog_stream import split_ids, stream_catalog, match_copy_precision
+from services.similarity_kernel import category_matrix, patch_dense_rows, patch_rows
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,6 +28,62 @@ DATABASE_URL = (
 
 engine = create_engine(DATABASE_URL)
 
+# Денормализованная выборка каталога с коррелированными подзапросами; {where} — фильтр по beats b.
+# Используется для небольших выборок изменений, полная загрузка идет через stream_catalog
+CATALOG_QUERY = """
+    SELECT 
+        b.id AS beat_id,
+        b.name AS file,
+        b.picture,
+        b.price,
+        b.url,
+
+        -- timestamps как JSON-массив без id
+        COALESCE((
+            SELECT json_agg(json_build_object(
+                'id', t.id,
+                'name', t.name,
+                'time_start', t.time_start,
+                'time_end', t.time_end
+            ))
+            FROM timestamps t
+            WHERE t.beat_id = b.id
+        ), '[]') AS timestamps,
+
+        -- связи по жанрам, тегам, настроениям
+        (SELECT string_agg(bg.genre_id::text, '||') FROM beat_genres bg WHERE bg.beat_id = b.id) AS genre_ids,
+        (SELECT string_agg(bt.tag_id::text, '||') FROM beat_tags bt WHERE bt.beat_id = b.id) AS tag_ids,
+        (SELECT string_agg(bm.mood_id::text, '||') FROM beat_moods bm WHERE bm.beat_id = b.id) AS mood_ids,
+
+        -- аудиофичи
+        mf.crm1, mf.crm2, mf.crm3, mf.crm4, mf.crm5, mf.crm6, mf.crm7, mf.crm8,
+        mf.crm9, mf.crm10, mf.crm11, mf.crm12,
+        mf.mlspc AS melspectrogram,
+        mf.spc AS spectral_centroid,
+        mf.mfcc1, mf.mfcc2, mf.mfcc3, mf.mfcc4, mf.mfcc5, mf.mfcc6, mf.mfcc7, mf.mfcc8,
+        mf.mfcc9, mf.mfcc10, mf.mfcc11, mf.mfcc12, mf.mfcc13, mf.mfcc14, mf.mfcc15,
+        mf.mfcc16, mf.mfcc17, mf.mfcc18, mf.mfcc19, mf.mfcc20, mf.mfcc21, mf.mfcc22,
+        mf.mfcc23, mf.mfcc24, mf.mfcc25, mf.mfcc26, mf.mfcc27, mf.mfcc28, mf.mfcc29,
+        mf.mfcc30, mf.mfcc31, mf.mfcc32, mf.mfcc33, mf.mfcc34, mf.mfcc35, mf.mfcc36,
+        mf.mfcc37, mf.mfcc38, mf.mfcc39, mf.mfcc40, mf.mfcc41, mf.mfcc42, mf.mfcc43,
+        mf.mfcc44, mf.mfcc45, mf.mfcc46, mf.mfcc47, mf.mfcc48, mf.mfcc49, mf.mfcc50
+    FROM beats b
+    LEFT JOIN mfccs mf ON b.id = mf.beat_id
+    {where}
+"""
+
+IDENTIFIER_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+AUDIO_FEATURES = [f'crm{i}' for i in range(1, 13)] + \
+                 [f'mfcc{i}' for i in range(1, 51)] + \
+                 ['melspectrogram', 'spectral_centroid']
+
+
+def watermark_column() -> str:
+    """Колонка beats, по которой отбираются изменения для инкрементального обновления"""
+    if not IDENTIFIER_RE.match(CATALOG_WATERMARK_COLUMN):
+        raise ValueError(f"Invalid watermark column: {CATALOG_WATERMARK_COLUMN!r}")
+    return CATALOG_WATERMARK_COLUMN
+
 
 def safe_str_split(x, sep='||'):
     if not x or pd.isna(x):
@@ -57,54 +120,12 @@ def load_data():
             conn.execute(text("SELECT 1"))
             logger.info("Database connection successful")
 
-        query = text("""
-            SELECT 
-                b.id AS beat_id,
-                b.name AS file,
-                b.picture,
-                b.price,
-                b.url,
-
-                -- timestamps как JSON-массив без id
-                COALESCE((
-                    SELECT json_agg(json_build_object(
-                        'id', t.id,
-                        'name', t.name,
-                        'time_start', t.time_start,
-                        'time_end', t.time_end
-                    ))
-                    FROM timestamps t
-                    WHERE t.beat_id = b.id
-                ), '[]') AS timestamps,
-
-                -- связи по жанрам, тегам, настроениям
-                (SELECT string_agg(bg.genre_id::text, '||') FROM beat_genres bg WHERE bg.beat_id = b.id) AS genre_ids,
-                (SELECT string_agg(bt.tag_id::text, '||') FROM beat_tags bt WHERE bt.beat_id = b.id) AS tag_ids,
-                (SELECT string_agg(bm.mood_id::text, '||') FROM beat_moods bm WHERE bm.beat_id = b.id) AS mood_ids,
-
-                -- аудиофичи
-                mf.crm1, mf.crm2, mf.crm3, mf.crm4, mf.crm5, mf.crm6, mf.crm7, mf.crm8,
-                mf.crm9, mf.crm10, mf.crm11, mf.crm12,
-                mf.mlspc AS melspectrogram,
-                mf.spc AS spectral_centroid,
-                mf.mfcc1, mf.mfcc2, mf.mfcc3, mf.mfcc4, mf.mfcc5, mf.mfcc6, mf.mfcc7, mf.mfcc8,
-                mf.mfcc9, mf.mfcc10, mf.mfcc11, mf.mfcc12, mf.mfcc13, mf.mfcc14, mf.mfcc15,
-                mf.mfcc16, mf.mfcc17, mf.mfcc18, mf.mfcc19, mf.mfcc20, mf.mfcc21, mf.mfcc22,
-                mf.mfcc23, mf.mfcc24, mf.mfcc25, mf.mfcc26, mf.mfcc27, mf.mfcc28, mf.mfcc29,
-                mf.mfcc30, mf.mfcc31, mf.mfcc32, mf.mfcc33, mf.mfcc34, mf.mfcc35, mf.mfcc36,
-                mf.mfcc37, mf.mfcc38, mf.mfcc39, mf.mfcc40, mf.mfcc41, mf.mfcc42, mf.mfcc43,
-                mf.mfcc44, mf.mfcc45, mf.mfcc46, mf.mfcc47, mf.mfcc48, mf.mfcc49, mf.mfcc50
-            FROM beats b
-            LEFT JOIN mfccs mf ON b.id = mf.beat_id
-        """)
-
-        df = pd.read_sql(query, engine)
+            df, feature_matrix, genres, tags, moods = stream_catalog(
+                conn, CATALOG_CHUNK_SIZE, copy_audio=MFCC_COPY)
+
         if df.empty:
             logger.error("Query returned empty dataframe")
             return None, None, None, None, None
-        df['timestamps'] = df['timestamps'].apply(
-            lambda x: json.loads(x) if isinstance(x, str) else x
-        )
 
         # Проверяем наличие id в первом элементе timestamps (для логирования)
         if len(df) > 0 and len(df.iloc[0]['timestamps']) > 0:
@@ -114,31 +135,169 @@ def load_data():
 
         logger.info(f"Loaded {len(df)} records")
 
-        # Обработка жанров, тегов и настроений:
-        for col in ['genre_ids', 'tag_ids', 'mood_ids']:
-            df[col] = df[col].fillna('')
-            # Преобразуем строки '1||3||5' в '1,3,5'
-            df[col] = df[col].apply(lambda x: ','.join(sorted(set(safe_str_split(x, sep='||')))) if x else '')
+        return df, feature_matrix, genres, tags, moods
+
+    except Exception as e:
+        logger.error(f"Error loading data: {str(e)}", exc_info=True)
+        return None, None, None, None, None
 
-        # Получаем one-hot encoding с разделителем ','
-        df_genres = df['genre_ids'].str.get_dummies(sep=',')
-        df_tags = df['tag_ids'].str.get_dummies(sep=',')
-        df_moods = df['mood_ids'].str.get_dummies(sep=',')
 
-        audio_features = [f'crm{i}' for i in range(1, 13)] + \
-                       [f'mfcc{i}' for i in range(1, 51)] + \
-                       ['melspectrogram', 'spectral_centroid']
-        
-        existing_features = [f for f in audio_features if f in df.columns]
-        df[existing_features] = df[existing_features].apply(pd.to_numeric, errors='coerce')
+def prepare_catalog_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Разбор сырых колонок выборки на месте: JSON таймкодов, id категорий '1,3,5', числовые аудиофичи"""
+    df['timestamps'] = df['timestamps'].apply(
+        lambda x: json.loads(x) if isinstance(x, str) else x
+    )
 
-        matrices = [df[existing_features].values] if existing_features else []
-        matrices.extend([df_genres.values, df_tags.values, df_moods.values])
+    # Обработка жанров, тегов и настроений:
+    for col in ['genre_ids', 'tag_ids', 'mood_ids']:
+        df[col] = df[col].fillna('')
+        # Преобразуем строки '1||3||5' в '1,3,5'
+        df[col] = df[col].apply(lambda x: ','.join(sorted(set(safe_str_split(x, sep='||')))) if x else '')
 
-        feature_matrix = SimpleImputer(strategy='mean').fit_transform(np.hstack(matrices))
+    existing_features = [f for f in AUDIO_FEATURES if f in df.columns]
+    df[existing_features] = df[existing_features].apply(pd.to_numeric, errors='coerce')
+    return df
 
-        return df, feature_matrix, df_genres, df_tags, df_moods
 
+def build_feature_blocks(df: pd.DataFrame):
+    """
+    (feature_matrix, genres, tags, moods) по уже разобранному df: плотная матрица аудиофичей
+    и разреженные (CSR) one-hot блоки категорий. В feature_matrix категории не склеиваются,
+    ядро схожести объединяет блоки само
+    """
+    genres = category_matrix(df['genre_ids'])
+    tags = category_matrix(df['tag_ids'])
+    moods = category_matrix(df['mood_ids'])
+
+    existing_features = [f for f in AUDIO_FEATURES if f in df.columns]
+    if existing_features:
+        feature_matrix = SimpleImputer(strategy='mean').fit_transform(df[existing_features].values)
+    else:
+        feature_matrix = np.empty((len(df), 0))
+
+    return feature_matrix, genres, tags, moods
+
+
+def load_watermark():
+    """Текущее значение watermark-колонки каталога (None, если недоступно)"""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(text(f"SELECT max(b.{watermark_column()}) FROM beats b")).scalar()
     except Exception as e:
-        logger.error(f"Error loading data: {str(e)}", exc_info=True)
-        return None, None, None, None, None
+        logger.warning(f"Catalog watermark is unavailable, incremental refresh disabled: {e}")
+        return None
+
+
+def load_catalog_delta(since):
+    """
+    Изменения каталога после watermark since: (разобранные строки добавленных и измененных
+    треков, id всех треков в базе для поиска удаленных, новый watermark) или None при ошибке.
+    Предполагается, что watermark-колонка beats обновляется и при правке связанных
+    таблиц (mfccs, beat_genres, beat_tags, beat_moods, timestamps)
+    """
+    try:
+        column = watermark_column()
+        with engine.connect() as conn:
+            # Сначала фиксируем верхнюю границу, чтобы изменения во время выборки попали в следующий проход
+            until = conn.execute(text(f"SELECT max(b.{column}) FROM beats b")).scalar()
+            alive_ids = [str(x) for x in conn.execute(text("SELECT b.id FROM beats b")).scalars()]
+            if until is None:
+                return pd.DataFrame(), alive_ids, since
+            # Окно перекрытия перечитывается каждый проход, поэтому равенство until и since не повод пропустить выборку
+            query = text(CATALOG_QUERY.format(where=f"WHERE b.{column} > :since AND b.{column} <= :until"))
+            changed = pd.read_sql(query, conn, params={"since": overlap_start(since), "until": until})
+            changed = match_copy_precision(conn, prepare_catalog_frame(changed), MFCC_COPY)
+        return changed, alive_ids, until
+    except Exception as e:
+        logger.error(f"Error loading catalog delta: {e}", exc_info=True)
+        return None
+
+
+def overlap_start(since: Any) -> Any:
+    """
+    Нижняя граница выборки изменений с окном перекрытия: транзакция, закоммиченная после прошлого
+    прохода, может нести watermark меньше уже прочитанного максимума. Окно задается в секундах
+    и применяется к колонкам-временам; числовые watermark-колонки читаются без перекрытия
+    """
+    if isinstance(since, datetime) and CATALOG_REFRESH_OVERLAP_SECONDS > 0:
+        return since - timedelta(seconds=CATALOG_REFRESH_OVERLAP_SECONDS)
+    return since
+
+
+def drop_unchanged_rows(df: pd.DataFrame, changed: pd.DataFrame) -> pd.DataFrame:
+    """
+    Убирает из изменений строки, совпадающие с уже загруженными: окно перекрытия перечитывает
+    последние правки, и без этого каждый проход пересобирал бы каталог без реальных изменений
+    """
+    if changed.empty or df.empty:
+        return changed
+    positions = pd.Series(np.arange(len(df)), index=df['beat_id'].astype(str))
+    positions = positions[~positions.index.duplicated()]
+    known = changed['beat_id'].astype(str).isin(positions.index).to_numpy()
+    if not known.any():
+        return changed
+    current = df.iloc[positions[changed['beat_id'].astype(str)[known]].to_numpy()]
+    same = np.zeros(len(changed), dtype=bool)
+    same[known] = _row_hashes(current) == _row_hashes(changed[known][df.columns])
+    return changed[~same].reset_index(drop=True)
+
+
+def _row_hashes(frame: pd.DataFrame) -> np.ndarray:
+    # Колонки со списками (timestamps) не хэшируются pandas напрямую, поэтому сравниваем строковый вид
+    return pd.util.hash_pandas_object(frame.astype(str), index=False).to_numpy()
+
+
+def merge_catalog_delta(df: pd.DataFrame, changed: pd.DataFrame, alive_ids) -> Tuple[pd.DataFrame, np.ndarray]:
+    """
+    Накладывает изменения на разобранный каталог: строки удаленных треков выкидываются (сжатие),
+    измененные заменяются на своих местах, добавленные дописываются в конец.
+    Возвращает (новый каталог, source): source[row] — строка прежнего каталога, из которой взята
+    строка row, или -1 для измененных и добавленных строк (их нужно разобрать заново)
+    """
+    beat_ids = df['beat_id'].astype(str)
+    take = np.flatnonzero(beat_ids.isin(set(alive_ids)).to_numpy())
+    combined = df
+    if not changed.empty:
+        new_rows = pd.Series(np.arange(len(take)), index=beat_ids.to_numpy()[take])
+        new_rows = new_rows[~new_rows.index.duplicated()]
+        targets = new_rows.reindex(changed['beat_id'].astype(str).to_numpy()).to_numpy()
+        in_place = ~np.isnan(targets)
+        take[targets[in_place].astype(np.int64)] = len(df) + np.flatnonzero(in_place)
+        take = np.concatenate([take, len(df) + np.flatnonzero(~in_place)])
+        combined = pd.concat([df, changed[df.columns]], ignore_index=True)
+    merged = combined.take(take).reset_index(drop=True)
+    return merged, np.where(take < len(df), take, -1)
+
+
+def patch_feature_blocks(df: pd.DataFrame, source: np.ndarray, feature_matrix: np.ndarray,
+                         genres: sparse.csr_matrix, tags: sparse.csr_matrix, moods: sparse.csr_matrix,
+                         vocabularies: Sequence[List[str]]) -> Optional[Tuple[np.ndarray, sparse.csr_matrix,
+                                                                            sparse.csr_matrix, sparse.csr_matrix]]:
+    """
+    (feature_matrix, genres, tags, moods) после merge_catalog_delta без полной сборки: строки прежнего
+    каталога копируются, разбираются только строки с source == -1. Пропуски аудиофичей в них заполняются
+    средними текущей матрицы признаков. None, если нужна полная сборка (сжатие): в изменениях есть
+    категории вне словарей vocabularies, какая-то категория пропала из каталога или матрица признаков
+    не совпадает по колонкам с аудиофичами df
+    """
+    fresh = np.flatnonzero(source < 0)
+    part = df.iloc[fresh]
+    existing_features = [f for f in AUDIO_FEATURES if f in df.columns]
+    if feature_matrix.shape[1] != len(existing_features):
+        return None
+
+    blocks = []
+    for col, block, vocabulary in zip(['genre_ids', 'tag_ids', 'mood_ids'], (genres, tags, moods), vocabularies):
+        names = {name for value in part[col] for name in split_ids(value)}
+        if block.shape[1] != len(vocabulary) or not names.issubset(vocabulary):
+            return None
+        patched = patch_rows(block, source, category_matrix(part[col], vocabulary))
+        if (patched.getnnz(axis=0) == 0).any():
+            return None
+        blocks.append(patched)
+
+    audio = part[existing_features].to_numpy(dtype=np.float64, copy=True)
+    missing = np.isnan(audio)
+    if missing.any():
+        audio[missing] = feature_matrix.mean(axis=0)[np.nonzero(missing)[1]]
+    return (patch_dense_rows(feature_matrix, source, audio), *blocks)
@@ -0,0 +1,165 @@
+import logging
+import uuid
+from typing import Sequence, Tuple
+import numpy as np
+from sqlalchemy import text
+
+try:
+    from psycopg2 import Error as DriverError
+except ImportError:  # без psycopg2 двоичный COPY не используется (см. copy_supported)
+    DriverError = ValueError
+
+logger = logging.getLogger(__name__)
+
+# Колонки таблицы mfccs в порядке AUDIO_COLUMNS выборки каталога
+MFCC_SOURCE_COLUMNS = [f'crm{i}' for i in range(1, 13)] + ['mlspc', 'spc'] + [f'mfcc{i}' for i in range(1, 51)]
+
+# Все значения приводятся к float4 на стороне базы, NULL заменяется на NaN:
+# каждая строка двоичного COPY получается фиксированной длины и разбирается одним np.frombuffer
+MFCC_SELECT_QUERY = "SELECT beat_id, {columns} FROM mfccs".format(
+    columns=", ".join(f"COALESCE({col}::float4, 'NaN'::float4)" for col in MFCC_SOURCE_COLUMNS)
+)
+MFCC_COPY_QUERY = f"COPY ({MFCC_SELECT_QUERY}) TO STDOUT (FORMAT binary)"
+
+# Ошибки двоичного COPY, после которых аудиофичи перечитываются обычной выборкой:
+# неожиданный формат потока (ValueError декодера) и ошибки драйвера из copy_expert
+COPY_ERRORS = (ValueError, DriverError)
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+COPY_TRAILER = b"\xff\xff"
+# Строка: число полей (int16), затем по каждому полю длина (int32) и значение; все в big-endian
+MFCC_RECORD_DTYPE = np.dtype([
+    ("fields", ">i2"),
+    ("id_length", ">i4"),
+    ("id", "S16"),
+    ("values", [("length", ">i4"), ("value", ">f4")], (len(MFCC_SOURCE_COLUMNS),)),
+])
+
+
+class BinaryCopyDecoder:
+    """
+    Приемник потока COPY ... TO STDOUT (FORMAT binary) для copy_expert: байты копятся
+    до drain_bytes и разбираются пачками сразу в предвыделенные буферы id (S16) и значений (float32)
+    """
+
+    def __init__(self, capacity: int, drain_bytes: int = 1 << 20):
+        capacity = max(capacity, 1)
+        self.ids = np.empty(capacity, dtype="S16")
+        self.values = np.empty((capacity, len(MFCC_SOURCE_COLUMNS)), dtype=np.float32)
+        self.size = 0
+        self.drain_bytes = drain_bytes
+        self._pending = bytearray()
+        self._header_read = False
+
+    def write(self, data) -> int:
+        self._pending += data
+        if len(self._pending) >= self.drain_bytes:
+            self._drain()
+        return len(data)
+
+    def _read_header(self) -> bool:
+        pending = self._pending
+        if len(pending) < 19:
+            return False
+        if bytes(pending[:11]) != COPY_SIGNATURE:
+            raise ValueError("Unexpected COPY binary signature")
+        extension = int.from_bytes(pending[15:19], "big")
+        if len(pending) < 19 + extension:
+            return False
+        del pending[:19 + extension]
+        self._header_read = True
+        return True
+
+    def _reserve(self, needed: int):
+        if needed > len(self.ids):
+            capacity = max(needed, len(self.ids) * 2)
+            self.ids = np.resize(self.ids, capacity)
+            self.values = np.resize(self.values, (capacity, self.values.shape[1]))
+
+    def _drain(self):
+        if not self._header_read and not self._read_header():
+            return
+        count = len(self._pending) // MFCC_RECORD_DTYPE.itemsize
+        if count == 0:
+            return
+        records = np.frombuffer(self._pending, dtype=MFCC_RECORD_DTYPE, count=count)
+        if (records["fields"] != len(MFCC_SOURCE_COLUMNS) + 1).any() or (records["id_length"] != 16).any() \
+                or (records["values"]["length"] != 4).any():
+            raise ValueError("Unexpected COPY binary row layout")
+        start, stop = self.size, self.size + count
+        self._reserve(stop)
+        self.ids[start:stop] = records["id"]
+        self.values[start:stop] = records["values"]["value"]
+        self.size = stop
+        # Буфер bytearray нельзя сжать, пока на него ссылается массив
+        del records
+        del self._pending[:count * MFCC_RECORD_DTYPE.itemsize]
+
+    def finish(self) -> Tuple[np.ndarray, np.ndarray]:
+        """(id треков в 16-байтовом виде, значения float32) всех прочитанных строк"""
+        self._drain()
+        if bytes(self._pending) != COPY_TRAILER:
+            raise ValueError("Truncated COPY binary stream")
+        return self.ids[:self.size], self.values[:self.size]
+
+
+def align_to_beats(ids: np.ndarray, values: np.ndarray, beat_ids: Sequence[str]) -> np.ndarray:
+    """Строки значений в порядке beat_ids; треки без строки в mfccs получают NaN (как LEFT JOIN)"""
+    aligned = np.full((len(beat_ids), values.shape[1]), np.nan, dtype=np.float32)
+    if len(ids) == 0 or len(beat_ids) == 0:
+        return aligned
+    keys = np.array([uuid.UUID(str(beat_id)).bytes for beat_id in beat_ids], dtype="S16")
+    order = np.argsort(ids, kind="stable")
+    sorted_ids = ids[order]
+    positions = np.minimum(np.searchsorted(sorted_ids, keys), len(sorted_ids) - 1)
+    found = sorted_ids[positions] == keys
+    aligned[found] = values[order[positions[found]]]
+    return aligned
+
+
+def copy_supported(conn) -> bool:
+    """Двоичный COPY читается через cursor.copy_expert, который есть только у psycopg2"""
+    return conn.dialect.driver == "psycopg2"
+
+
+def copy_mfcc_features(conn, beat_ids: Sequence[str], read_size: int = 1 << 16) -> np.ndarray:
+    """Аудиофичи всех треков beat_ids из mfccs через двоичный COPY, минуя объекты строк SQLAlchemy"""
+    capacity = conn.execute(text("SELECT count(*) FROM mfccs")).scalar() or 0
+    decoder = BinaryCopyDecoder(capacity)
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.copy_expert(MFCC_COPY_QUERY, decoder, size=read_size)
+    finally:
+        cursor.close()
+    ids, values = decoder.finish()
+    logger.info(f"Copied {len(ids)} mfcc rows")
+    return align_to_beats(ids, values, beat_ids)
+
+
+def select_mfcc_features(conn, beat_ids: Sequence[str], chunk_size: int) -> np.ndarray:
+    """
+    Те же аудиофичи обычной выборкой из mfccs по chunk_size строк — запасной путь, если COPY не удался.
+    Значения так же приводятся к float4, поэтому совпадают с результатом copy_mfcc_features
+    """
+    result = conn.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(text(MFCC_SELECT_QUERY))
+    id_parts, value_parts = [], []
+    for rows in result.partitions(chunk_size):
+        id_parts.append(np.array([uuid.UUID(str(row[0])).bytes for row in rows], dtype="S16"))
+        value_parts.append(np.array([row[1:] for row in rows], dtype=np.float32))
+    ids = np.concatenate(id_parts) if id_parts else np.empty(0, dtype="S16")
+    values = np.concatenate(value_parts) if value_parts else np.empty((0, len(MFCC_SOURCE_COLUMNS)), dtype=np.float32)
+    logger.info(f"Selected {len(ids)} mfcc rows")
+    return align_to_beats(ids, values, beat_ids)
+
+
+def reset_connection(conn):
+    """
+    Откат транзакции после прерванного COPY. Если соединение после ошибки драйвера
+    непригодно и откат не проходит, оно инвалидируется: следующий запрос возьмет новое из пула
+    """
+    try:
+        conn.rollback()
+    except Exception as e:
+        logger.warning(f"Rollback after failed COPY failed, reopening the connection: {e}")
+        conn.invalidate()
+        conn.rollback()
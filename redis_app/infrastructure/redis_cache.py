@@ -1,28 +1,142 @@
 import redis
-import json
+import uuid
 from datetime import timedelta
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+
+# Запись о соседе: UUID трека (16 байт) и скор (float32) — 20 байт вместо полного JSON трека
+NEIGHBOUR_DTYPE = np.dtype([("id", "S16"), ("score", "<f4")])
+
+# Снимаем блокировку, только если она все еще наша (могла истечь и достаться другому процессу)
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def encode_neighbours(beat_ids: Sequence[str], scores: Sequence[float]) -> bytes:
+    """Ранжированный список соседей в компактное бинарное значение для Redis"""
+    entries = np.empty(len(beat_ids), dtype=NEIGHBOUR_DTYPE)
+    entries["id"] = [uuid.UUID(str(b)).bytes for b in beat_ids]
+    entries["score"] = scores
+    return entries.tobytes()
+
+
+def decode_neighbours(value: bytes) -> Tuple[List[str], np.ndarray]:
+    """Обратное к encode_neighbours: (beat_id в строковом виде UUID, скоры) в порядке ранжирования"""
+    entries = np.frombuffer(value, dtype=NEIGHBOUR_DTYPE)
+    # np.frombuffer обрезает завершающие нулевые байты у S16, поэтому дополняем до 16
+    beat_ids = [str(uuid.UUID(bytes=raw.ljust(16, b"\0"))) for raw in entries["id"]]
+    return beat_ids, entries["score"].astype(np.float32)
+
 
 class RedisCache:
+    """
+    Кэш похожих треков в Redis. Хранятся только id соседей и скоры в бинарном виде,
+    данные треков подставляются из каталога в памяти при ответе
+    """
     def __init__(self):
         self.r = redis.Redis(
             host='localhost',
             port=6379,
             db=0,
-            decode_responses=True
+            decode_responses=False
         )
         self.default_ttl = timedelta(weeks=1)
 
-    def get_similar_tracks(self, track_id):
-        key = f"similar_tracks:{track_id}"
-        cached_data = self.r.get(key)
-        return json.loads(cached_data) if cached_data else None
+    @staticmethod
+    def key(track_id, version: Optional[str] = None) -> str:
+        """Ключ записи в пространстве имен версии данных каталога"""
+        return f"similar_ids:{version}:{track_id}" if version else f"similar_ids:{track_id}"
+
+    def get_similar_tracks(self, track_id, version: Optional[str] = None) -> Optional[Tuple[List[str], np.ndarray]]:
+        cached_data = self.r.get(self.key(track_id, version))
+        return decode_neighbours(cached_data) if cached_data else None
+
+    def get_many_similar_tracks(self, track_ids: Sequence[str],
+                                version: Optional[str] = None) -> List[Optional[Tuple[List[str], np.ndarray]]]:
+        """Записи для нескольких треков одним MGET (None для отсутствующих)"""
+        if not track_ids:
+            return []
+        values = self.r.mget([self.key(track_id, version) for track_id in track_ids])
+        return [decode_neighbours(value) if value else None for value in values]
+
+    def set_similar_tracks(self, track_id, beat_ids: Sequence[str], scores: Sequence[float],
+                           version: Optional[str] = None):
+        self.r.setex(name=self.key(track_id, version), time=self.default_ttl,
+                     value=encode_neighbours(beat_ids, scores))
+
+    def set_many_similar_tracks(self, items: Iterable[Tuple[str, Sequence[str], Sequence[float]]],
+                                version: Optional[str] = None, batch_size: int = 1000):
+        """Массовая запись (track_id, beat_ids, scores) пачками через pipeline"""
+        items = list(items)
+        for start in range(0, len(items), batch_size):
+            pipe = self.r.pipeline(transaction=False)
+            for track_id, beat_ids, scores in items[start:start + batch_size]:
+                pipe.setex(name=self.key(track_id, version), time=self.default_ttl,
+                           value=encode_neighbours(beat_ids, scores))
+            pipe.execute()
+
+    def scan_track_ids(self, version: str, batch_size: int = 1000) -> Iterator[List[str]]:
+        """track_id всех записей пространства имен версии, пачками (SCAN, без блокировки Redis)"""
+        prefix = self.key("", version)
+        batch = []
+        for key in self.r.scan_iter(match=f"{prefix}*", count=batch_size):
+            key = key.decode("utf-8") if isinstance(key, bytes) else key
+            batch.append(key[len(prefix):])
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def get_many_raw(self, track_ids: Sequence[str], version: str) -> List[Tuple[Optional[bytes], int]]:
+        """(значение, оставшийся TTL в мс) для нескольких записей одним pipeline"""
+        pipe = self.r.pipeline(transaction=False)
+        for track_id in track_ids:
+            key = self.key(track_id, version)
+            pipe.get(key)
+            pipe.pttl(key)
+        values = pipe.execute()
+        return list(zip(values[0::2], values[1::2]))
+
+    def move_entries(self, entries: Iterable[Tuple[str, bytes, int]], old_version: str, new_version: str):
+        """Переносит записи (track_id, значение, TTL в мс) в новое пространство имен, сохраняя TTL"""
+        pipe = self.r.pipeline(transaction=False)
+        for track_id, value, ttl_ms in entries:
+            if ttl_ms > 0:
+                pipe.psetex(self.key(track_id, new_version), ttl_ms, value)
+            pipe.unlink(self.key(track_id, old_version))
+        pipe.execute()
+
+    def delete_entries(self, track_ids: Sequence[str], version: str):
+        if track_ids:
+            self.r.unlink(*[self.key(track_id, version) for track_id in track_ids])
+
+    def acquire_lock(self, name: str, ttl_ms: int) -> Optional[str]:
+        """Короткая блокировка между процессами (SET NX PX); токен владельца или None, если занята"""
+        token = uuid.uuid4().hex
+        if self.r.set(f"lock:{name}", token, nx=True, px=ttl_ms):
+            return token
+        return None
+
+    def release_lock(self, name: str, token: str):
+        self.r.eval(RELEASE_LOCK_SCRIPT, 1, f"lock:{name}", token)
+
+    def lock_held(self, name: str) -> bool:
+        return bool(self.r.exists(f"lock:{name}"))
 
-    def set_similar_tracks(self, track_id, data):
-        key = f"similar_tracks:{track_id}"
-        self.r.setex(name=key, time=self.default_ttl, value=json.dumps(data))
+    def locks_held(self, names: Sequence[str]) -> List[bool]:
+        """lock_held для нескольких блокировок одним pipeline"""
+        pipe = self.r.pipeline(transaction=False)
+        for name in names:
+            pipe.exists(f"lock:{name}")
+        return [bool(held) for held in pipe.execute()]
 
     # def delete_similar_tracks(self, track_id):
-    #     key = f"similar_tracks:{track_id}"
+    #     key = self.key(track_id)
     #     self.r.delete(key)
 
 # Экземпляр класса RedisCache
@@ -0,0 +1,92 @@
+from threading import Lock
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import logging
+import sys
+import numpy as np
+import services.globals as globals
+from config import L1_CACHE_MAX_ENTRIES, L1_CACHE_MAX_BYTES, L1_CACHE_TTL_SECONDS
+from infrastructure.local_cache import LocalCache
+from infrastructure.redis_cache import RedisCache, redis_cache
+
+logger = logging.getLogger(__name__)
+
+Neighbours = Tuple[List[str], np.ndarray]
+
+
+def _nbytes(beat_ids: Sequence[str], scores: np.ndarray) -> int:
+    return sum(sys.getsizeof(b) for b in beat_ids) + scores.nbytes + sys.getsizeof(beat_ids)
+
+
+class SimilarTracksCache:
+    """
+    Двухуровневый кэш похожих треков: L1 в памяти процесса (LocalCache) перед Redis.
+    Оба уровня работают в пространстве имен версии данных каталога globals.dataset_version
+    (update_dataset): при смене версии L1 сбрасывается, а ключи Redis меняются
+    (записи прошлой версии переносит services/cache_migration.py). Попадания и промахи
+    считаются по каждому уровню
+    """
+
+    def __init__(self, remote: RedisCache = redis_cache, local: Optional[LocalCache] = None):
+        self.remote = remote
+        self.local = local or LocalCache(L1_CACHE_MAX_ENTRIES, L1_CACHE_MAX_BYTES, L1_CACHE_TTL_SECONDS)
+        self._lock = Lock()
+        self.redis_hits = 0
+        self.redis_misses = 0
+
+    def get(self, track_id: str) -> Optional[Neighbours]:
+        version = globals.dataset_version
+        cached = self.local.get(track_id, version)
+        if cached is not None:
+            return cached
+
+        cached = self.remote.get_similar_tracks(track_id, version)
+        with self._lock:
+            if cached is None:
+                self.redis_misses += 1
+                return None
+            self.redis_hits += 1
+        self.local.set(track_id, version, cached, _nbytes(*cached))
+        return cached
+
+    def get_many(self, track_ids: Sequence[str]) -> Dict[str, Neighbours]:
+        """Найденные записи для нескольких треков: сначала L1, остальные одним MGET из Redis"""
+        version = globals.dataset_version
+        found: Dict[str, Neighbours] = {}
+        missing = []
+        for track_id in track_ids:
+            cached = self.local.get(track_id, version)
+            if cached is not None:
+                found[track_id] = cached
+            else:
+                missing.append(track_id)
+
+        remote = self.remote.get_many_similar_tracks(missing, version)
+        hits = 0
+        for track_id, cached in zip(missing, remote):
+            if cached is not None:
+                hits += 1
+                found[track_id] = cached
+                self.local.set(track_id, version, cached, _nbytes(*cached))
+        with self._lock:
+            self.redis_hits += hits
+            self.redis_misses += len(missing) - hits
+        return found
+
+    def set(self, track_id: str, beat_ids: Sequence[str], scores: Sequence[float],
+            version: Optional[str] = None):
+        """Запись результата, посчитанного на каталоге версии version (по умолчанию текущей)"""
+        version = version or globals.dataset_version
+        scores = np.asarray(scores, dtype=np.float32)
+        beat_ids = list(beat_ids)
+        # Результат, досчитанный после перезагрузки на старом каталоге, в L1 не кладем
+        if version == globals.dataset_version:
+            self.local.set(track_id, version, (beat_ids, scores), _nbytes(beat_ids, scores))
+        self.remote.set_similar_tracks(track_id, beat_ids, scores, version)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            redis_stats = {"hits": self.redis_hits, "misses": self.redis_misses}
+        return {"l1": self.local.stats(), "redis": redis_stats}
+
+
+similar_tracks_cache = SimilarTracksCache()
@@ -0,0 +1,67 @@
+from threading import Event, Lock
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Схлопывание одновременных запросов по ключу: пока для ключа идет вычисление,
+    остальные потоки с тем же ключом ждут и получают его результат (или его исключение)
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = Lock()
+
+    def claim(self, key: Hashable) -> Tuple[bool, _Call]:
+        """
+        Регистрирует вычисление по ключу: (True, вызов), если вычислять должен этот поток
+        (тогда он обязан вызвать resolve), иначе (False, уже идущий вызов) — его ждут через wait
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return False, call
+            call = self._calls[key] = _Call()
+            return True, call
+
+    def resolve(self, key: Hashable, call: _Call, result: Any = None, error: Optional[BaseException] = None):
+        """Публикует результат (или исключение) вычисления и будит ждущих"""
+        call.result = result
+        call.error = error
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.done.set()
+
+    @staticmethod
+    def wait(call: _Call) -> Any:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        leader, call = self.claim(key)
+        if not leader:
+            return self.wait(call)
+
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self.resolve(key, call, error=e)
+            raise
+        self.resolve(key, call, result)
+        return result
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,12 @@
+import os
+
+# Файл-указатель на актуальную версию в каталоге версий (снимки каталога, таблицы соседей)
+CURRENT_FILE = "CURRENT"
+
+
+def write_current(root: str, version: str):
+    """Атомарно переключает указатель на готовую версию"""
+    tmp_path = os.path.join(root, CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(root, CURRENT_FILE))
@@ -0,0 +1,174 @@
+"""
+Офлайн-расчет top-K похожих треков для всего каталога.
+
+Ядро схожести каталога (SimilarityKernel: плотный блок аудио и разреженные блоки категорий)
+умножается само на себя блоками строк в пуле процессов; для каждой строки остаются K лучших соседей без самого трека.
+Результат — версия таблицы соседей в --output (ids.npy int32, scores.npy float16, beat_ids.npy,
+row_hashes.npy, meta.json) и атомарное переключение указателя CURRENT. Сервис читает таблицу через
+services/neighbour_table.py (NEIGHBOUR_TABLE_DIR). С --redis id и скоры --redis-top-n
+соседей дополнительно заливаются в Redis pipeline-ом.
+
+    cd redis_app && python precompute_neighbours.py --output /data/neighbours --k 50 --workers 8
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+import numpy as np
+from services.similarity_kernel import SimilarityKernel
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WEIGHTS = (0.2, 0.3, 0.3, 0.2)  # как в find_similar_tracks
+
+_kernel = None
+_weights = None
+_ids = None
+_scores = None
+_k = 0
+
+
+def _init_worker(kernel_paths: dict, blocks, ids_path: str, scores_path: str, weights: np.ndarray, k: int):
+    """Каждый процесс открывает массивы ядра и выходные таблицы через mmap, без копирования"""
+    global _kernel, _weights, _ids, _scores, _k
+    _kernel = SimilarityKernel.from_arrays({name: np.load(p, mmap_mode="r") for name, p in kernel_paths.items()},
+                                           blocks)
+    _ids = np.load(ids_path, mmap_mode="r+")
+    _scores = np.load(scores_path, mmap_mode="r+")
+    _weights = weights
+    _k = k
+
+
+def _process_block(bounds):
+    start, end = bounds
+    sims = _kernel.dot((_kernel.rows(slice(start, end)) * _weights).T).T
+    sims[np.arange(end - start), np.arange(start, end)] = -np.inf
+
+    top = np.argpartition(-sims, _k - 1, axis=1)[:, :_k]
+    top_scores = np.take_along_axis(sims, top, axis=1)
+    # По убыванию скора, при равенстве — по возрастанию строки, как в top_k
+    order = np.lexsort((top, -top_scores))
+    _ids[start:end] = np.take_along_axis(top, order, axis=1)
+    _scores[start:end] = np.take_along_axis(top_scores, order, axis=1)
+    _ids.flush()
+    _scores.flush()
+    return end - start
+
+
+def weight_vector(blocks, weights) -> np.ndarray:
+    """Вес каждого столбца склеенной матрицы по весам блоков"""
+    vector = np.empty(blocks[-1][1], dtype=np.float32)
+    for (start, end), weight in zip(blocks, weights):
+        vector[start:end] = weight
+    return vector
+
+
+def compute_neighbours(kernel: SimilarityKernel, weights, k: int, path: str,
+                       workers: int, block_size: int = 0):
+    """Считает таблицу соседей в каталог path (ids.npy, scores.npy)"""
+    n_rows = len(kernel)
+    k = min(k, n_rows - 1)
+    # По умолчанию блок строк такой, чтобы матрица скоров блока занимала ~256 МБ
+    block_size = block_size or max(1, (64 * 1024 * 1024) // n_rows)
+
+    kernel_paths = {name: os.path.join(path, f"kernel_{name}.npy") for name in kernel.arrays()}
+    ids_path = os.path.join(path, "ids.npy")
+    scores_path = os.path.join(path, "scores.npy")
+    for name, array in kernel.arrays().items():
+        np.save(kernel_paths[name], array)
+    np.lib.format.open_memmap(ids_path, mode="w+", dtype=np.int32, shape=(n_rows, k)).flush()
+    np.lib.format.open_memmap(scores_path, mode="w+", dtype=np.float16, shape=(n_rows, k)).flush()
+
+    bounds = [(start, min(start + block_size, n_rows)) for start in range(0, n_rows, block_size)]
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(kernel_paths, kernel.blocks, ids_path, scores_path,
+                                       weight_vector(kernel.blocks, weights), k)) as pool:
+        for rows in pool.map(_process_block, bounds):
+            done += rows
+            logger.debug(f"Neighbours computed for {done}/{n_rows} tracks")
+
+    for kernel_path in kernel_paths.values():
+        os.remove(kernel_path)
+    return k
+
+
+def load_to_redis(index, ids: np.ndarray, scores: np.ndarray, top_n: int, batch_size: int):
+    """Заливает top_n соседей каждого трека (id и скоры) в Redis пачками через pipeline"""
+    from infrastructure.redis_cache import redis_cache
+
+    beat_ids = index.beat_ids
+    batch = []
+    for row, beat_id in enumerate(beat_ids):
+        neighbours = ids[row, :top_n]
+        batch.append((beat_id, [beat_ids[n] for n in neighbours], scores[row, :top_n]))
+        if len(batch) >= batch_size:
+            redis_cache.set_many_similar_tracks(batch, index.content_version, batch_size)
+            batch = []
+    if batch:
+        redis_cache.set_many_similar_tracks(batch, index.content_version, batch_size)
+
+
+def remove_old_versions(root: str, keep: int):
+    versions = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+    for version in versions[:-keep]:
+        shutil.rmtree(os.path.join(root, version), ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", required=True, help="каталог с версиями таблицы соседей")
+    parser.add_argument("--k", type=int, default=50)
+    parser.add_argument("--weights", type=float, nargs=4, default=list(DEFAULT_WEIGHTS),
+                        metavar=("MFCC", "GENRE", "TAG", "MOOD"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--block-size", type=int, default=0, help="строк на задачу (0 — автоматически)")
+    parser.add_argument("--keep", type=int, default=2, help="сколько версий хранить")
+    parser.add_argument("--redis", action="store_true", help="залить результаты в Redis")
+    parser.add_argument("--redis-top-n", type=int, default=10)
+    parser.add_argument("--redis-batch", type=int, default=1000)
+    args = parser.parse_args()
+
+    from infrastructure.data_loader import load_data
+    from services.catalog_index import build_catalog_index
+    from infrastructure.version_pointer import write_current
+    from services.neighbour_table import META_FILE
+
+    df, features, genres, tags, moods = load_data()
+    if df is None:
+        raise SystemExit("Failed to load dataset")
+    index = build_catalog_index(df, features, genres, tags, moods)
+    if len(index) < 2:
+        raise SystemExit("Catalog is too small")
+
+    version = datetime.now().strftime("%Y%m%d%H%M%S")
+    path = os.path.join(args.output, version)
+    os.makedirs(path, exist_ok=True)
+
+    started = time.perf_counter()
+    k = compute_neighbours(index.kernel, args.weights, args.k, path, args.workers, args.block_size)
+    np.save(os.path.join(path, "beat_ids.npy"), np.array(index.beat_ids, dtype=str))
+    # По beat_id и хэшам строк сервис переводит таблицу на следующие версии каталога
+    np.save(os.path.join(path, "row_hashes.npy"), index.row_hashes)
+    with open(os.path.join(path, META_FILE), "w") as f:
+        json.dump({"k": k, "weights": args.weights, "rows": len(index),
+                   "content_version": index.content_version, "created_at": version}, f)
+    write_current(args.output, version)
+    logger.info(f"Neighbour table {path}: {len(index)} tracks, k={k}, {time.perf_counter() - started:.1f}s")
+
+    if args.redis:
+        ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+        scores = np.load(os.path.join(path, "scores.npy"), mmap_mode="r")
+        load_to_redis(index, ids, scores, min(args.redis_top_n, k), args.redis_batch)
+        logger.info("Neighbours loaded to Redis")
+
+    remove_old_versions(args.output, args.keep)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    main()
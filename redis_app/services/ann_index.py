@@ -0,0 +1,139 @@
+from typing import Optional, Tuple
+import logging
+import numpy as np
+from scipy import sparse
+from services.ranking import top_k
+from services.similarity_kernel import SimilarityKernel
+
+logger = logging.getLogger(__name__)
+
+
+def _assign(kernel: SimilarityKernel, centroids: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    """Номер ближайшего (по скалярному произведению) центроида для каждой строки ядра, по кускам"""
+    labels = np.empty(len(kernel), dtype=np.int32)
+    for start in range(0, len(kernel), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        labels[chunk] = np.argmax(kernel.dot(centroids.T, rows=chunk), axis=1)
+    return labels
+
+
+def spherical_kmeans(kernel: SimilarityKernel, n_clusters: int, n_iter: int = 10,
+                     sample_size: int = 64, seed: int = 0) -> np.ndarray:
+    """
+    k-means на единичной сфере (назначение по скалярному произведению, центроиды нормируются).
+    Обучается на случайной подвыборке из sample_size строк на кластер; центроиды плотные
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = len(kernel)
+    sample = kernel.take(np.sort(rng.choice(n_rows, min(n_rows, n_clusters * sample_size), replace=False)))
+    centroids = sample.rows(rng.choice(len(sample), n_clusters, replace=False))
+
+    for _ in range(n_iter):
+        labels = _assign(sample, centroids)
+        counts = np.bincount(labels, minlength=n_clusters)
+
+        # Суммы строк по кластерам: разреженная матрица принадлежности (кластер x строка) на строки подвыборки
+        membership = sparse.csr_matrix((np.ones(len(labels), dtype=np.float32), (labels, np.arange(len(labels)))),
+                                       shape=(n_clusters, len(sample)))
+        sums = np.hstack([membership @ sample.dense, (membership @ sample.sparse).toarray()])
+
+        # Пустые кластеры переинициализируются случайными строками подвыборки
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = sample.rows(rng.choice(len(sample), len(empty), replace=False))
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = np.divide(sums, norms, out=np.zeros_like(sums), where=norms > 0)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Инвертированный индекс (IVF) поверх строк ядра схожести каталога.
+    Строки разбиты на кластеры k-means; запрос просматривает только nprobe кластеров
+    с наибольшим скалярным произведением центроида и вектора запроса, и точные скоры
+    считаются только для треков этих кластеров. nprobe — компромисс между полнотой и скоростью.
+    vocabulary — ключ словарей категорий (CatalogIndex.vocabulary_key), на которых обучены центроиды:
+    колонки категорий ядра идут в порядке словаря, и при другом словаре центроиды к ним не подходят
+    """
+    __slots__ = ("centroids", "list_offsets", "list_rows", "nprobe", "vocabulary")
+
+    def __init__(self, centroids: np.ndarray, labels: np.ndarray, nprobe: int, vocabulary: Optional[str] = None):
+        self.centroids = centroids
+        self.nprobe = nprobe
+        self.vocabulary = vocabulary
+        # Строки, отсортированные по кластеру: кластер c — list_rows[list_offsets[c]:list_offsets[c + 1]]
+        self.list_rows = np.argsort(labels, kind='stable').astype(np.int64)
+        self.list_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=len(centroids)), out=self.list_offsets[1:])
+
+    @classmethod
+    def from_lists(cls, centroids: np.ndarray, list_offsets: np.ndarray, list_rows: np.ndarray,
+                   nprobe: int, vocabulary: Optional[str] = None) -> "IVFIndex":
+        """Индекс из уже разложенных по кластерам строк (например, из снимка каталога)"""
+        index = cls.__new__(cls)
+        index.centroids = centroids
+        index.list_offsets = list_offsets
+        index.list_rows = list_rows
+        index.nprobe = nprobe
+        index.vocabulary = vocabulary
+        return index
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    def candidates(self, query: np.ndarray, nprobe: Optional[int] = None) -> np.ndarray:
+        """Строки каталога из nprobe ближайших к запросу кластеров"""
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        probes = top_k(self.centroids @ query, nprobe)
+        return np.concatenate([
+            self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probes
+        ])
+
+    def search(self, kernel: SimilarityKernel, query: np.ndarray, k: int, exclude_row: Optional[int] = None,
+               nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Приближенный top-k строк ядра по скалярному произведению с query: (строки, скоры)"""
+        rows = np.sort(self.candidates(query, nprobe))
+        scores = kernel.dot(query, rows=rows)
+        exclude = np.flatnonzero(rows == exclude_row) if exclude_row is not None else None
+        selected = top_k(scores, k, exclude=exclude)
+        return rows[selected], scores[selected]
+
+
+def build_ivf_index(kernel: SimilarityKernel, nlist: int = 0, nprobe: int = 8, seed: int = 0,
+                    vocabulary: Optional[str] = None) -> IVFIndex:
+    """Строит IVF-индекс; nlist=0 — 4 * sqrt(N) кластеров"""
+    n_rows = len(kernel)
+    nlist = nlist or int(4 * np.sqrt(n_rows))
+    nlist = max(1, min(nlist, n_rows))
+    logger.info(f"Building IVF index: {n_rows} rows, nlist={nlist}, nprobe={nprobe}")
+    centroids = spherical_kmeans(kernel, nlist, seed=seed)
+    return IVFIndex(centroids, _assign(kernel, centroids), nprobe, vocabulary)
+
+
+def reassign_ivf_index(ann: IVFIndex, kernel: SimilarityKernel, vocabulary: Optional[str] = None) -> Optional[IVFIndex]:
+    """
+    IVF-индекс для обновленного ядра с прежними центроидами: строки только перераспределяются
+    по кластерам без k-means. None, если изменились размерность признаков или словари категорий
+    (одинаковая ширина не гарантирует тот же смысл колонок) и нужна полная сборка
+    """
+    if ann.centroids.shape[1] != kernel.width or ann.vocabulary is None or ann.vocabulary != vocabulary:
+        return None
+    return IVFIndex(ann.centroids, _assign(kernel, ann.centroids), ann.nprobe, vocabulary)
+
+
+def patch_ivf_index(ann: IVFIndex, source: np.ndarray, kernel: SimilarityKernel) -> IVFIndex:
+    """
+    IVF-индекс после инкрементального обновления каталога: строки с source[row] >= 0 остаются
+    в своих кластерах, по центроидам распределяются только измененные и новые строки (source == -1)
+    """
+    labels = np.empty(int(ann.list_offsets[-1]), dtype=np.int64)
+    labels[ann.list_rows] = np.repeat(np.arange(ann.nlist), np.diff(ann.list_offsets))
+    patched = np.empty(len(source), dtype=np.int64)
+    kept = source >= 0
+    patched[kept] = labels[source[kept]]
+    fresh = np.flatnonzero(~kept)
+    if len(fresh):
+        patched[fresh] = _assign(kernel.take(fresh), ann.centroids)
+    return IVFIndex(ann.centroids, patched, ann.nprobe, ann.vocabulary)
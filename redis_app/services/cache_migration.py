@@ -0,0 +1,129 @@
+from typing import List, Sequence, Set, Tuple
+import logging
+import numpy as np
+from infrastructure.redis_cache import RedisCache, decode_neighbours, redis_cache
+from services.catalog_index import CatalogIndex
+from services.ranking import top_k
+from services.similarity_kernel import DEFAULT_WEIGHTS
+from config import BATCH_CHUNK_SIZE, CACHE_MIGRATION_LOCK_TTL_MS
+
+logger = logging.getLogger(__name__)
+
+DELTA_CHUNK_SIZE = 8192
+
+
+def diff_catalogs(old: CatalogIndex, new: CatalogIndex) -> Tuple[Set[str], Set[str], np.ndarray]:
+    """
+    Разница каталогов по хэшам содержимого строк:
+    (удаленные beat_id, измененные beat_id, строки нового каталога с новыми и измененными треками)
+    """
+    changed: Set[str] = set()
+    delta_rows: List[int] = []
+    for beat_id, row in new.row_of.items():
+        old_row = old.row_of.get(beat_id)
+        if old_row is None:
+            delta_rows.append(row)
+        elif old.row_hashes[old_row] != new.row_hashes[row]:
+            changed.add(beat_id)
+            delta_rows.append(row)
+    removed = {beat_id for beat_id in old.row_of if beat_id not in new.row_of}
+    return removed, changed, np.array(sorted(delta_rows), dtype=np.int64)
+
+
+def _weighted_queries(index: CatalogIndex, rows: Sequence[int], weights: Sequence[float]) -> np.ndarray:
+    return np.stack([index.kernel.query(row, weights) for row in rows])
+
+
+def beats_delta_max(index: CatalogIndex, rows: Sequence[int], delta_rows: np.ndarray,
+                    weights: Sequence[float]) -> np.ndarray:
+    """Для каждой строки rows — максимальный скор среди новых и измененных треков delta_rows"""
+    best = np.full(len(rows), -np.inf, dtype=np.float32)
+    if len(rows) == 0 or len(delta_rows) == 0:
+        return best
+    queries = _weighted_queries(index, rows, weights)
+    for start in range(0, len(delta_rows), DELTA_CHUNK_SIZE):
+        chunk = delta_rows[start:start + DELTA_CHUNK_SIZE]
+        best = np.maximum(best, index.kernel.dot(queries.T, rows=chunk).max(axis=0))
+    return best
+
+
+def migrate_similar_tracks_cache(old: CatalogIndex, new: CatalogIndex,
+                                 weights: Sequence[float] = DEFAULT_WEIGHTS,
+                                 cache: RedisCache = redis_cache, batch_size: int = 500):
+    """
+    Переносит записи кэша похожих треков из пространства имен старой версии каталога в новое.
+    Пересчитываются только записи, соседство которых могло измениться: сам трек изменился,
+    среди соседей есть удаленные или измененные треки, или новый/измененный трек набирает
+    больше скора K-го соседа записи. Остальные записи переносятся как есть с прежним TTL.
+    Записи удаленных треков удаляются. Небольшой дрейф скоров неизмененных треков
+    из-за глобальной импутации средними после перезагрузки не учитывается.
+    Переход между парой версий переносит один процесс — тот, кто взял блокировку в Redis
+    """
+    if old is None or old.content_version == new.content_version:
+        return
+
+    lock_name = f"migrate:{old.content_version}:{new.content_version}"
+    token = cache.acquire_lock(lock_name, CACHE_MIGRATION_LOCK_TTL_MS)
+    if token is None:
+        logger.info(f"Cache migration {old.content_version} -> {new.content_version} is run by another process")
+        return
+    try:
+        _migrate(old, new, weights, cache, batch_size)
+    finally:
+        cache.release_lock(lock_name, token)
+
+
+def _migrate(old: CatalogIndex, new: CatalogIndex, weights: Sequence[float], cache: RedisCache, batch_size: int):
+    removed, changed, delta_rows = diff_catalogs(old, new)
+    stale = removed | changed
+    logger.info(f"Cache migration {old.content_version} -> {new.content_version}: "
+                f"{len(removed)} removed, {len(changed)} changed, {len(delta_rows)} new or changed beats")
+
+    moved = recomputed = dropped = 0
+    for track_ids in cache.scan_track_ids(old.content_version, batch_size):
+        raw = cache.get_many_raw(track_ids, old.content_version)
+
+        keep: List[Tuple[str, int, int, float, bytes, int]] = []
+        recompute: List[Tuple[str, int, int]] = []
+        drop: List[str] = []
+        for track_id, (value, ttl_ms) in zip(track_ids, raw):
+            if value is None:
+                continue
+            row = new.row(track_id)
+            if row is None:
+                drop.append(track_id)
+                continue
+            beat_ids, scores = decode_neighbours(value)
+            if len(scores) == 0:
+                drop.append(track_id)
+            elif track_id in changed or any(beat_id in stale for beat_id in beat_ids):
+                recompute.append((track_id, row, len(beat_ids)))
+            else:
+                keep.append((track_id, row, len(scores), float(scores[-1]), value, ttl_ms))
+
+        # Новые и измененные треки, которые обходят K-го соседа, меняют выдачу — такие записи пересчитываем
+        best = beats_delta_max(new, [entry[1] for entry in keep], delta_rows, weights)
+        unchanged = []
+        for (track_id, row, k, kth_score, value, ttl_ms), best_score in zip(keep, best):
+            if best_score > kth_score:
+                recompute.append((track_id, row, k))
+            else:
+                unchanged.append((track_id, value, ttl_ms))
+
+        for start in range(0, len(recompute), BATCH_CHUNK_SIZE):
+            chunk = recompute[start:start + BATCH_CHUNK_SIZE]
+            similarities = new.kernel.similarities_batch([row for _, row, _ in chunk], weights)
+            items = []
+            for col, (track_id, row, k) in enumerate(chunk):
+                column = similarities[:, col]
+                top_rows = top_k(column, k, exclude=[row])
+                items.append((track_id, [new.beat_ids[r] for r in top_rows], column[top_rows]))
+            cache.set_many_similar_tracks(items, new.content_version)
+
+        cache.move_entries(unchanged, old.content_version, new.content_version)
+        cache.delete_entries(drop + [track_id for track_id, _, _ in recompute], old.content_version)
+        moved += len(unchanged)
+        recomputed += len(recompute)
+        dropped += len(drop)
+
+    logger.info(f"Cache migration done: {moved} moved, {recomputed} recomputed, {dropped} dropped")
@@ -0,0 +1,152 @@
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import hashlib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from infrastructure.catalog_stream import split_ids
+from services.ann_index import IVFIndex, patch_ivf_index
+from services.similarity_kernel import SimilarityKernel, build_similarity_kernel
+
+
+# Колонки, которые не влияют на схожесть: их правки не меняют версию данных каталога
+METADATA_COLUMNS = {"beat_id", "file", "picture", "price", "url", "timestamps"}
+
+
+def content_row_hashes(df: pd.DataFrame) -> np.ndarray:
+    """Хэш содержимого каждой строки по колонкам, от которых зависит схожесть (признаки и категории)"""
+    columns = [c for c in df.columns if c not in METADATA_COLUMNS]
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy(dtype=np.uint64)
+
+
+def category_vocabularies(*lists: List[List[str]]) -> Tuple[List[str], ...]:
+    """Отсортированные словари категорий (жанры, теги, настроения): по ним упорядочены колонки категорий ядра"""
+    return tuple(sorted({name for ids in rows for name in ids}) for rows in lists)
+
+
+def vocabulary_key(vocabularies: Sequence[List[str]]) -> str:
+    """Хэш словарей категорий"""
+    digest = hashlib.blake2b(digest_size=8)
+    for vocabulary in vocabularies:
+        digest.update("\n".join(vocabulary).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def content_version(beat_ids: List[str], row_hashes: np.ndarray) -> str:
+    """
+    Версия данных каталога: хэш отсортированных пар (id трека, хэш содержимого).
+    От порядка строк не зависит, поэтому перестановка строк или правка метаданных версию не меняют
+    """
+    ids = np.asarray(beat_ids, dtype=str)
+    order = np.lexsort((row_hashes, ids))
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update("\n".join(ids[order].tolist()).encode("utf-8"))
+    digest.update(np.ascontiguousarray(row_hashes[order]).tobytes())
+    return digest.hexdigest()
+
+
+class CatalogIndex:
+    """
+    Индекс каталога, который строится один раз на каждую загрузку датасета:
+    beat_id -> позиция строки, заранее разобранные списки категорий каждой строки
+    и нормированные матрицы признаков для расчета схожести.
+    content_version меняется, только если изменились треки или данные, влияющие на схожесть
+    """
+    __slots__ = ("beat_ids", "row_of", "genres", "tags", "moods", "kernel", "ann",
+                 "row_hashes", "content_version", "vocabularies", "vocabulary_key")
+
+    def __init__(self, beat_ids: List[str], genres: List[List[str]],
+                 tags: List[List[str]], moods: List[List[str]],
+                 kernel: Optional[SimilarityKernel] = None,
+                 row_hashes: Optional[np.ndarray] = None,
+                 row_of: Optional[Dict[str, int]] = None,
+                 vocabularies: Optional[Tuple[List[str], ...]] = None):
+        self.beat_ids = beat_ids
+        if row_of is None:
+            # При дублях beat_id выигрывает первая строка, как при поиске через df['beat_id'] == id
+            row_of = {}
+            for row, beat_id in enumerate(beat_ids):
+                row_of.setdefault(beat_id, row)
+        self.row_of: Dict[str, int] = row_of
+        self.genres = genres
+        self.tags = tags
+        self.moods = moods
+        self.kernel = kernel
+        self.ann: Optional[IVFIndex] = None  # приближенный индекс, если включен SIMILARITY_SEARCH=ivf
+        self.row_hashes = row_hashes if row_hashes is not None else np.zeros(len(beat_ids), dtype=np.uint64)
+        self.content_version = content_version(beat_ids, self.row_hashes)
+        self.vocabularies = vocabularies if vocabularies is not None else category_vocabularies(genres, tags, moods)
+        self.vocabulary_key = vocabulary_key(self.vocabularies)
+
+    def __len__(self) -> int:
+        return len(self.beat_ids)
+
+    def __contains__(self, beat_id: Any) -> bool:
+        return str(beat_id) in self.row_of
+
+    def row(self, beat_id: Any) -> Optional[int]:
+        return self.row_of.get(str(beat_id))
+
+
+def build_catalog_index(df: pd.DataFrame, feature_matrix: Optional[np.ndarray] = None,
+                        genres: Optional[sparse.spmatrix] = None, tags: Optional[sparse.spmatrix] = None,
+                        moods: Optional[sparse.spmatrix] = None,
+                        kernel: Optional[SimilarityKernel] = None) -> CatalogIndex:
+    """kernel — готовое ядро схожести (из снимка каталога), иначе строится по feature_matrix и CSR-блокам категорий"""
+    if kernel is None and feature_matrix is not None:
+        kernel = build_similarity_kernel(feature_matrix, genres, tags, moods)
+    return CatalogIndex(
+        [str(b) for b in df['beat_id']],
+        [split_ids(x) for x in df['genre_ids']],
+        [split_ids(x) for x in df['tag_ids']],
+        [split_ids(x) for x in df['mood_ids']],
+        kernel=kernel,
+        row_hashes=content_row_hashes(df)
+    )
+
+
+def patch_catalog_index(index: CatalogIndex, df: pd.DataFrame, source: np.ndarray, feature_matrix: np.ndarray,
+                        genres: sparse.spmatrix, tags: sparse.spmatrix, moods: sparse.spmatrix) -> CatalogIndex:
+    """
+    Индекс после инкрементального обновления без полной сборки: строки с source[row] >= 0 берутся
+    из index, а разбираются, хэшируются и нормируются в ядре только строки df с source == -1
+    (измененные и добавленные). feature_matrix и блоки категорий — уже обновленные (patch_feature_blocks),
+    словари категорий те же, что у index. IVF-индекс переносится с распределением только измененных строк
+    """
+    fresh = np.flatnonzero(source < 0)
+    part = df.iloc[fresh]
+    kernel = index.kernel.patch(source, build_similarity_kernel(
+        feature_matrix[fresh], genres[fresh], tags[fresh], moods[fresh]))
+
+    def take(values: list, changed: list) -> list:
+        taken = [values[row] if row >= 0 else None for row in source.tolist()]
+        for row, value in zip(fresh.tolist(), changed):
+            taken[row] = value
+        return taken
+
+    beat_ids = take(index.beat_ids, [str(b) for b in part['beat_id']])
+    row_hashes = np.empty(len(source), dtype=np.uint64)
+    row_hashes[source >= 0] = index.row_hashes[source[source >= 0]]
+    row_hashes[fresh] = content_row_hashes(part)
+
+    # Без удалений строки прежних треков остаются на своих местах: достаточно дописать новые id
+    n_old = len(index)
+    row_of = None
+    if len(source) >= n_old and np.all((source[:n_old] == np.arange(n_old)) | (source[:n_old] < 0)):
+        row_of = dict(index.row_of)
+        for row in fresh[fresh >= n_old].tolist():
+            row_of.setdefault(beat_ids[row], row)
+
+    patched = CatalogIndex(
+        beat_ids,
+        take(index.genres, [split_ids(x) for x in part['genre_ids']]),
+        take(index.tags, [split_ids(x) for x in part['tag_ids']]),
+        take(index.moods, [split_ids(x) for x in part['mood_ids']]),
+        kernel=kernel,
+        row_hashes=row_hashes,
+        row_of=row_of,
+        vocabularies=index.vocabularies
+    )
+    if index.ann is not None:
+        patched.ann = patch_ivf_index(index.ann, source, kernel)
+    return patched
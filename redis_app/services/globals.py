@@ -2,9 +2,17 @@ import pandas as pd
 
 dataset_df = None
 df_feature_matrix = None
+# Разреженные (CSR) one-hot блоки категорий
 df_genres = None
 df_moods = None
 df_tags = None
+catalog_index = None
+# Версия данных каталога (CatalogIndex.content_version): пространство имен ключей кэша
+dataset_version = None
+# Значение watermark-колонки, до которого загружен каталог (инкрементальное обновление)
+catalog_watermark = None
+# Поколение снимка, к которому подключен процесс (режим общего каталога)
+catalog_generation = 0
 
 df_genres_lookup = None
 df_tags_lookup = None
@@ -0,0 +1,143 @@
+from threading import Lock
+from typing import Optional, Sequence, Tuple
+import json
+import logging
+import os
+import numpy as np
+from config import NEIGHBOUR_TABLE_DIR
+from infrastructure.version_pointer import CURRENT_FILE
+from services.catalog_index import CatalogIndex
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+
+
+def read_current(root: str) -> Optional[str]:
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(root, version) if version else None
+
+
+class NeighbourTable:
+    """
+    Предпосчитанная таблица соседей (precompute_neighbours.py): для каждого трека K строк
+    ближайших треков (int32) и их скоры (float16), открытые через mmap, а также beat_id и хэши
+    содержимого строк каталога, по которому таблица посчитана (beat_ids.npy, row_hashes.npy).
+    Строки таблицы переводятся в строки текущего индекса каталога по beat_id; треки, которых нет
+    в индексе или чье содержимое (хэш строки) изменилось, из таблицы не используются.
+    Перевод строится один раз на пару (таблица, индекс каталога). Версия CURRENT проверяется
+    при публикации каталога и по таймеру (run_neighbour_table_watcher)
+    """
+
+    def __init__(self, root: str = NEIGHBOUR_TABLE_DIR):
+        self.root = root
+        self.path: Optional[str] = None
+        self.content_version: Optional[str] = None
+        self.weights: Optional[Tuple[float, ...]] = None
+        self.k = 0
+        self.ids: Optional[np.ndarray] = None
+        self.scores: Optional[np.ndarray] = None
+        self.beat_ids: Optional[np.ndarray] = None
+        self.row_hashes: Optional[np.ndarray] = None
+        # (путь таблицы, индекс каталога, строка индекса -> строка таблицы, строка таблицы -> строка индекса)
+        self._mapping: Optional[Tuple[str, CatalogIndex, np.ndarray, np.ndarray]] = None
+        self._lock = Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self.ids is not None
+
+    def reload(self) -> bool:
+        """Открывает актуальную версию таблицы, если она сменилась"""
+        if not self.root:
+            return False
+        path = read_current(self.root)
+        if path is None or path == self.path:
+            return self.loaded
+
+        try:
+            with open(os.path.join(path, META_FILE)) as f:
+                meta = json.load(f)
+            ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+            scores = np.load(os.path.join(path, "scores.npy"), mmap_mode="r")
+            # Таблицы старого формата без хэшей строк нельзя сверить с каталогом
+            beat_ids = np.load(os.path.join(path, "beat_ids.npy"), mmap_mode="r")
+            row_hashes = np.load(os.path.join(path, "row_hashes.npy"), mmap_mode="r")
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to load neighbour table {path}: {e}")
+            return self.loaded
+
+        with self._lock:
+            self.path = path
+            self.content_version = meta.get("content_version")
+            self.weights = tuple(meta["weights"])
+            self.k = int(meta["k"])
+            self.ids = ids
+            self.scores = scores
+            self.beat_ids = beat_ids
+            self.row_hashes = row_hashes
+            self._mapping = None
+        logger.info(f"Loaded neighbour table {path}: {len(ids)} tracks, k={self.k}, "
+                    f"catalog version {self.content_version}")
+        return True
+
+    def _map_rows(self, path: str, index: CatalogIndex, beat_ids: np.ndarray,
+                  row_hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Перевод строк между таблицей и индексом каталога (-1 — строки нет или ее содержимое изменилось).
+        Считается один раз на индекс и переиспользуется, пока не сменится таблица или индекс
+        """
+        with self._lock:
+            mapping = self._mapping
+        if mapping is not None and mapping[0] == path and mapping[1] is index:
+            return mapping[2], mapping[3]
+
+        to_index = np.fromiter((index.row_of.get(beat_id, -1) for beat_id in beat_ids.tolist()),
+                               dtype=np.int64, count=len(beat_ids))
+        found = np.flatnonzero(to_index >= 0)
+        stale = found[index.row_hashes[to_index[found]] != row_hashes[found]]
+        to_index[stale] = -1
+        to_table = np.full(len(index), -1, dtype=np.int64)
+        valid = np.flatnonzero(to_index >= 0)
+        to_table[to_index[valid]] = valid
+
+        logger.info(f"Neighbour table {path} mapped to catalog {index.content_version}: "
+                    f"{len(valid)} of {len(beat_ids)} tracks usable")
+        with self._lock:
+            if self.path == path:
+                self._mapping = (path, index, to_table, to_index)
+        return to_table, to_index
+
+    def similar_rows(self, index: CatalogIndex, track_id: str, top_n: int,
+                     weights: Sequence[float]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Строки индекса top_n предпосчитанных соседей трека и их скоры или None, если таблица не подходит
+        (нет таблицы, трек новый или изменился, другие веса или в таблице меньше top_n пригодных соседей).
+        Треки, добавленные после расчета таблицы, среди соседей не появляются до ее пересчета
+        """
+        with self._lock:
+            path, ids, scores = self.path, self.ids, self.scores
+            beat_ids, row_hashes = self.beat_ids, self.row_hashes
+            k, table_weights = self.k, self.weights
+        if ids is None or top_n > k or tuple(weights) != table_weights:
+            return None
+        row = index.row(track_id)
+        if row is None:
+            return None
+
+        to_table, to_index = self._map_rows(path, index, beat_ids, row_hashes)
+        table_row = to_table[row]
+        if table_row < 0:
+            return None
+        rows = to_index[np.asarray(ids[table_row], dtype=np.int64)]
+        keep = np.flatnonzero(rows >= 0)[:top_n]
+        if len(keep) < top_n:
+            return None
+        return rows[keep], np.asarray(scores[table_row], dtype=np.float32)[keep]
+
+
+neighbour_table = NeighbourTable()
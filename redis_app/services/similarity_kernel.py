@@ -0,0 +1,161 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from scipy import sparse
+
+# Веса блоков (аудио, жанры, теги, настроения) по умолчанию, как в find_similar_tracks
+DEFAULT_WEIGHTS = (0.2, 0.3, 0.3, 0.2)
+
+
+def category_matrix(values: Sequence[str], vocabulary: Optional[List[str]] = None) -> sparse.csr_matrix:
+    """
+    Разреженный (CSR) one-hot блок по колонке id категорий '1,3,5': колонки в порядке сортировки
+    названий, как у str.get_dummies(sep=','), но в памяти только ненулевые элементы.
+    vocabulary — готовый словарь колонок (все категории values должны в него входить)
+    """
+    rows = [sorted({item for item in value.split(',') if item}) if isinstance(value, str) else [] for value in values]
+    if vocabulary is None:
+        vocabulary = sorted({name for ids in rows for name in ids})
+    code_of = {name: code for code, name in enumerate(vocabulary)}
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(ids) for ids in rows], out=indptr[1:])
+    codes = np.fromiter((code_of[name] for ids in rows for name in ids), dtype=np.int32, count=int(indptr[-1]))
+    return sparse.csr_matrix((np.ones(len(codes), dtype=np.float32), codes, indptr),
+                             shape=(len(rows), len(vocabulary)))
+
+
+def patch_rows(matrix: sparse.csr_matrix, source: np.ndarray, changed: sparse.spmatrix) -> sparse.csr_matrix:
+    """
+    CSR-матрица после инкрементального обновления: строка row берется из matrix[source[row]],
+    а строки с source == -1 по порядку — из changed. Неизмененные строки копируются целиком, без пересчета
+    """
+    take = source.copy()
+    fresh = np.flatnonzero(source < 0)
+    take[fresh] = matrix.shape[0] + np.arange(len(fresh))
+    return sparse.vstack([matrix, changed], format='csr', dtype=matrix.dtype)[take]
+
+
+def patch_dense_rows(matrix: np.ndarray, source: np.ndarray, changed: np.ndarray) -> np.ndarray:
+    """То же для плотной матрицы"""
+    patched = np.empty((len(source), matrix.shape[1]), dtype=matrix.dtype)
+    kept = source >= 0
+    patched[kept] = matrix[source[kept]]
+    patched[~kept] = changed
+    return patched
+
+
+def _inverse_norms(squares: np.ndarray) -> np.ndarray:
+    norms = np.sqrt(squares)
+    return np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0).astype(np.float32)
+
+
+class SimilarityKernel:
+    """
+    Блоки признаков (аудио, жанры, теги, настроения), заранее L2-нормированные по строкам.
+    Блок аудио — плотная матрица признаков вместе с категориями трека (как прежняя склеенная
+    feature_matrix), блоки жанров, тегов и настроений — только категории. Плотная часть хранится
+    массивом float32, все категории — одной разреженной CSR-матрицей, без нулей one-hot.
+    Колонки ядра — [плотная часть | разреженная часть]; blocks — границы блоков в этой нумерации.
+    Скалярное произведение нормированных строк блока — косинус по блоку, поэтому взвешенная сумма
+    косинусов считается одним умножением матрица-вектор: веса применяются к блокам строки-запроса
+    """
+    __slots__ = ("dense", "sparse", "blocks")
+
+    def __init__(self, features: np.ndarray, categories: Sequence[sparse.spmatrix]):
+        features = np.asarray(features, dtype=np.float32)
+        categories = [sparse.csr_matrix(block, dtype=np.float32) for block in categories]
+
+        # Норма блока аудио считается по признакам и всем категориям сразу
+        squares = np.einsum('ij,ij->i', features, features, dtype=np.float64)
+        category_squares = [np.asarray(block.multiply(block).sum(axis=1), dtype=np.float64).ravel()
+                            for block in categories]
+        audio_scale = _inverse_norms(squares + sum(category_squares))
+
+        self.dense = features * audio_scale[:, None]
+        scaled = [sparse.diags(audio_scale) @ block for block in categories]
+        scaled += [sparse.diags(_inverse_norms(block_squares)) @ block
+                   for block, block_squares in zip(categories, category_squares)]
+        self.sparse = sparse.hstack(scaled, format='csr', dtype=np.float32)
+
+        width = features.shape[1] + sum(block.shape[1] for block in categories)
+        self.blocks: List[Tuple[int, int]] = [(0, width)]
+        for block in categories:
+            self.blocks.append((width, width + block.shape[1]))
+            width += block.shape[1]
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], blocks: Sequence[Tuple[int, int]]) -> "SimilarityKernel":
+        """Ядро поверх уже нормированных массивов (например, открытых через mmap из снимка) без копирования"""
+        kernel = cls.__new__(cls)
+        kernel.dense = arrays["dense"]
+        kernel.sparse = sparse.csr_matrix(
+            (arrays["sparse_data"], arrays["sparse_indices"], arrays["sparse_indptr"]),
+            shape=(len(arrays["dense"]), blocks[-1][1] - arrays["dense"].shape[1]), copy=False)
+        kernel.blocks = [tuple(block) for block in blocks]
+        return kernel
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Массивы ядра для сохранения в .npy (обратное к from_arrays)"""
+        return {"dense": self.dense, "sparse_data": self.sparse.data,
+                "sparse_indices": self.sparse.indices, "sparse_indptr": self.sparse.indptr}
+
+    def __len__(self) -> int:
+        return self.dense.shape[0]
+
+    @property
+    def width(self) -> int:
+        return self.blocks[-1][1]
+
+    def rows(self, rows) -> np.ndarray:
+        """Плотные строки ядра (len(rows) x width)"""
+        return np.hstack([self.dense[rows], self.sparse[rows].toarray()])
+
+    def take(self, rows) -> "SimilarityKernel":
+        """Ядро из подмножества строк"""
+        kernel = SimilarityKernel.__new__(SimilarityKernel)
+        kernel.dense = self.dense[rows]
+        kernel.sparse = self.sparse[rows]
+        kernel.blocks = self.blocks
+        return kernel
+
+    def patch(self, source: np.ndarray, changed: "SimilarityKernel") -> "SimilarityKernel":
+        """
+        Ядро после инкрементального обновления (см. patch_rows): строки нормированы независимо друг от друга,
+        поэтому пересчитываются только строки changed, остальные копируются из этого ядра
+        """
+        kernel = SimilarityKernel.__new__(SimilarityKernel)
+        kernel.dense = patch_dense_rows(self.dense, source, changed.dense)
+        kernel.sparse = patch_rows(self.sparse, source, changed.sparse)
+        kernel.blocks = self.blocks
+        return kernel
+
+    def dot(self, queries: np.ndarray, rows=None) -> np.ndarray:
+        """
+        Скалярные произведения строк ядра (всех или rows) с запросами: вектор длины width
+        или матрица (width x число запросов)
+        """
+        split = self.dense.shape[1]
+        dense = self.dense if rows is None else self.dense[rows]
+        categories = self.sparse if rows is None else self.sparse[rows]
+        return dense @ queries[:split] + categories @ queries[split:]
+
+    def _weigh(self, queries: np.ndarray, weights: Sequence[float]) -> np.ndarray:
+        for (start, end), weight in zip(self.blocks, weights):
+            queries[..., start:end] *= weight
+        return queries
+
+    def query(self, row: int, weights: Sequence[float]) -> np.ndarray:
+        """Строка row с блоками, умноженными на веса"""
+        return self._weigh(self.rows([row])[0], weights)
+
+    def similarities(self, row: int, weights: Sequence[float]) -> np.ndarray:
+        """Взвешенная сумма косинусов по блокам между строкой row и всеми строками каталога"""
+        return self.dot(self.query(row, weights))
+
+    def similarities_batch(self, rows: Sequence[int], weights: Sequence[float]) -> np.ndarray:
+        """То же для нескольких строк сразу одним умножением матрица-матрица: (треки каталога x rows)"""
+        return self.dot(self._weigh(self.rows(list(rows)), weights).T)
+
+
+def build_similarity_kernel(feature_matrix: np.ndarray, genres: sparse.spmatrix,
+                            tags: sparse.spmatrix, moods: sparse.spmatrix) -> SimilarityKernel:
+    return SimilarityKernel(feature_matrix, [genres, tags, moods])
@@ -1,11 +1,15 @@
-import json
 import numpy as np
 import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
 import services.globals as globals
-from services.update_dataset import update_dataset
+from services.update_dataset import update_dataset, update_lock
+from services.catalog_index import CatalogIndex
+from services.similarity_kernel import SimilarityKernel
+from services.ranking import top_k
+from services.neighbour_table import neighbour_table
+from config import BATCH_CHUNK_SIZE
 import logging
-from typing import Dict, List, Any, Tuple, Optional
+from typing import Dict, List, Any, Tuple
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -13,57 +17,58 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-def get_updated_data() -> Tuple[pd.DataFrame, np.ndarray, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+def get_updated_data() -> Tuple[pd.DataFrame, np.ndarray, sparse.csr_matrix, sparse.csr_matrix,
+                                sparse.csr_matrix, CatalogIndex]:
     """Обновляем и возвращаем актуальные данные для расчетов"""
     try:
         if globals.dataset_df is None or globals.df_feature_matrix is None:
             logger.info("Data not loaded, updating dataset...")
             update_dataset()
         
-        return (
-            globals.dataset_df, 
-            globals.df_feature_matrix, 
-            globals.df_genres, 
-            globals.df_moods, 
-            globals.df_tags
-        )
+        with update_lock:
+            return (
+                globals.dataset_df, 
+                globals.df_feature_matrix, 
+                globals.df_genres, 
+                globals.df_tags, 
+                globals.df_moods,
+                globals.catalog_index
+            )
     except Exception as e:
         logger.error(f"Error getting updated data: {str(e)}")
         raise
 
 def calculate_similarities(
     track_idx: int,
-    feature_matrix: np.ndarray,
-    genres_df: pd.DataFrame,
-    tags_df: pd.DataFrame,
-    moods_df: pd.DataFrame,
+    kernel: SimilarityKernel,
     mfcc_weight: float = 0.2,
     genre_weight: float = 0.3,
     tag_weight: float = 0.3,
     mood_weight: float = 0.2
 ) -> np.ndarray:
-    """Вычисляем меру схожести треков"""
-    mfcc_sim = cosine_similarity(
-        feature_matrix[track_idx].reshape(1, -1), 
-        feature_matrix
-    )[0] * mfcc_weight
-
-    genre_sim = cosine_similarity(
-        genres_df.values[track_idx].reshape(1, -1),
-        genres_df.values
-    )[0] * genre_weight
-
-    tag_sim = cosine_similarity(
-        tags_df.values[track_idx].reshape(1, -1),
-        tags_df.values
-    )[0] * tag_weight
-
-    mood_sim = cosine_similarity(
-        moods_df.values[track_idx].reshape(1, -1),
-        moods_df.values
-    )[0] * mood_weight
+    """
+    Вычисляем меру схожести треков: взвешенная сумма косинусов по признакам, жанрам, тегам
+    и настроениям одним умножением на заранее нормированную матрицу каталога
+    """
+    return kernel.similarities(track_idx, (mfcc_weight, genre_weight, tag_weight, mood_weight))
 
-    return mfcc_sim + genre_sim + tag_sim + mood_sim
+def rank_similar_tracks(index: CatalogIndex, track_idx: int, top_n: int,
+                        weights: Tuple[float, float, float, float]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Строки топ-N похожих треков без самого трека и их скоры. При построенном IVF-индексе поиск
+    приближенный; если в просмотренных кластерах не набралось top_n треков, то полный перебор
+    """
+    if index.ann is not None:
+        kernel = index.kernel
+        rows, scores = index.ann.search(kernel, kernel.query(track_idx, weights), top_n, exclude_row=track_idx)
+        if len(rows) >= min(top_n, len(index) - 1):
+            return rows, scores
+        logger.debug(f"IVF returned {len(rows)} of {top_n} tracks, falling back to exact search")
+
+    # Полный перебор: схожесть со всем каталогом и частичный отбор top-N
+    similarities = calculate_similarities(track_idx, index.kernel, *weights)
+    rows = top_k(similarities, top_n, exclude=[track_idx])
+    return rows, similarities[rows]
 
 def prepare_track_response(track: pd.Series) -> Dict[str, Any]:
     """Подготавливаем данные трека для ответа API"""
@@ -76,7 +81,7 @@ def prepare_track_response(track: pd.Series) -> Dict[str, Any]:
         "timestamps": track.get("timestamps", [])
     }
 
-def prepare_full_track_data(track: pd.Series) -> Dict[str, Any]:
+def prepare_full_track_data(track: pd.Series, index: CatalogIndex, row: int) -> Dict[str, Any]:
     """Подготавливаем полные данные трека"""
     response = prepare_track_response(track)
     response.update({
@@ -86,12 +91,101 @@ def prepare_full_track_data(track: pd.Series) -> Dict[str, Any]:
         # "price": float(track.get("price", 0.0)),
         # "picture": str(track.get("picture", "")),
         # "timestamps": track.get("timestamps", []),
-        "genres": track.get('genre_ids', '').split(','),
-        "moods": track.get('mood_ids', '').split(','),
-        "tags": track.get('tag_ids', '').split(',')
+        "genres": index.genres[row],
+        "moods": index.moods[row],
+        "tags": index.tags[row]
     })
     return response
 
+def tracks_from_rows(df: pd.DataFrame, index: CatalogIndex, rows: np.ndarray,
+                     return_full_data: bool = False) -> List[Dict[str, Any]]:
+    """Данные треков по строкам каталога (в порядке rows)"""
+    results = []
+    for idx in rows:
+        track = df.iloc[idx]
+        if return_full_data:
+            results.append(prepare_full_track_data(track, index, idx))
+        else:
+            results.append(prepare_track_response(track))
+    return results
+
+def rank_similar(
+    track_id: str,
+    top_n: int = 10,
+    mfcc_weight: float = 0.2,
+    genre_weight: float = 0.3,
+    tag_weight: float = 0.3,
+    mood_weight: float = 0.2
+) -> Tuple[pd.DataFrame, CatalogIndex, np.ndarray, np.ndarray]:
+    """
+    Находит похожие треки на актуальных данных: (датасет, индекс каталога, строки, скоры).
+    Строки и скоры относятся к возвращенным датасету и индексу
+    """
+    # Загружаем актуальные данные
+    df, feature_matrix, genres_df, tags_df, moods_df, index = get_updated_data()
+
+    logger.info(f"Processing track_id: {track_id}")
+    logger.debug(f"Dataset shape: {df.shape}")
+
+    # Проверяем наличие трека
+    track_idx = index.row(track_id)
+    if track_idx is None:
+        update_dataset()
+        df, feature_matrix, genres_df, tags_df, moods_df, index = get_updated_data()
+        track_idx = index.row(track_id)
+        if track_idx is None:
+            raise ValueError(f"Track {track_id} not found in dataset")
+
+    # Получаем топ-N похожих треков (исключая исходный): из предпосчитанной таблицы, если она есть
+    weights = (mfcc_weight, genre_weight, tag_weight, mood_weight)
+    precomputed = neighbour_table.similar_rows(index, track_id, top_n, weights)
+    if precomputed is not None:
+        rows, scores = precomputed
+    else:
+        rows, scores = rank_similar_tracks(index, track_idx, top_n, weights)
+    return df, index, rows, scores
+
+def rank_similar_batch(
+    track_ids: List[str],
+    top_n: int = 10,
+    mfcc_weight: float = 0.2,
+    genre_weight: float = 0.3,
+    tag_weight: float = 0.3,
+    mood_weight: float = 0.2
+) -> Tuple[pd.DataFrame, CatalogIndex, Dict[str, Tuple[np.ndarray, np.ndarray]]]:
+    """
+    Похожие треки сразу для нескольких треков: (датасет, индекс каталога, {track_id: (строки, скоры)}).
+    Предпосчитанные соседи берутся из таблицы, остальные запросы при полном переборе считаются
+    умножением матрица-матрица чанками по BATCH_CHUNK_SIZE. Треков, которых нет в каталоге, в ответе нет
+    """
+    df, feature_matrix, genres_df, tags_df, moods_df, index = get_updated_data()
+    weights = (mfcc_weight, genre_weight, tag_weight, mood_weight)
+
+    results: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+    pending: List[Tuple[str, int]] = []
+    for track_id in dict.fromkeys(track_ids):
+        track_idx = index.row(track_id)
+        if track_idx is None:
+            continue
+        precomputed = neighbour_table.similar_rows(index, track_id, top_n, weights)
+        if precomputed is not None:
+            results[track_id] = precomputed
+        elif index.ann is not None:
+            results[track_id] = rank_similar_tracks(index, track_idx, top_n, weights)
+        else:
+            pending.append((track_id, track_idx))
+
+    for start in range(0, len(pending), BATCH_CHUNK_SIZE):
+        chunk = pending[start:start + BATCH_CHUNK_SIZE]
+        similarities = index.kernel.similarities_batch([track_idx for _, track_idx in chunk], weights)
+        for col, (track_id, track_idx) in enumerate(chunk):
+            column = similarities[:, col]
+            rows = top_k(column, top_n, exclude=[track_idx])
+            results[track_id] = (rows, column[rows])
+
+    logger.info(f"Batch: {len(results)} of {len(track_ids)} tracks ranked, {len(pending)} by matrix product")
+    return df, index, results
+
 def find_similar_tracks(
     track_id: str,
     top_n: int = 10,
@@ -110,57 +204,19 @@ def find_similar_tracks(
         genre_weight: вес жанров в схожести
         tag_weight: вес тегов в схожести
         mood_weight: вес настроений в схожести
-        return_full_data: если True, возвращает полные данные (для кэша)
+        return_full_data: если True, возвращает полные данные (с genres/moods/tags)
     
         Список словарей с информацией о похожих треках
     """
     try:
-        # Загружаем актуальные данные
-        df, feature_matrix, genres_df, tags_df, moods_df = get_updated_data()
-        
-        logger.info(f"Processing track_id: {track_id}")
-        logger.debug(f"Dataset shape: {df.shape}")
-
-        # Проверяем наличие трека
-        track_idx_list = df.index[df['beat_id'] == track_id].tolist()
-        if not track_idx_list:
-            update_dataset()
-            df, feature_matrix, genres_df, tags_df, moods_df = get_updated_data()
-            track_idx_list = df.index[df['beat_id'] == track_id].tolist()
-            if not track_idx_list:
-                raise ValueError(f"Track {track_id} not found in dataset")
-
-        track_idx = track_idx_list[0]
-
-        # Вычисляем схожести
-        similarities = calculate_similarities(
-            track_idx,
-            feature_matrix,
-            genres_df,
-            tags_df,
-            moods_df,
-            mfcc_weight,
-            genre_weight,
-            tag_weight,
-            mood_weight
-        )
-
-        # Получаем топ-N похожих треков (исключая исходный)
-        similar_indices = np.argsort(similarities)[::-1]
-        similar_indices = [idx for idx in similar_indices if idx != track_idx][:top_n]
+        df, index, rows, _ = rank_similar(track_id, top_n, mfcc_weight, genre_weight, tag_weight, mood_weight)
 
         # Формируем результат
-        results = []
-        for idx in similar_indices:
-            track = df.iloc[idx]
-            if return_full_data:
-                results.append(prepare_full_track_data(track))
-            else:
-                results.append(prepare_track_response(track))
+        results = tracks_from_rows(df, index, rows, return_full_data)
 
         logger.info(f"Found {len(results)} similar tracks for track_id {track_id}")
         return results
 
     except Exception as e:
         logger.error(f"Error in find_similar_tracks: {str(e)}", exc_info=True)
-        raise RuntimeError(f"Similarity calculation failed: {str(e)}")
\ No newline at end of file
+        raise RuntimeError(f"Similarity calculation failed: {str(e)}")
@@ -1,5 +1,16 @@
-from infrastructure.data_loader import load_data
+from infrastructure.data_loader import (load_data, load_watermark, load_catalog_delta,
+                                        merge_catalog_delta, drop_unchanged_rows, build_feature_blocks,
+                                        patch_feature_blocks)
 import services.globals as globals
+from services.catalog_index import build_catalog_index, patch_catalog_index
+from services.ann_index import build_ivf_index, reassign_ivf_index
+from services.neighbour_table import neighbour_table
+from services.cache_migration import migrate_similar_tracks_cache
+from infrastructure.catalog_snapshot import write_snapshot, load_latest_snapshot, read_generation
+from infrastructure.catalog_leader import CatalogLeader
+from config import (SIMILARITY_SEARCH, ANN_NLIST, ANN_NPROBE, ANN_MIN_ROWS, CATALOG_REFRESH_MINUTES,
+                    SNAPSHOT_DIR, SNAPSHOT_KEEP, SNAPSHOT_MIN_INTERVAL_SECONDS, CATALOG_SHARED, CATALOG_ATTACH_POLL_SECONDS,
+                    CATALOG_ATTACH_TIMEOUT_SECONDS, NEIGHBOUR_TABLE_DIR, NEIGHBOUR_TABLE_POLL_SECONDS)
 import pandas as pd
 import logging
 from threading import Lock
@@ -9,23 +20,222 @@ from datetime import datetime
 
 logger = logging.getLogger(__name__)
 update_lock = Lock()
-def update_dataset() -> bool:
-    try:
-        df, features, genres, moods, tags = load_data()
+# Полная перезагрузка и инкрементальное обновление не выполняются одновременно
+reload_lock = Lock()
+# Снимки пишутся в фоне по одному
+snapshot_lock = Lock()
+# Снимки после инкрементальных обновлений пишутся не чаще SNAPSHOT_MIN_INTERVAL_SECONDS:
+# время последней записи (time.monotonic) и признак отложенного снимка
+last_snapshot_at = None
+snapshot_pending = False
+# В режиме общего каталога базу грузит только один процесс, остальные подключаются к его снимкам
+catalog_leader = CatalogLeader(SNAPSHOT_DIR) if CATALOG_SHARED and SNAPSHOT_DIR else None
+if CATALOG_SHARED and not SNAPSHOT_DIR:
+    logger.warning("CATALOG_SHARED requires SNAPSHOT_DIR, every worker will load the catalog itself")
+
+def owns_catalog() -> bool:
+    """Процесс сам грузит каталог из базы: вне режима общего каталога или если он загрузчик"""
+    return catalog_leader is None or catalog_leader.acquire()
 
+def publish_dataset(df, features, genres, tags, moods, watermark=None, reuse_ann: bool = False,
+                    snapshot: bool = True, kernel=None, ann=None, index=None):
+    """
+    Строит индекс и подменяет данные каталога. При reuse_ann IVF-индекс не обучается заново:
+    строки перераспределяются по центроидам прежнего индекса.
+    snapshot — в фоне записать снимок датасета для быстрого старта (если задан SNAPSHOT_DIR).
+    kernel, ann — готовые ядро схожести и IVF-индекс из снимка.
+    index — готовый индекс каталога (после инкрементального обновления), тогда он не строится заново
+    """
+    if index is None:
+        index = build_catalog_index(df, features, genres, tags, moods, kernel=kernel)
+        index.ann = ann
+    if index.ann is None and SIMILARITY_SEARCH == "ivf" and len(index) >= ANN_MIN_ROWS:
+        previous_ann = globals.catalog_index.ann if reuse_ann and globals.catalog_index is not None else None
+        if previous_ann is not None:
+            index.ann = reassign_ivf_index(previous_ann, index.kernel, index.vocabulary_key)
+        if index.ann is None:
+            index.ann = build_ivf_index(index.kernel, nlist=ANN_NLIST, nprobe=ANN_NPROBE,
+                                        vocabulary=index.vocabulary_key)
+
+    # Подменяем данные и индекс одним блоком, чтобы читатели не видели их вперемешку
+    with update_lock:
+        previous_index = globals.catalog_index
         globals.dataset_df = df
         globals.df_feature_matrix = features
         globals.df_genres = genres
         globals.df_moods = moods
         globals.df_tags = tags
+        globals.catalog_index = index
+        globals.dataset_version = index.content_version
+        globals.catalog_watermark = watermark
+
+    # Записи кэша прошлой версии переносятся в новое пространство имен в фоне,
+    # пересчитываются только те, чье соседство могло измениться
+    # В режиме общего каталога кэш переносит только загрузчик
+    if previous_index is not None and previous_index.content_version != index.content_version \
+            and (catalog_leader is None or catalog_leader.is_leader):
+        threading.Thread(target=_migrate_cache, args=(previous_index, index), daemon=True).start()
+
+    # Таблица соседей пересчитывается офлайн после перезагрузки и подхватывается, когда готова
+    neighbour_table.reload()
+
+    if snapshot:
+        _schedule_snapshot(df, features, watermark, index)
+    return index
+
+def _snapshot_due() -> bool:
+    return last_snapshot_at is None or time.monotonic() - last_snapshot_at >= SNAPSHOT_MIN_INTERVAL_SECONDS
 
-        logger.info(f"Dataset updated. Records: {len(df)}")
+def _schedule_snapshot(df, features, watermark, index):
+    """В фоне пишет снимок датасета; снимки пишет только загрузчик общего каталога (или любой процесс вне этого режима)"""
+    global last_snapshot_at, snapshot_pending
+    if not SNAPSHOT_DIR or (catalog_leader is not None and not catalog_leader.is_leader):
+        return
+    last_snapshot_at = time.monotonic()
+    snapshot_pending = False
+    threading.Thread(target=_save_snapshot, args=(df, features, watermark, index), daemon=True).start()
+
+def _save_snapshot(df, features, watermark, index):
+    try:
+        with snapshot_lock:
+            write_snapshot(SNAPSHOT_DIR, df, features, watermark, keep=SNAPSHOT_KEEP,
+                           kernel=index.kernel, ann=index.ann)
+    except Exception as e:
+        logger.error(f"Failed to write dataset snapshot: {e}")
+
+def restore_snapshot() -> bool:
+    """Поднимает датасет из последнего снимка на диске (без обращения к базе)"""
+    if not SNAPSHOT_DIR:
+        return False
+    try:
+        generation = read_generation(SNAPSHOT_DIR)
+        snapshot = load_latest_snapshot(SNAPSHOT_DIR)
+        if snapshot is None:
+            return False
+        df, features, genres, tags, moods, watermark, kernel, ann = snapshot
+        with reload_lock:
+            publish_dataset(df, features, genres, tags, moods, watermark, snapshot=False, kernel=kernel, ann=ann)
+            globals.catalog_generation = generation
+        logger.info(f"Dataset restored from snapshot. Records: {len(df)}, generation: {generation}")
         return True
+    except Exception as e:
+        logger.error(f"Failed to restore dataset snapshot: {e}")
+        return False
+
+def attach_snapshot() -> bool:
+    """Подключается к последнему снимку загрузчика, если его поколение сменилось"""
+    if globals.dataset_df is not None and read_generation(SNAPSHOT_DIR) == globals.catalog_generation:
+        return True
+    return restore_snapshot()
+
+def wait_for_shared_catalog() -> bool:
+    """
+    Старт воркера общего каталога: ждет первый снимок загрузчика не дольше CATALOG_ATTACH_TIMEOUT_SECONDS.
+    На каждой итерации процесс пробует сам стать загрузчиком: прежний мог упасть, не записав снимок.
+    True — подключился к снимку; False — нужно грузить из базы самому (режим выключен,
+    процесс стал загрузчиком или загрузчик не записал снимок вовремя)
+    """
+    if catalog_leader is None:
+        return False
+    deadline = time.monotonic() + CATALOG_ATTACH_TIMEOUT_SECONDS
+    while not owns_catalog():
+        if attach_snapshot():
+            return True
+        if time.monotonic() >= deadline:
+            logger.warning("No catalog snapshot from the loader in time, loading from the database")
+            return False
+        time.sleep(CATALOG_ATTACH_POLL_SECONDS)
+    return False
+
+def catch_up_dataset() -> bool:
+    """
+    Догоняет базу после старта из снимка: изменения после watermark снимка,
+    если включено инкрементальное обновление, иначе полная перезагрузка
+    """
+    if CATALOG_REFRESH_MINUTES > 0 and globals.catalog_watermark is not None:
+        if refresh_dataset():
+            return True
+    return update_dataset()
+
+def update_dataset(force: bool = False) -> bool:
+    """force — читать базу, даже если процесс не загрузчик общего каталога"""
+    if not force and not owns_catalog():
+        return attach_snapshot()
+    try:
+        with reload_lock:
+            # watermark читаем до выборки: изменения во время загрузки подхватит следующий инкрементальный проход
+            watermark = load_watermark() if CATALOG_REFRESH_MINUTES > 0 else None
+            df, features, genres, tags, moods = load_data()
+            publish_dataset(df, features, genres, tags, moods, watermark)
+
+            logger.info(f"Dataset updated. Records: {len(df)}")
+            return True
 
     except Exception as e:
         logger.error(f"Failed to update dataset: {e}")
         return False
 
+def refresh_dataset() -> bool:
+    """
+    Инкрементальное обновление: из базы читаются только треки, измененные после watermark,
+    и список id для поиска удаленных. В матрицах, ядре и индексе пересчитываются только эти строки;
+    полная сборка в памяти — только при смене словарей категорий
+    """
+    global snapshot_pending
+    if not owns_catalog():
+        return attach_snapshot()
+    try:
+        with reload_lock:
+            since = globals.catalog_watermark
+            current_df = globals.dataset_df
+            if since is None or current_df is None:
+                return False
+
+            delta = load_catalog_delta(since)
+            if delta is None:
+                return False
+            changed, alive_ids, watermark = delta
+            changed = drop_unchanged_rows(current_df, changed)
+
+            deleted = len(current_df) - int(current_df['beat_id'].astype(str).isin(set(alive_ids)).sum())
+            if changed.empty and not deleted:
+                globals.catalog_watermark = watermark
+                # Отложенный снимок прошлых изменений дописывается, когда подошел интервал
+                if snapshot_pending and _snapshot_due():
+                    _schedule_snapshot(globals.dataset_df, globals.df_feature_matrix, watermark, globals.catalog_index)
+                return True
+
+            df, source = merge_catalog_delta(current_df, changed, alive_ids)
+            current_index = globals.catalog_index
+            blocks = patch_feature_blocks(df, source, globals.df_feature_matrix, globals.df_genres,
+                                          globals.df_tags, globals.df_moods, current_index.vocabularies)
+            due = _snapshot_due()
+            if blocks is not None:
+                # Пересчитываются только измененные и новые строки матриц, ядра и индекса
+                features, genres, tags, moods = blocks
+                index = patch_catalog_index(current_index, df, source, features, genres, tags, moods)
+                publish_dataset(df, features, genres, tags, moods, watermark, snapshot=due, index=index)
+            else:
+                # Словари категорий изменились: полная сборка матриц и индекса по объединенному каталогу
+                logger.info("Category vocabularies changed, rebuilding catalog matrices")
+                features, genres, tags, moods = build_feature_blocks(df)
+                publish_dataset(df, features, genres, tags, moods, watermark, reuse_ann=True, snapshot=due)
+            snapshot_pending = not due
+
+            logger.info(f"Dataset refreshed. Changed: {len(changed)}, deleted: {deleted}, records: {len(df)}, "
+                        f"patched: {blocks is not None}")
+            return True
+
+    except Exception as e:
+        logger.error(f"Failed to refresh dataset: {e}")
+        return False
+
+def _migrate_cache(previous_index, index):
+    try:
+        migrate_similar_tracks_cache(previous_index, index)
+    except Exception as e:
+        logger.error(f"Failed to migrate similar tracks cache: {e}")
+
 def run_nightly_update():
     """Запускает фоновый поток для ежедневного обновления в 00:00"""
     def scheduler():
@@ -37,4 +247,47 @@ def run_nightly_update():
             time.sleep(30)
 
     thread = threading.Thread(target=scheduler, daemon=True)
-    thread.start()
\ No newline at end of file
+    thread.start()
+
+def run_incremental_refresh():
+    """Запускает фоновый поток инкрементального обновления каждые CATALOG_REFRESH_MINUTES минут"""
+    if CATALOG_REFRESH_MINUTES <= 0:
+        return
+
+    def scheduler():
+        while True:
+            time.sleep(CATALOG_REFRESH_MINUTES * 60)
+            refresh_dataset()
+
+    thread = threading.Thread(target=scheduler, daemon=True)
+    thread.start()
+
+def run_catalog_watcher():
+    """В режиме общего каталога воркеры следят за поколением снимков и переподключаются к новым"""
+    if catalog_leader is None:
+        return
+
+    def watcher():
+        while True:
+            time.sleep(CATALOG_ATTACH_POLL_SECONDS)
+            if not owns_catalog():
+                attach_snapshot()
+
+    thread = threading.Thread(target=watcher, daemon=True)
+    thread.start()
+
+def run_neighbour_table_watcher():
+    """
+    Подхватывает новые версии таблицы соседей: precompute_neighbours.py переключает CURRENT
+    независимо от перезагрузок каталога, поэтому одной проверки при публикации мало
+    """
+    if not NEIGHBOUR_TABLE_DIR:
+        return
+
+    def watcher():
+        while True:
+            time.sleep(NEIGHBOUR_TABLE_POLL_SECONDS)
+            neighbour_table.reload()
+
+    thread = threading.Thread(target=watcher, daemon=True)
+    thread.start()
@@ -0,0 +1,7 @@
+import os
+
+# infrastructure/data_loader.py создает engine при импорте: URL базы должен разбираться,
+# хотя сами тесты к базе не подключаются
+for name, value in {"DB_HOST": "localhost", "DB_PORT": "5432", "DB_USER": "test",
+                    "DB_PASS": "test", "DB_NAME": "test", "DB_SSLMODE": "disable"}.items():
+    os.environ.setdefault(name, value)
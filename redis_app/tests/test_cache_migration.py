@@ -0,0 +1,136 @@
+import uuid
+import numpy as np
+import pandas as pd
+import pytest
+from infrastructure.redis_cache import decode_neighbours, encode_neighbours
+from services.cache_migration import diff_catalogs, migrate_similar_tracks_cache
+from services.catalog_index import build_catalog_index
+from services.ranking import top_k
+from services.similarity_kernel import DEFAULT_WEIGHTS, category_matrix
+
+OLD, NEW = "old", "new"
+TTL_MS = 60_000
+BEATS = {name: str(uuid.uuid5(uuid.NAMESPACE_OID, name)) for name in "ABCDEFG"}
+
+
+class FakeCache:
+    """Кэш похожих треков в словаре: {(версия, track_id): (значение, TTL в мс)} и блокировки"""
+
+    def __init__(self):
+        self.entries = {}
+        self.locks = {}
+
+    def put(self, track_id, beat_ids, scores, version=OLD):
+        self.entries[(version, track_id)] = (encode_neighbours(beat_ids, scores), TTL_MS)
+
+    def scan_track_ids(self, version, batch_size=1000):
+        track_ids = [track_id for v, track_id in self.entries if v == version]
+        for start in range(0, len(track_ids), batch_size):
+            yield track_ids[start:start + batch_size]
+
+    def get_many_raw(self, track_ids, version):
+        return [self.entries.get((version, track_id), (None, -2)) for track_id in track_ids]
+
+    def set_many_similar_tracks(self, items, version=None, batch_size=1000):
+        for track_id, beat_ids, scores in items:
+            self.put(track_id, beat_ids, scores, version)
+
+    def move_entries(self, entries, old_version, new_version):
+        for track_id, value, ttl_ms in entries:
+            self.entries[(new_version, track_id)] = (value, ttl_ms)
+            self.entries.pop((old_version, track_id), None)
+
+    def delete_entries(self, track_ids, version):
+        for track_id in track_ids:
+            self.entries.pop((version, track_id), None)
+
+    def acquire_lock(self, name, ttl_ms):
+        if name in self.locks:
+            return None
+        self.locks[name] = "token"
+        return "token"
+
+    def release_lock(self, name, token):
+        if self.locks.get(name) == token:
+            del self.locks[name]
+
+
+def catalog(tracks, version):
+    """Индекс каталога из {имя: (mfcc1, mfcc2, genre_ids)} с заданной версией данных"""
+    df = pd.DataFrame([
+        {"beat_id": BEATS[name], "file": "", "picture": "", "price": 0.0, "url": "", "timestamps": [],
+         "genre_ids": genres, "tag_ids": "1", "mood_ids": "1", "mfcc1": x, "mfcc2": y}
+        for name, (x, y, genres) in tracks.items()
+    ])
+    genres = category_matrix(df["genre_ids"])
+    tags = category_matrix(df["tag_ids"])
+    moods = category_matrix(df["mood_ids"])
+    index = build_catalog_index(df, df[["mfcc1", "mfcc2"]].to_numpy(dtype=np.float64), genres, tags, moods)
+    index.content_version = version
+    return index
+
+
+OLD_TRACKS = {"A": (1.0, 0.1, "1"), "B": (0.9, 0.2, "1"), "C": (0.1, 1.0, "2"),
+              "D": (0.2, 0.9, "2"), "E": (-1.0, 0.3, "3"), "F": (0.5, 0.5, "1,2")}
+# F удален, B изменился, G добавлен
+NEW_TRACKS = {**{name: OLD_TRACKS[name] for name in "ACDE"},
+              "B": (-0.9, -0.2, "3"), "G": (0.15, 0.95, "2")}
+
+
+@pytest.fixture
+def catalogs():
+    return catalog(OLD_TRACKS, OLD), catalog(NEW_TRACKS, NEW)
+
+
+def expected_neighbours(index, track, k):
+    row = index.row(BEATS[track])
+    scores = index.kernel.similarities(row, DEFAULT_WEIGHTS)
+    rows = top_k(scores, k, exclude=[row])
+    return [index.beat_ids[r] for r in rows]
+
+
+def test_diff_catalogs(catalogs):
+    old, new = catalogs
+    removed, changed, delta_rows = diff_catalogs(old, new)
+    assert removed == {BEATS["F"]}
+    assert changed == {BEATS["B"]}
+    assert sorted(new.beat_ids[row] for row in delta_rows) == sorted([BEATS["B"], BEATS["G"]])
+
+
+def test_migration_keeps_recomputes_and_drops(catalogs):
+    old, new = catalogs
+    cache = FakeCache()
+    # Соседи не задеты, а K-й скор не обойти ни одним новым треком (скор не больше 1) — переносится как есть
+    cache.put(BEATS["A"], [BEATS["D"]], [1.0])
+    kept_value = cache.entries[(OLD, BEATS["A"])][0]
+    # Среди соседей измененный трек
+    cache.put(BEATS["E"], [BEATS["B"], BEATS["A"]], [0.9, 0.1])
+    # Новый трек G ближе K-го соседа записи
+    cache.put(BEATS["C"], [BEATS["A"]], [-1.0])
+    # Сам трек изменился
+    cache.put(BEATS["B"], [BEATS["A"]], [0.99])
+    # Трек удален из каталога и пустая запись
+    cache.put(BEATS["F"], [BEATS["A"]], [0.5])
+    cache.put(BEATS["D"], [], [])
+
+    migrate_similar_tracks_cache(old, new, cache=cache, batch_size=2)
+
+    assert not [key for key in cache.entries if key[0] == OLD]
+    assert set(track_id for _, track_id in cache.entries) == {BEATS[name] for name in "AEBC"}
+    assert cache.entries[(NEW, BEATS["A"])] == (kept_value, TTL_MS)
+    for name, k in (("E", 2), ("C", 1), ("B", 1)):
+        beat_ids, _ = decode_neighbours(cache.entries[(NEW, BEATS[name])][0])
+        assert beat_ids == expected_neighbours(new, name, k)
+    assert decode_neighbours(cache.entries[(NEW, BEATS["C"])][0])[0] == [BEATS["G"]]
+    assert not cache.locks
+
+
+def test_migration_skipped_when_another_process_holds_lock(catalogs):
+    old, new = catalogs
+    cache = FakeCache()
+    cache.put(BEATS["F"], [BEATS["A"]], [0.5])
+    cache.acquire_lock(f"migrate:{OLD}:{NEW}", 1000)
+
+    migrate_similar_tracks_cache(old, new, cache=cache)
+
+    assert list(cache.entries) == [(OLD, BEATS["F"])]
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+from infrastructure.data_loader import build_feature_blocks, merge_catalog_delta, patch_feature_blocks
+from services.ann_index import build_ivf_index
+from services.catalog_index import build_catalog_index, patch_catalog_index
+
+TRACKS = {
+    "a": (1.0, 0.1, "1", "5"), "b": (0.9, 0.2, "1,2", "5"), "c": (0.1, 1.0, "2", "6"),
+    "d": (0.2, 0.9, "2", ""), "e": (-1.0, 0.3, "3", "6"), "f": (0.5, 0.5, "1,3", "5,6"),
+}
+
+
+def frame(tracks, price=10.0) -> pd.DataFrame:
+    return pd.DataFrame([
+        {"beat_id": beat_id, "file": beat_id, "picture": "", "price": price, "url": "", "timestamps": [],
+         "genre_ids": genres, "tag_ids": tags, "mood_ids": "1", "mfcc1": x, "mfcc2": y}
+        for beat_id, (x, y, genres, tags) in tracks.items()
+    ])
+
+
+def full_build(df):
+    features, genres, tags, moods = build_feature_blocks(df)
+    return build_catalog_index(df, features, genres, tags, moods), (features, genres, tags, moods)
+
+
+def test_changed_rows_are_replaced_in_place():
+    df = frame(TRACKS)
+    index, _ = full_build(df)
+    changed = frame({"c": TRACKS["c"]}, price=99.0)
+
+    merged, source = merge_catalog_delta(df, changed, list(TRACKS))
+
+    assert merged["beat_id"].tolist() == list(TRACKS)
+    assert merged.loc[2, "price"] == 99.0
+    assert source.tolist() == [0, 1, -1, 3, 4, 5]
+    # Правка цены не меняет ни порядок строк, ни версию данных каталога
+    assert full_build(merged)[0].content_version == index.content_version
+
+
+def test_content_version_ignores_row_order():
+    df = frame(TRACKS)
+    shuffled = df.iloc[[3, 0, 5, 1, 4, 2]].reset_index(drop=True)
+    assert full_build(df)[0].content_version == full_build(shuffled)[0].content_version
+
+
+def test_patch_matches_full_build():
+    df = frame(TRACKS)
+    index, (features, genres, tags, moods) = full_build(df)
+    index.ann = build_ivf_index(index.kernel, nlist=2, vocabulary=index.vocabulary_key)
+    # c изменился, d удален, g добавлен
+    changed = frame({"c": (0.3, 0.8, "1,2", "6"), "g": (0.0, -1.0, "3", "5")})
+    merged, source = merge_catalog_delta(df, changed, ["a", "b", "c", "e", "f", "g"])
+
+    blocks = patch_feature_blocks(merged, source, features, genres, tags, moods, index.vocabularies)
+    patched = patch_catalog_index(index, merged, source, *blocks)
+    expected, expected_blocks = full_build(merged)
+
+    assert patched.beat_ids == expected.beat_ids == ["a", "b", "c", "e", "f", "g"]
+    assert patched.row_of == expected.row_of
+    assert patched.genres == expected.genres and patched.tags == expected.tags
+    np.testing.assert_array_equal(patched.row_hashes, expected.row_hashes)
+    assert patched.content_version == expected.content_version
+    assert patched.vocabulary_key == expected.vocabulary_key
+    np.testing.assert_allclose(blocks[0], expected_blocks[0])
+    for block, expected_block in zip(blocks[1:], expected_blocks[1:]):
+        assert (block != expected_block).nnz == 0
+    np.testing.assert_allclose(patched.kernel.dense, expected.kernel.dense, rtol=1e-6)
+    np.testing.assert_allclose(patched.kernel.sparse.toarray(), expected.kernel.sparse.toarray(), rtol=1e-6)
+    assert sorted(patched.ann.list_rows.tolist()) == list(range(len(merged)))
+
+
+def test_vocabulary_change_requires_full_build():
+    df = frame(TRACKS)
+    index, (features, genres, tags, moods) = full_build(df)
+
+    # Новый жанр 4
+    merged, source = merge_catalog_delta(df, frame({"a": (1.0, 0.1, "4", "5")}), list(TRACKS))
+    assert patch_feature_blocks(merged, source, features, genres, tags, moods, index.vocabularies) is None
+    # Жанр 3 остается без треков
+    merged, source = merge_catalog_delta(df, frame({"e": (-1.0, 0.3, "2", "6")}), ["a", "b", "c", "d", "e"])
+    assert patch_feature_blocks(merged, source, features, genres, tags, moods, index.vocabularies) is None
@@ -0,0 +1,164 @@
+import uuid
+import numpy as np
+import pytest
+from infrastructure.mfcc_copy import (COPY_SIGNATURE, COPY_TRAILER, MFCC_RECORD_DTYPE, MFCC_SOURCE_COLUMNS,
+                                      BinaryCopyDecoder, align_to_beats)
+
+N_VALUES = len(MFCC_SOURCE_COLUMNS)
+
+
+def copy_stream(ids, values, extension=b"", trailer=True) -> bytes:
+    """Поток COPY ... TO STDOUT (FORMAT binary) в том виде, в каком его отдает Postgres"""
+    records = np.zeros(len(ids), dtype=MFCC_RECORD_DTYPE)
+    records["fields"] = N_VALUES + 1
+    records["id_length"] = 16
+    records["id"] = [uuid.UUID(beat_id).bytes for beat_id in ids]
+    records["values"]["length"] = 4
+    records["values"]["value"] = values
+    header = COPY_SIGNATURE + (0).to_bytes(4, "big") + len(extension).to_bytes(4, "big") + extension
+    return header + records.tobytes() + (COPY_TRAILER if trailer else b"")
+
+
+def decode(stream: bytes, piece: int, capacity: int = 1, drain_bytes: int = 1) -> BinaryCopyDecoder:
+    decoder = BinaryCopyDecoder(capacity, drain_bytes=drain_bytes)
+    for start in range(0, len(stream), piece):
+        assert decoder.write(stream[start:start + piece]) == len(stream[start:start + piece])
+    return decoder
+
+
+def sample(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = [str(uuid.UUID(int=int(x))) for x in rng.integers(1, 2 ** 62, size=n_rows)]
+    values = rng.standard_normal((n_rows, N_VALUES)).astype(np.float32)
+    values[0, 3] = np.nan
+    return ids, values
+
+
+# Куски, которые режут заголовок, строки и завершающий маркер в разных местах
+@pytest.mark.parametrize("piece", [1, 7, MFCC_RECORD_DTYPE.itemsize - 1, MFCC_RECORD_DTYPE.itemsize + 3, 1 << 20])
+def test_decoder_handles_chunk_boundaries(piece):
+    ids, values = sample(25)
+    decoded_ids, decoded_values = decode(copy_stream(ids, values), piece).finish()
+
+    assert [str(uuid.UUID(bytes=raw.ljust(16, b"\0"))) for raw in decoded_ids] == ids
+    np.testing.assert_array_equal(decoded_values, values)
+
+
+def test_decoder_skips_header_extension_and_grows_buffers():
+    ids, values = sample(10)
+    decoder = decode(copy_stream(ids, values, extension=b"\x01\x02\x03"), 5, capacity=2, drain_bytes=64)
+    decoded_ids, decoded_values = decoder.finish()
+
+    assert len(decoded_ids) == 10
+    np.testing.assert_array_equal(decoded_values, values)
+
+
+def test_decoder_empty_table():
+    decoded_ids, decoded_values = decode(copy_stream([], np.empty((0, N_VALUES))), 4).finish()
+    assert len(decoded_ids) == 0 and decoded_values.shape == (0, N_VALUES)
+
+
+def test_decoder_rejects_truncated_stream():
+    ids, values = sample(3)
+    with pytest.raises(ValueError, match="Truncated"):
+        decode(copy_stream(ids, values, trailer=False), 11).finish()
+    with pytest.raises(ValueError, match="Truncated"):
+        decode(copy_stream(ids, values)[:-30], 11).finish()
+
+
+def test_decoder_rejects_unexpected_layout():
+    ids, values = sample(3)
+    with pytest.raises(ValueError, match="signature"):
+        decode(b"NOTCOPY" + copy_stream(ids, values), 1 << 20).finish()
+
+    stream = bytearray(copy_stream(ids, values))
+    # Первая строка с другим числом полей (например, в mfccs добавили колонку)
+    stream[19:21] = (N_VALUES + 2).to_bytes(2, "big")
+    with pytest.raises(ValueError, match="layout"):
+        decode(bytes(stream), 1 << 20).finish()
+
+
+def test_align_to_beats_orders_rows_and_fills_missing():
+    ids, values = sample(4)
+    raw_ids = np.array([uuid.UUID(beat_id).bytes for beat_id in ids], dtype="S16")
+    missing = str(uuid.uuid4())
+    beat_ids = [ids[2], missing, ids[0], ids[3]]
+
+    aligned = align_to_beats(raw_ids, values, beat_ids)
+
+    assert aligned.shape == (4, N_VALUES) and aligned.dtype == np.float32
+    np.testing.assert_array_equal(aligned[0], values[2])
+    assert np.isnan(aligned[1]).all()
+    np.testing.assert_array_equal(aligned[2], values[0])
+    np.testing.assert_array_equal(aligned[3], values[3])
+
+
+def test_align_to_beats_without_mfcc_rows():
+    aligned = align_to_beats(np.empty(0, dtype="S16"), np.empty((0, N_VALUES), dtype=np.float32),
+                             [str(uuid.uuid4()) for _ in range(3)])
+    assert aligned.shape == (3, N_VALUES) and np.isnan(aligned).all()
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def scalar(self):
+        return self.rows[0][0]
+
+    def partitions(self, size):
+        for start in range(0, len(self.rows), size):
+            yield self.rows[start:start + size]
+
+
+class FakeConnection:
+    """Соединение psycopg2, которое отдает каталог без аудиофичей и строки mfccs обычной выборкой"""
+
+    class dialect:
+        driver = "psycopg2"
+
+    def __init__(self, catalog_rows, mfcc_rows):
+        self.catalog_rows = catalog_rows
+        self.mfcc_rows = mfcc_rows
+        self.queries = []
+        self.rollbacks = 0
+
+    def execution_options(self, **options):
+        return self
+
+    def execute(self, query):
+        sql = str(query)
+        self.queries.append(sql)
+        if "count(*)" in sql:
+            return FakeResult([(len(self.catalog_rows),)])
+        if sql.startswith("SELECT beat_id"):
+            return FakeResult(self.mfcc_rows)
+        return FakeResult(self.catalog_rows)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def test_stream_catalog_selects_only_audio_after_failed_copy(monkeypatch):
+    from infrastructure import catalog_stream
+
+    def broken_copy(conn, beat_ids):
+        raise ValueError("Unexpected COPY binary row layout")
+
+    monkeypatch.setattr(catalog_stream, "copy_mfcc_features", broken_copy)
+    ids, values = sample(3)
+    catalog_rows = [(beat_id, f"beat {i}", None, 10.0, None, "[]", "1", None, None) for i, beat_id in enumerate(ids)]
+    # Строки mfccs в другом порядке и без одного трека
+    mfcc_rows = [(uuid.UUID(ids[2]), *values[2].tolist()), (uuid.UUID(ids[0]), *values[0].tolist())]
+    conn = FakeConnection(catalog_rows, mfcc_rows)
+
+    df, feature_matrix, genres, tags, moods = catalog_stream.stream_catalog(conn, chunk_size=2, copy_audio=True)
+
+    assert conn.rollbacks == 1
+    # Каталог читается один раз, после отката перечитываются только аудиофичи
+    assert sum("FROM beats b" in sql for sql in conn.queries) == 1
+    assert conn.queries[-1].startswith("SELECT beat_id") and "FROM mfccs" in conn.queries[-1]
+    audio = df[catalog_stream.AUDIO_COLUMNS].to_numpy()
+    np.testing.assert_array_equal(audio[0], values[0])
+    assert np.isnan(audio[1]).all()
+    np.testing.assert_array_equal(audio[2], values[2])
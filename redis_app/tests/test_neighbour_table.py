@@ -0,0 +1,63 @@
+import json
+import numpy as np
+import pytest
+from infrastructure.version_pointer import write_current
+from services.catalog_index import CatalogIndex
+from services.neighbour_table import META_FILE, NeighbourTable
+
+WEIGHTS = (0.2, 0.3, 0.3, 0.2)
+TABLE_BEATS = ["a", "b", "c", "d", "e"]
+TABLE_HASHES = np.array([1, 2, 3, 4, 5], dtype=np.uint64)
+# Соседи каждой строки таблицы по убыванию скора
+TABLE_IDS = np.array([[1, 2, 3], [0, 2, 4], [3, 0, 1], [2, 4, 0], [3, 1, 2]], dtype=np.int32)
+TABLE_SCORES = np.array([[0.9, 0.8, 0.7], [0.9, 0.6, 0.5], [0.95, 0.8, 0.6],
+                         [0.95, 0.7, 0.6], [0.7, 0.5, 0.4]], dtype=np.float16)
+
+
+@pytest.fixture
+def table(tmp_path) -> NeighbourTable:
+    path = tmp_path / "20240101000000"
+    path.mkdir()
+    np.save(path / "ids.npy", TABLE_IDS)
+    np.save(path / "scores.npy", TABLE_SCORES)
+    np.save(path / "beat_ids.npy", np.array(TABLE_BEATS, dtype=str))
+    np.save(path / "row_hashes.npy", TABLE_HASHES)
+    (path / META_FILE).write_text(json.dumps({"k": 3, "weights": list(WEIGHTS), "content_version": "old"}))
+    write_current(str(tmp_path), path.name)
+    table = NeighbourTable(str(tmp_path))
+    assert table.reload()
+    return table
+
+
+def catalog(beats, hashes) -> CatalogIndex:
+    empty = [[] for _ in beats]
+    return CatalogIndex(beats, empty, empty, empty, row_hashes=np.array(hashes, dtype=np.uint64))
+
+
+def test_rows_are_mapped_by_beat_id(table):
+    # Другой порядок строк и новый трек f: версия каталога другая, но таблица применима
+    index = catalog(["f", "e", "d", "c", "b", "a"], [6, 5, 4, 3, 2, 1])
+
+    rows, scores = table.similar_rows(index, "a", 3, WEIGHTS)
+
+    assert [index.beat_ids[row] for row in rows] == ["b", "c", "d"]
+    np.testing.assert_allclose(scores, TABLE_SCORES[0].astype(np.float32))
+
+
+def test_changed_and_removed_tracks_are_skipped(table):
+    # c изменился, e удален
+    index = catalog(["a", "b", "c", "d"], [1, 2, 33, 4])
+
+    assert table.similar_rows(index, "c", 1, WEIGHTS) is None
+    rows, scores = table.similar_rows(index, "a", 2, WEIGHTS)
+    assert [index.beat_ids[row] for row in rows] == ["b", "d"]
+    np.testing.assert_allclose(scores, TABLE_SCORES[0, [0, 2]].astype(np.float32))
+    # У b после пропуска c и e остается один пригодный сосед
+    assert table.similar_rows(index, "b", 2, WEIGHTS) is None
+    assert table.similar_rows(index, "new", 1, WEIGHTS) is None
+
+
+def test_other_weights_or_depth_are_rejected(table):
+    index = catalog(TABLE_BEATS, TABLE_HASHES)
+    assert table.similar_rows(index, "a", 4, WEIGHTS) is None
+    assert table.similar_rows(index, "a", 2, (0.25, 0.25, 0.25, 0.25)) is None
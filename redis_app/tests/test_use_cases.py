@@ -0,0 +1,151 @@
+import threading
+import time
+import pytest
+import core.use_cases as use_cases
+from config import SIMILAR_TRACKS_CACHE_K
+
+
+class FakeRedis:
+    """Блокировки расчета и записи похожих треков в словарях"""
+
+    def __init__(self):
+        self.locks = {}
+        self.entries = {}
+
+    def acquire_lock(self, name, ttl_ms):
+        if name in self.locks:
+            return None
+        self.locks[name] = "token"
+        return "token"
+
+    def release_lock(self, name, token):
+        if self.locks.get(name) == token:
+            del self.locks[name]
+
+    def lock_held(self, name):
+        return name in self.locks
+
+    def locks_held(self, names):
+        return [name in self.locks for name in names]
+
+    def get_many_similar_tracks(self, track_ids, version=None):
+        return [(self.entries[track_id], None) if track_id in self.entries else None for track_id in track_ids]
+
+
+class FakeIndex:
+    beat_ids = [f"beat-{row}" for row in range(200)]
+    content_version = "v1"
+
+    def __len__(self):
+        return len(self.beat_ids)
+
+    def __contains__(self, beat_id):
+        return beat_id in self.beat_ids
+
+    def row(self, beat_id):
+        return self.beat_ids.index(beat_id) if beat_id in self.beat_ids else None
+
+
+INDEX = FakeIndex()
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    fake = FakeRedis()
+    monkeypatch.setattr(use_cases, "redis_cache", fake)
+    monkeypatch.setattr(use_cases, "tracks_from_rows", lambda df, index, rows: list(rows))
+
+    def cache(track_id, beat_ids, scores, version, lock_name=None, lock_token=None):
+        fake.entries[track_id] = list(beat_ids)
+        if lock_token is not None:
+            fake.release_lock(lock_name, lock_token)
+
+    monkeypatch.setattr(use_cases, "_cache_similar_tracks", cache)
+    monkeypatch.setattr(use_cases, "get_updated_data", lambda: (None, None, None, None, None, INDEX))
+    monkeypatch.setattr(use_cases, "ensure_dataset", lambda: None)
+    monkeypatch.setattr(use_cases.globals, "catalog_index", INDEX)
+    monkeypatch.setattr(use_cases.similar_tracks_cache, "get_many", lambda track_ids: {})
+    return fake
+
+
+def ranked_batch(calls, delay=0.0):
+    def rank_similar_batch(track_ids, top_n):
+        calls.append((sorted(track_ids), top_n))
+        time.sleep(delay)
+        return None, INDEX, {track_id: (list(range(top_n)), [0.0] * top_n) for track_id in track_ids}
+    return rank_similar_batch
+
+
+def test_requests_with_different_top_n_share_one_computation(redis, monkeypatch):
+    calls = []
+
+    def rank_similar(track_id, top_n):
+        calls.append(top_n)
+        time.sleep(0.2)
+        return None, INDEX, list(range(top_n)), [0.0] * top_n
+
+    monkeypatch.setattr(use_cases, "rank_similar", rank_similar)
+    results = {}
+    threads = [threading.Thread(target=lambda n=n: results.__setitem__(n, use_cases.compute_similar_tracks("t", n)))
+               for n in (5, 10, SIMILAR_TRACKS_CACHE_K)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [SIMILAR_TRACKS_CACHE_K]
+    assert {n: len(rows) for n, rows in results.items()} == {5: 5, 10: 10, SIMILAR_TRACKS_CACHE_K: SIMILAR_TRACKS_CACHE_K}
+    assert len(redis.entries["t"]) == SIMILAR_TRACKS_CACHE_K
+    assert not redis.locks
+
+
+def test_batch_misses_are_cached_at_cache_depth(redis, monkeypatch):
+    calls = []
+    monkeypatch.setattr(use_cases, "rank_similar_batch", ranked_batch(calls))
+
+    results = use_cases.get_similar_tracks_batch_use_case(["beat-1", "beat-2", "missing"], 5)
+
+    assert calls == [(["beat-1", "beat-2"], SIMILAR_TRACKS_CACHE_K)]
+    assert [len(results["beat-1"]), len(results["beat-2"]), results["missing"]] == [5, 5, None]
+    assert {track_id: len(beat_ids) for track_id, beat_ids in redis.entries.items()} == \
+        {"beat-1": SIMILAR_TRACKS_CACHE_K, "beat-2": SIMILAR_TRACKS_CACHE_K}
+    assert not redis.locks
+
+
+def test_batch_shares_computation_with_single_request(redis, monkeypatch):
+    single_calls, batch_calls = [], []
+
+    def rank_similar(track_id, top_n):
+        single_calls.append(track_id)
+        time.sleep(0.3)
+        return None, INDEX, list(range(top_n)), [0.0] * top_n
+
+    monkeypatch.setattr(use_cases, "rank_similar", rank_similar)
+    monkeypatch.setattr(use_cases, "rank_similar_batch", ranked_batch(batch_calls))
+    single = threading.Thread(target=use_cases.compute_similar_tracks, args=("beat-1", 10))
+    single.start()
+    time.sleep(0.1)
+
+    results = use_cases.get_similar_tracks_batch_use_case(["beat-1", "beat-2"], 10)
+    single.join()
+
+    assert single_calls == ["beat-1"]
+    assert batch_calls == [(["beat-2"], SIMILAR_TRACKS_CACHE_K)]
+    assert len(results["beat-1"]) == 10
+
+
+def test_batch_waits_for_track_locked_by_another_process(redis, monkeypatch):
+    calls = []
+    monkeypatch.setattr(use_cases, "rank_similar_batch", ranked_batch(calls))
+    lock_name = use_cases._compute_lock_name("beat-2", SIMILAR_TRACKS_CACHE_K)
+    redis.locks[lock_name] = "other"
+
+    def other_process():
+        redis.entries["beat-2"] = INDEX.beat_ids[:SIMILAR_TRACKS_CACHE_K]
+        del redis.locks[lock_name]
+
+    threading.Timer(0.1, other_process).start()
+    results = use_cases.get_similar_tracks_batch_use_case(["beat-1", "beat-2"], 5)
+
+    assert calls == [(["beat-1"], SIMILAR_TRACKS_CACHE_K)]
+    assert results["beat-2"] == [INDEX.row(beat_id) for beat_id in INDEX.beat_ids[:5]]